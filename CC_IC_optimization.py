@@ -9,21 +9,37 @@ import pandas as pd
 import numpy as np
 import scipy
 import matplotlib.pyplot as plt
-from functions import gp_model, reification, knowledge_gradient
+from functions import gp_model, reification, hp_optimize_models, set_gp_backend
 from reduced_order_models import isostrain_IS, isostress_IS, isowork_IS
 from time import time
 from tqdm import tqdm
 from copy import deepcopy
-from pyDOE import lhs
-from kmedoids import kMedoids
+from rng import rng_streams, lhs
+from kmedoids import kMedoids, fastPAM, clara
+from kg_tasks import kg_context, chunk_scheduler, run_kg_tasks, best_kg_points
+from run_options import parse_run_options
+from thread_governor import thread_governor
+from checkpoint import save_checkpoint, find_checkpoint, load_checkpoint, \
+                       restore_checkpoint
+from results_sink import results_sink, RESULTS_TABLES
+from instrumentation import phase_timer, kg_trace
+from budget import cost_ledger, parse_charges
+from truth_evaluator import create_truth_evaluator
+from feasibility import feasibility_lookup
+from candidates import candidate_pool, unit_to_design
+from screening import screen_candidates, compare_choices
+from batch_selection import greedy_batch
+from hp_pruning import prune_hyper_parameters
+from acquisition import optimize_acquisition
 import os
 import sys
-import multiprocessing
-from time import sleep
 import datetime as dt
 
 class RVE_GP():
-    def __init__(self):
+    def __init__(self, inducing=None, sparse_method='fitc'):
+        # with inducing points the GP is the inducing point approximation
+        self.inducing = inducing
+        self.sparse_method = sparse_method
         self.mean = 0
         self.std = 0
         self.gp = 0
@@ -37,7 +53,8 @@ class RVE_GP():
         self.mean = np.mean(data.iloc[:,5])
         self.std = np.std(data.iloc[:,5])
         data.iloc[:,5] = (data.iloc[:,5]-self.mean)/self.std
-        self.gp = gp_model(data.iloc[:,0:4], data.iloc[:,5], np.array([0.12274117, 0.08612411, 0.65729583, 0.23342798]), 0.16578065, 0.1, 4, 'SE')
+        self.gp = gp_model(data.iloc[:,0:4], data.iloc[:,5], np.array([0.12274117, 0.08612411, 0.65729583, 0.23342798]), 0.16578065, 0.1, 4, 'SE', 
+                           inducing=self.inducing, sparse_method=self.sparse_method)
 
     def predict(self, x_predict):
         if len(x_predict.shape) == 1:
@@ -126,7 +143,8 @@ class RVE_GP():
             self.gp = gp_model(data.iloc[train_data[i],[0,1,2,3]], 
                           data.iloc[train_data[i],5], 
                           [0.12274117, 0.08612411, 0.65729583, 0.23342798], 
-                          0.16578065, 0.1, 4, 'SE')
+                          0.16578065, 0.1, 4, 'SE', inducing=self.inducing, 
+                          sparse_method=self.sparse_method)
             out = self.predict(np.array(data_1.iloc[test_data[i],[0,1,2,3]]))
             results[i*150:(i+1)*150,0] = out
             results[i*150:(i+1)*150,1] = data.iloc[test_data[i],5] * self.std + self.mean
@@ -141,7 +159,10 @@ class RVE_GP():
         return results, results_all
 
 class TC_GP():
-    def __init__(self):
+    def __init__(self, inducing=None, sparse_method='fitc'):
+        # with inducing points the GPs are the inducing point approximation
+        self.inducing = inducing
+        self.sparse_method = sparse_method
         self.y_mean = []
         self.y_std = []
         self.y_max = []
@@ -169,7 +190,9 @@ class TC_GP():
             y_train = (np.array(data.iloc[:,k+5])-self.y_mean[k])/self.y_std[k]
             l_param = l_param_list[k]
             sf = sf_list[k]
-            self.tc_gp.append(gp_model(x_train, y_train, np.array(l_param), sf, 0.05, 4, 'M52'))
+            self.tc_gp.append(gp_model(x_train, y_train, np.array(l_param), sf, 0.05, 4, 'M52', 
+                                       inducing=self.inducing, 
+                                       sparse_method=self.sparse_method))
             
     def TC_GP_Predict(self, index, x_predict):
         # x_predict = np.expand_dims(x_predict, 0)
@@ -228,8 +251,11 @@ class model_reification():
         self.model_hp = {"l": np.array(l_param),
                          "sf": np.array(sigma_f),
                          "sn": np.array(sigma_n)}
-        self.err_mean = []
-        self.err_std = []
+        # normalisation of the error models and the predictions of each low
+        # order GP at the truth points (None when the GP has been updated)
+        self.err_mean = [0]*num_models
+        self.err_std = [1]*num_models
+        self.err_pred = [None]*num_models
         self.err_model_hp = {"l": np.array(l_param_err),
                              "sf": np.array(sigma_f_err),
                              "sn": np.array(sigma_n_err)}
@@ -273,15 +299,9 @@ class model_reification():
         """
         gp_error_models = []
         for i in range(self.num_models):
-            gpmodel_mean, gpmodel_var = self.gp_models[i].predict_var(self.x_true)
-            gpmodel_mean = gpmodel_mean * self.model_std[i] + self.model_mean[i]
-            error = np.abs(self.y_true-gpmodel_mean)
-            self.err_mean.append(np.mean(error))
-            self.err_std.append(np.std(error))
-            if self.err_std[i] == 0:
-                self.err_std[i] = 1
+            error = self.normalised_error(i)
             new_model = gp_model(self.x_true, 
-                                 (error-self.err_mean[i])/self.err_std[i], 
+                                 error, 
                                  self.err_model_hp["l"][i], 
                                  self.err_model_hp["sf"][i], 
                                  self.err_model_hp["sn"][i], 
@@ -290,6 +310,30 @@ class model_reification():
             gp_error_models.append(new_model)
         return gp_error_models
     
+    def normalised_error(self, index):
+        """
+        The error of low order GP index at all the truth points, normalised
+        with its current mean and standard deviation (which are kept in
+        err_mean and err_std for the predictions of the error model). The
+        predictions of the low order GP at the truth points are kept, so only
+        the truth points added since the last call are predicted, unless the
+        low order GP has been updated in the meantime.
+        """
+        known = 0 if self.err_pred[index] is None else self.err_pred[index].shape[0]
+        if known < self.x_true.shape[0]:
+            gpmodel_mean, gpmodel_var = self.gp_models[index].predict_var(self.x_true[known:])
+            gpmodel_mean = gpmodel_mean * self.model_std[index] + self.model_mean[index]
+            if known == 0:
+                self.err_pred[index] = gpmodel_mean
+            else:
+                self.err_pred[index] = np.append(self.err_pred[index], gpmodel_mean)
+        error = np.abs(self.y_true-self.err_pred[index])
+        self.err_mean[index] = np.mean(error)
+        self.err_std[index] = np.std(error)
+        if self.err_std[index] == 0:
+            self.err_std[index] = 1
+        return (error-self.err_mean[index])/self.err_std[index]
+    
     def create_fused_GP(self, x_test, l_param, sigma_f, sigma_n, kernel):
         model_mean = []
         model_var = []
@@ -320,11 +364,47 @@ class model_reification():
         self.x_train[model_index] = np.vstack((self.x_train[model_index], new_x))
         self.y_train[model_index] = np.append(self.y_train[model_index], new_y)
         self.gp_models[model_index].update(new_x, new_y, self.model_hp['sn'][model_index], False)
+        self.err_pred[model_index] = None
     
     def update_truth(self, new_x, new_y):
+        """
+        Add a batch of truth points (new_x has one row per point) and update
+        the error models once for the whole batch. The normalised errors
+        change at every truth point, so each error model is given the new
+        targets, the kernel is kept. With the numpy GP backend the Cholesky
+        factor of each error model is extended by the rows of the new points
+        (numpy_gp.compute); george has no such update and factorises the
+        covariance again.
+        """
         self.x_true = np.vstack((self.x_true, new_x))
         self.y_true = np.append(self.y_true, new_y)
-        self.gp_err_models = self.create_error_models()
+        for i in range(self.num_models):
+            err_model = self.gp_err_models[i]
+            err_model.x_train = self.x_true
+            err_model.y_train = self.normalised_error(i)
+            err_model.gp.compute(err_model.x_train, err_model.sigma_n)
+    
+    def optimize_hyper_params(self, starts=1, workers=1, random_state=None):
+        """
+        Fit the hyper-parameters of the low order GPs (see hp_optimize_models)
+        and keep them for the GPs created later. The error models are then
+        given the errors of the new low order GPs, and their hyper-parameters
+        are fitted to these errors.
+        """
+        rng = np.random.default_rng(random_state)
+        hp_optimize_models(self.gp_models, update=True, starts=starts, 
+                           workers=workers, random_state=rng)
+        self.model_hp['l'] = np.array([np.sqrt(gp.l_param) for gp in self.gp_models])
+        self.model_hp['sf'] = np.array([gp.sigma_f for gp in self.gp_models])
+        for i in range(self.num_models):
+            self.err_pred[i] = None
+            err_model = self.gp_err_models[i]
+            err_model.y_train = self.normalised_error(i)
+            err_model.gp.compute(err_model.x_train, err_model.sigma_n)
+        hp_optimize_models(self.gp_err_models, update=True, starts=starts, 
+                           workers=workers, random_state=rng)
+        self.err_model_hp['l'] = np.array([np.sqrt(gp.l_param) for gp in self.gp_err_models])
+        self.err_model_hp['sf'] = np.array([gp.sigma_f for gp in self.gp_err_models])
         
     def predict_low_order(self, x_predict, index):
         gpmodel_mean, gpmodel_var = self.gp_models[index].predict_var(x_predict)
@@ -370,13 +450,12 @@ def predict_low_order_model(tc_gp, x_predict, model):
         return isowork_IS(tc_out, ep)
     
 class tc_vf_classifier():
-    def __init__(self):
-        self.setup()
+    def __init__(self, size=200, random_state=None):
+        self.setup(size, random_state)
         
-    def setup(self):
+    def setup(self, size=200, random_state=None):
+        # the classifier is trained on a size x size grid of the design space
         tc_gp = TC_GP()
-    
-        size = 200
         
         temp = np.linspace(0,1,size,endpoint=True)
         
@@ -393,55 +472,28 @@ class tc_vf_classifier():
         output[np.nonzero(tc_out[:,0] > 0.9)] = 1
         
         from sklearn.tree import DecisionTreeClassifier
-        self.clf = DecisionTreeClassifier()
+        self.clf = DecisionTreeClassifier(random_state=random_state)
         self.clf.fit(x_fused,output)
     
     def predict(self, x_fused):
         return self.clf.predict(x_fused)
 
-def k_medoids(sample, num_clusters):
-    D = scipy.spatial.distance_matrix(sample, sample)
-    M, C = kMedoids(D, num_clusters)
+def k_medoids(sample, num_clusters, method='voronoi', clara_threshold=2000, 
+              random_state=None):
+    # 'voronoi' is the original random initialisation and Voronoi iteration,
+    # 'fastpam' uses BUILD and FastPAM swaps on the full distance matrix up to
+    # clara_threshold points and CLARA sub-sampling above that
+    if method == 'voronoi':
+        D = scipy.spatial.distance_matrix(sample, sample)
+        M, C = kMedoids(D, num_clusters, random_state=random_state)
+    elif method == 'clara' or sample.shape[0] > clara_threshold:
+        M, C = clara(sample, num_clusters, random_state=random_state)
+    else:
+        D = scipy.spatial.distance_matrix(sample, sample)
+        M, C = fastPAM(D, num_clusters)
     return M, C
 
-def calculate(process_name, tasks, results):
-    # this multiprocess work will calculate the knowledge gradient choice for
-    # a single set of hyper-parameters.
-    while True:
-        (finish, model_temp, x_fused, fused_model_HP, \
-         kernel, x_test, jj, kk, mm, true_sample_count) = tasks.get()
-        if finish < 0:
-            results.put(-1)
-            break
-        else:
-            cost = [0.246179, 0.890249,  1.827838]
-            output = [0,0,0,0,0,jj,kk,mm,0,0]
-            model_temp.create_fused_GP(x_fused, fused_model_HP[0:2], 
-                                        fused_model_HP[2], 0.1, 
-                                        kernel)
-            fused_mean, fused_var = model_temp.predict_fused_GP(x_test)
-            
-            index_max = np.nonzero(fused_mean == np.max(fused_mean))
-            output[0] = np.max(fused_mean)
-            output[1] = x_test[index_max,0]
-            output[2] = x_test[index_max,1]
-            
-            nu_star, x_star, NU = knowledge_gradient(true_sample_count, 
-                                                      0.1, 
-                                                      fused_mean, 
-                                                      fused_var)
-            output[3] = nu_star/cost[jj]
-            output[4] = x_star
-            output[8] = x_test[x_star,0]*200 + 650
-            output[9] = x_test[x_star,1]
-            results.put(output)
-
-if __name__ == "__main__":     
-    param = sys.argv
-    # When testing, particularly in Spyder, the following ensures the correct
-    # operation of the code
-    if len(param) == 1:
-        param = ['', 'M52', '2', '10', '50', '1', '1', '2000000', '1000']
+def run_campaign(param, options, shared=None):
     """
     This code is to do batch bayesian optimization of two dimensional problem
     within the DEMS project. The assumption at this point is that we have
@@ -451,7 +503,21 @@ if __name__ == "__main__":
     the Fused Model GP. However, this approach is still taking the step that
     while we know the ideal parameters for the low order GPs we have only very
     limited information from the low-order models to start with.
+
+    shared holds the models that the campaign runner (campaigns.py) builds
+    once for all of its campaigns: the Thermo-Calc GP ('tc_gp'), the RVE
+    GP ('rve_gp'), the feasibility map ('clf') and the turns at the knowledge
+    gradient workers ('kg_turns'). Anything missing is built here.
     """
+    # the backend of all the GPs built from here on
+    set_gp_backend(options['gp-backend'])
+
+    resume_state = None
+    if options['resume']:
+        # continue a campaign from its last checkpoint, using the inputs it
+        # was started with
+        resume_state = load_checkpoint(find_checkpoint(options['resume'], 'results_Iter_'))
+        param = resume_state['param']
 
     kernel = param[1]           # define the kernel to be used when defining the GPs
     iter_count = int(param[2])  # define the number of iterations
@@ -461,21 +527,33 @@ if __name__ == "__main__":
     rve_iter = int(param[6])    # define the number of iterations between each RVE call
     total_budget = int(param[7])# define the total budget 
     rve_budget = int(param[8])  # define the RVE budget
-    with open("current_index.txt",'r') as f:
-        curr_index = f.read()
-    init_index = int(curr_index)
+    # the row of data/init_data.csv used for the initial data
+    if options['init-index'] >= 0:
+        init_index = options['init-index']
+    else:
+        with open("current_index.txt",'r') as f:
+            curr_index = f.read()
+        init_index = int(curr_index)
+    if resume_state is not None:
+        init_index = resume_state['init_index']
+    # all the random numbers of the campaign come from streams derived from
+    # a single seed, when resuming the seed of the campaign is used
+    streams = rng_streams(options['seed'] if options['seed'] >= 0 else None)
+    if resume_state is not None:
+        streams = resume_state['streams']
     today = dt.datetime.today()
     date = "{}_{}_{}_{}_{}".format(today.year,today.month,today.day,today.hour,today.minute)
+    if options['results-dir']:
+        date = options['results-dir']
+    if resume_state is not None:
+        date = resume_state['date']
     
     results_dir_name = 'results_Iter_{}m-{}hp-{}sc-{}ri'.format(num_medoids, hp_count, sample_count, rve_iter)
-    try:
-        os.mkdir('results')
-    except FileExistsError:
-        pass
-    try:
-        os.mkdir('results/{}'.format(date))
-    except FileExistsError:
-        pass
+    os.makedirs('results/{}'.format(date), exist_ok=True)
+    if resume_state is None:
+        # the campaign can be repeated with --seed=<entropy>
+        with open("results/{}/{}_seed.txt".format(date, results_dir_name), 'w') as f:
+            f.write("{}\n".format(streams.entropy))
 
     # define the points for creating the fused GP
     points1 = 27
@@ -488,7 +566,15 @@ if __name__ == "__main__":
     
     temp = deepcopy(x_fused)
     temp[:,0] = temp[:,0]*200 + 650
-    clf = tc_vf_classifier()
+    if shared is None:
+        shared = {}
+    kg_turns = shared.get('kg_turns')
+    if 'clf' in shared:
+        clf = shared['clf']
+    else:
+        # the feasible region is looked up in the map stored in data/, which
+        # is only built when it is missing or out of date
+        clf = feasibility_lookup(TC_GP, 200, options['feasibility-refine'])
     
     clf_out = clf.predict(temp)
         
@@ -503,10 +589,12 @@ if __name__ == "__main__":
                              [random_init[init_index, 2],random_init[init_index, 3]]])
     
     # define the Thermo-Calc GP
-    tc_gp = TC_GP()
+    tc_gp = shared['tc_gp'] if 'tc_gp' in shared else TC_GP(options['sparse-inducing'], 
+                                                            options['sparse-method'])
     # define the RVE GP - This GP is used in lieu of the actual RVE code,
     # a separate GP will be created for the data extracted from the RVE code
-    rve_gp = RVE_GP()
+    rve_gp = shared['rve_gp'] if 'rve_gp' in shared else RVE_GP(options['sparse-inducing'], 
+                                                                 options['sparse-method'])
     
     rve_out = rve_gp.predict(initial_data)
 
@@ -551,15 +639,11 @@ if __name__ == "__main__":
     
     #model_control.plot_models(tc_gp, -1, results_dir_name)
     
-    fused_model_HP = lhs(3,hp_count)
+    fused_model_HP = lhs(3,hp_count, streams.generator('fused_hp'))
     fused_model_HP[:,0] = fused_model_HP[:,0]*20 + 0.01
     fused_model_HP[:,1] = fused_model_HP[:,1]*20 + 0.01
     fused_model_HP[:,2] = fused_model_HP[:,2]*99.9 + 0.1
     
-    with open("results/{}/{}_model_record.csv".format(date, results_dir_name), 'w') as f:
-        f.write("Isostrain,Isostress,Isowork,RVE,\n")
-        f.write("0,0,0,0,\n")
-        
     model_record = [0,0,0,0]
     iteration_time = [0]
     medoids_list = []
@@ -567,246 +651,412 @@ if __name__ == "__main__":
     all_RVE_y = []
     max_RVE = [np.max(rve_out)]
     
-    with open("results/{}/{}_iteration_data.csv".format(date, results_dir_name), 'w') as f:
-        f.write("Iteration,Model,Temperature,Carbon,Model Out,\n")
-        f.write("Iteration,Model,Temperature,Carbon,Model Out,\n")
-        f.write("{},{},{},{},{},\n".format(-1,0,initial_data[0,0],initial_data[0,1],y_init[0][0])) 
-        f.write("{},{},{},{},{},\n".format(-1,0,initial_data[1,0],initial_data[1,1],y_init[0][1]))
-        f.write("{},{},{},{},{},\n".format(-1,1,initial_data[0,0],initial_data[0,1],y_init[1][0]))
-        f.write("{},{},{},{},{},\n".format(-1,1,initial_data[1,0],initial_data[1,1],y_init[1][1]))
-        f.write("{},{},{},{},{},\n".format(-1,2,initial_data[0,0],initial_data[0,1],y_init[2][0]))
-        f.write("{},{},{},{},{},\n".format(-1,2,initial_data[1,0],initial_data[1,1],y_init[2][1]))
-        f.write("{},{},{},{},{},\n".format(-1,3,initial_data[0,0],initial_data[0,1],rve_out[0]))
-        f.write("{},{},{},{},{},\n".format(-1,3,initial_data[1,0],initial_data[1,1],rve_out[1]))
+    # Define the number of workers for the knowledge gradient stage and the 
+    # number of BLAS/OpenMP threads each worker can use
+    governor = thread_governor(options['kg-workers'], options['blas-threads'])
+    governor.apply_environment()
+    # The scheduler decides how many tasks are sent to a worker at once, the
+    # latency estimate it uses is carried over between iterations
+    scheduler = chunk_scheduler(governor.num_workers, options['chunk-size'], 
+                                options['chunk-time'])
     
-    with open("results/{}/{}_iteration_cost.csv".format(date, results_dir_name), 'w') as f:
-        f.write("Model Cost, Total Budget Left, RVE Budget Left,\n")
-        
-        
-    # Define IPC manager
-    manager = multiprocessing.Manager()
-
-    # Define a list (queue) for tasks and computation results
-    tasks = manager.Queue()
-    results = manager.Queue()
+    # The cost ledger keeps the modelled cost of the evaluations and the
+    # measured compute of the acquisition separately, the budget policy
+    # decides which of them are taken from the budgets
+    ledger = cost_ledger(total_budget, rve_budget, 
+                         parse_charges(options['budget-charges']))
+    
+    first_iteration = 0
+    if resume_state is not None:
+        # restore the state of the loop, the random number generators and the
+        # log files as they were at the end of the last completed iteration
+        restore_checkpoint(resume_state)
+        first_iteration = resume_state['iteration']
+        model_control = resume_state['model_control']
+        fused_model_HP = resume_state['fused_model_HP']
+        sample_count = resume_state['sample_count']
+        ledger = resume_state['ledger']
+        max_RVE = resume_state['max_RVE']
+        model_record = resume_state['model_record']
+        iteration_time = resume_state['iteration_time']
+        all_RVE_x = resume_state['all_RVE_x']
+        all_RVE_y = resume_state['all_RVE_y']
+        scheduler.latency = resume_state['scheduler_latency']
+        governor.num_workers, governor.blas_threads, governor.calibration = resume_state['governor']
+        scheduler.num_workers = governor.num_workers
+    
+    # The truth model is evaluated inline or by a pool of workers while the
+    # loop goes on, the jobs still running at the checkpoint are submitted again
+    truth = create_truth_evaluator(options['truth-evaluator'], rve_gp, 
+                                   options['truth-workers'])
+    if resume_state is not None:
+        for job_iteration, x_new in resume_state['truth_pending']:
+            truth.submit(job_iteration, x_new)
     
-    # Create process pool with four processes
-    num_processes = multiprocessing.cpu_count()
-    if num_processes > 25:
-        num_processes = 20
-    pool = multiprocessing.Pool(processes=num_processes)
+    # With --candidate-pool the candidates are kept between the iterations,
+    # the chosen ones are retired and new ones are added in their place
+    candidates = None
+    if options['candidate-pool']:
+        candidates = candidate_pool(clf, options['candidate-sampler'], 
+                                    streams.generator('candidates'))
+        if resume_state is not None:
+            candidates = resume_state['candidates']
+    
+    # The results tables are buffered in memory and written to disk in batches,
+    # when resuming the records are appended to the existing tables
+    results = results_sink(date, results_dir_name, options['results-format'], 
+                           append=(resume_state is not None))
+    for table in ['model_record', 'iteration_data', 'iteration_cost', 'cost_ledger', 
+                  'kg_throughput']:
+        results.add_table(table, *RESULTS_TABLES[table])
+    screening = options['screen-keep'] < 1
+    if screening:
+        results.add_table('screening', *RESULTS_TABLES['screening'])
+    if options['acquisition-optimizer']:
+        results.add_table('acquisition', *RESULTS_TABLES['acquisition'])
+    if options['hp-prune'] > 0:
+        results.add_table('hp_pruning', *RESULTS_TABLES['hp_pruning'])
+    audits = [0, 0]
+    if resume_state is None:
+        results.append('model_record', 0, 0, 0, 0)
+        for jj in range(3):
+            for kk in range(2):
+                results.append('iteration_data', -1, jj, initial_data[kk,0], 
+                               initial_data[kk,1], y_init[jj][kk])
+        for kk in range(2):
+            results.append('iteration_data', -1, 3, initial_data[kk,0], 
+                           initial_data[kk,1], rve_out[kk])
     
-    rve_Budget_Left = rve_budget
-    total_Budget_Left = total_budget
+    # wall and CPU time of each phase of the iterations
+    timer = phase_timer("results/{}/{}_trace.jsonl".format(date, results_dir_name), 
+                        options['trace'], append=(resume_state is not None))
     
-    for ii in tqdm(range(iter_count)):
+    for ii in tqdm(range(first_iteration, iter_count)):
         start_iteration = time()
         start = time()
-        x_test = lhs(2, sample_count)
-        x_test1 = deepcopy(x_test)
-        x_test1[:,0] = x_test1[:,0]*200 + 650
-        
-        clf_out = clf.predict(x_test1)
-        
-        x_test = x_test[np.nonzero(clf_out==0)[0],:]
-        x_test1 = x_test1[np.nonzero(clf_out==0)[0],:]
+        # the hyper-parameter sets of the fused GP that fit its training data
+        # too badly are not used in this iteration
+        if options['hp-prune'] > 0:
+            with timer.phase('hp_pruning'):
+                start_pruning = time()
+                keep, hp_likelihood = prune_hyper_parameters(model_control, x_fused, 
+                                                             fused_model_HP, kernel, 
+                                                             options['hp-prune'])
+                active_HP = fused_model_HP[keep]
+                results.append('hp_pruning', ii, fused_model_HP.shape[0], keep.shape[0], 
+                               np.max(hp_likelihood), time() - start_pruning)
+        else:
+            active_HP = fused_model_HP
+        with timer.phase('sampling'):
+            # all the candidates are inside the feasible region
+            if options['acquisition-optimizer']:
+                # the candidates are the best points of the expected
+                # improvement of the fused model
+                start_search = time()
+                x_test, acquisition = optimize_acquisition(model_control, x_fused, 
+                                                           active_HP, kernel, clf, 
+                                                           sample_count, 
+                                                           streams.generator('candidates', ii), 
+                                                           options['acquisition-starts'])
+                results.append('acquisition', ii, x_test.shape[0], 
+                               acquisition['local_maxima'], acquisition['evaluations'], 
+                               acquisition['best_ei'], acquisition['best_sample_ei'], 
+                               time() - start_search)
+            elif options['candidate-pool']:
+                x_test = candidates.draw(sample_count)
+            else:
+                x_test = candidate_pool(clf, options['candidate-sampler'], 
+                                        streams.generator('candidates', ii)).draw(sample_count)
+            x_test1 = unit_to_design(x_test)
         
         true_sample_count = x_test1.shape[0]
         
-        tc_out = tc_gp.predict(x_test1)
-               
-        x_test.shape
-        new_mean = []
-        
-        # obtain predictions for the mechanical properties from the low-order
-        # GPs
-        new, var = model_control.predict_low_order(x_test, 
-                                                    model_index['isostrain'])
-        new_mean.append(new)
-        new, var = model_control.predict_low_order(x_test, 
-                                                    model_index['isostress'])
-        new_mean.append(new)
-        new, var = model_control.predict_low_order(x_test, 
-                                                    model_index['isowork'])
-        new_mean.append(new)
-                
-        kg_output = [] 
-        
-        processes = []
-        # Initiate the worker processes
-        for i in range(num_processes):
-        
-            # Set process name
-            process_name = 'P%i' % i
-        
-            # Create the process, and connect it to the worker function
-            new_process = multiprocessing.Process(target=calculate, args=(process_name,tasks,results))
-        
-            # Add new process to the list of processes
-            processes.append(new_process)
+        with timer.phase('low_order_prediction'):
+            x_test.shape
+            new_mean = []
         
-            # Start the process
-            new_process.start()
+            # obtain predictions for the mechanical properties from the low-order
+            # GPs
+            new, var = model_control.predict_low_order(x_test, 
+                                                        model_index['isostrain'])
+            new_mean.append(new)
+            new, var = model_control.predict_low_order(x_test, 
+                                                        model_index['isostress'])
+            new_mean.append(new)
+            new, var = model_control.predict_low_order(x_test, 
+                                                        model_index['isowork'])
+            new_mean.append(new)
+                
+        # Only the candidates with the best upper confidence bound of the fused
+        # model go on to the knowledge gradient, all of them are kept for the
+        # audit of the screening
+        audit = screening and (options['screen-audit'] > 0) and \
+                (ii % options['screen-audit'] == 0)
+        if screening:
+            x_all = x_test
+            new_mean_all = new_mean
+            with timer.phase('screening'):
+                start_screen = time()
+                keep, ucb = screen_candidates(model_control, x_fused, active_HP, 
+                                              kernel, x_test, options['screen-keep'], 
+                                              options['screen-beta'], num_medoids)
+                x_test = x_test[keep,:]
+                x_test1 = x_test1[keep,:]
+                new_mean = [new[keep] for new in new_mean]
+                true_sample_count = x_test.shape[0]
+                screen_time = time() - start_screen
         
         # Calculate the Knowledge Gradient for each of the test points in each
-        # model for each set of hyperparameters
-        for jj in range(3):
-            for kk in range(true_sample_count):
-                model_temp = deepcopy(model_control)
-                model_temp.update_GP(np.expand_dims(x_test[kk], axis=0), 
-                                      np.expand_dims(np.array([new_mean[jj][kk]]), 
-                                                axis=0), jj)
-    
-                # model_temp.update_GP(x_test[kk], 
-                #                      np.array([new_mean[jj][kk]]), 0)
-                for mm in range(hp_count):
-                    single_task = (1, model_temp, x_fused, fused_model_HP[mm,:],
-                                    kernel, x_test, jj, kk, mm, true_sample_count)
-                    tasks.put(single_task)
-                    
-        # Wait while the workers process
-        sleep(60)
-        
-        # Quit the worker processes by sending them -1
-        for i in range(num_processes):
-            tasks.put((-1,1,1,1,1,1,1,1,1,1))
-            
-        # Read calculation results
-        num_finished_processes = 0
-        while True:
-            # Read result
-            new_result = results.get()
-        
-            # Have a look at the results
-            if new_result == -1:
-                # Process has finished
-                num_finished_processes += 1
-        
-                if num_finished_processes == num_processes:
-                    break
-            else:
-                # Output result
-                kg_output.append(new_result)
-                
-        for i in range(num_processes):
-            processes[i].terminate()
+        # model for each set of hyperparameters. The tasks are sent to the
+        # workers in chunks of candidates x hyper-parameter sets
+        context = kg_context(model_control, x_fused, active_HP, kernel, 
+                             x_test, new_mean, true_sample_count, 
+                             streams.sequence('kg_worker', ii))
+        kg_wait = 0
+        calibration_time = 0
+        if kg_turns is not None:
+            # wait for the turn of this campaign at the workers, the time
+            # spent waiting is not part of the cost of the acquisition
+            with timer.phase('kg_wait'):
+                start_wait = time()
+                kg_turns.acquire()
+                kg_wait = time() - start_wait
+        try:
+            if options['calibrate-threads'] and (not governor.calibration) and \
+               (options['kg-backend'] != 'serial'):
+                # pick the best split of the cores between workers and threads
+                # using the tasks of the first iteration, the one-off tuning is
+                # not part of the cost of the acquisition
+                with timer.phase('thread_calibration'):
+                    start_calibration = time()
+                    calibration = governor.calibrate(context, options['kg-backend'])
+                    calibration_time = time() - start_calibration
+                scheduler.num_workers = governor.num_workers
+                results.add_table('thread_calibration', *RESULTS_TABLES['thread_calibration'])
+                for workers, threads, throughput in calibration:
+                    results.append('thread_calibration', workers, threads, throughput)
+            with timer.phase('knowledge_gradient'):
+                kg_output, kg_report = run_kg_tasks(context, governor.num_workers, scheduler, 
+                                                    options['kg-backend'], 
+                                                    governor.blas_threads)
+        finally:
+            if kg_turns is not None:
+                kg_turns.release()
+        with timer.phase('logging'):
+            results.append('kg_throughput', ii, kg_report['backend'], 
+                           kg_report['workers'], kg_report['blas_threads'], 
+                           kg_report['tasks'], kg_report['wall_time'], 
+                           kg_report['throughput'], kg_report['utilisation'])
 
-        # convert to a numpy array for ease of indexing
-        kg_output = np.array(kg_output)
-        point_selection = {}
-        selected_indices = []
-        for iii in range(kg_output.shape[0]):
-            try:
-                if kg_output[iii,5] in point_selection[kg_output[iii,4]]['models']:
-                    if kg_output[iii,3] > point_selection[kg_output[iii,4]]['nu'][kg_output[iii,5]]:
-                        point_selection[kg_output[iii,4]]['nu'][kg_output[iii,5]] = kg_output[iii,3]
-                        point_selection[kg_output[iii,4]]['kg_out'][kg_output[iii,5]] = iii
-                else:
-                    point_selection[kg_output[iii,4]]['models'].append(kg_output[iii,5])
-                    point_selection[kg_output[iii,4]]['nu'][kg_output[iii,5]] = kg_output[iii,3]
-                    point_selection[kg_output[iii,4]]['kg_out'][kg_output[iii,5]] = iii
-            except KeyError:
-                point_selection[kg_output[iii,4]] = {'models':[kg_output[iii,5]],
-                                                     'nu':[-1e6,-1e6,-1e6],
-                                                     'kg_out':[-1,-1,-1]}
-                point_selection[kg_output[iii,4]]['nu'][kg_output[iii,5]] = kg_output[iii,3]
-                point_selection[kg_output[iii,4]]['kg_out'][kg_output[iii,5]] = iii
-        
-        med_input = [[],[],[],[]]        
-        for index in point_selection.keys():
-            for jjj in range(len(point_selection[index]['models'])):
-                med_input[0].append(point_selection[index]['nu'][point_selection[index]['models'][jjj]])
-                med_input[1].append(index)
-                med_input[2].append(point_selection[index]['models'][jjj])
-                med_input[3].append(point_selection[index]['kg_out'][point_selection[index]['models'][jjj]])
-        med_input = np.array(med_input).transpose()
-                   
-        
-        # Since there may be too many duplicates when using small numbers of
-        # test points and hyper-parameters check to make sure and then return
-        # all the points if there are less than the required number of points
-        if med_input.shape[0] > num_medoids:
-            medoids, clusters = k_medoids(med_input[:,0:3], num_medoids)
+        if options['batch-selection'] == 'greedy':
+            # the points are chosen one at a time, with fantasized updates of
+            # the models for the points already in the batch
+            with timer.phase('batch_selection'):
+                medoid_out = greedy_batch(context, kg_output, num_medoids, 
+                                          options['batch-shortlist'])
+                medoids = list(range(medoid_out.shape[0]))
         else:
-            medoids, clusters = k_medoids(med_input[:,0:3], int(med_input.shape[0]/3))       
-        
-        # next, need to get the true values for each of the medoids and update the
-        # models before starting next iteration.
+            # select the best set of hyperparameters for each (x_star, model) pair,
+            # the columns of med_input are [nu, x_star, model, row of kg_output]
+            with timer.phase('clustering'):
+                med_input = best_kg_points(kg_output)
+                       
+            
+                # Since there may be too many duplicates when using small numbers of
+                # test points and hyper-parameters check to make sure and then return
+                # all the points if there are less than the required number of points
+                if med_input.shape[0] > num_medoids:
+                    medoids, clusters = k_medoids(med_input[:,0:3], num_medoids, 
+                                                  options['medoid-method'], 
+                                                  options['clara-threshold'], 
+                                                  streams.generator('medoids', ii))
+                else:
+                    medoids, clusters = k_medoids(med_input[:,0:3], int(med_input.shape[0]/3), 
+                                                  options['medoid-method'], 
+                                                  options['clara-threshold'], 
+                                                  streams.generator('medoids', ii))
+            
+            # next, need to get the true values for each of the medoids and update the
+            # models before starting next iteration.
 
-        medoid_index = []
-        for i in range(len(medoids)):
-            medoid_index.append(int(med_input[medoids[i],3]))
-        medoid_out = kg_output[medoid_index,:]
+            medoid_index = []
+            for i in range(len(medoids)):
+                medoid_index.append(int(med_input[medoids[i],3]))
+            medoid_out = kg_output[medoid_index]
+        
+        audit_time = 0
+        if screening:
+            changed = 0
+            overlap = 1.0
+            if audit:
+                # the knowledge gradient and the batch for all the candidates,
+                # chosen in the same way as the batch of the screened ones, the
+                # time of the audit is not part of the cost of the acquisition
+                with timer.phase('screening_audit'):
+                    start_audit = time()
+                    full_context = kg_context(model_control, x_fused, active_HP, 
+                                              kernel, x_all, new_mean_all, 
+                                              x_all.shape[0], 
+                                              streams.sequence('kg_worker', ii))
+                    full_output, full_report = run_kg_tasks(full_context, 
+                                                            governor.num_workers, 
+                                                            scheduler, 
+                                                            options['kg-backend'], 
+                                                            governor.blas_threads)
+                    if options['batch-selection'] == 'greedy':
+                        full_choice = greedy_batch(full_context, full_output, num_medoids, 
+                                                   options['batch-shortlist'])
+                    else:
+                        full_input = best_kg_points(full_output)
+                        if full_input.shape[0] > num_medoids:
+                            full_count = num_medoids
+                        else:
+                            full_count = int(full_input.shape[0]/3)
+                        full_medoids, full_clusters = k_medoids(full_input[:,0:3], full_count, 
+                                                                options['medoid-method'], 
+                                                                options['clara-threshold'], 
+                                                                streams.generator('medoids', ii))
+                        full_choice = full_output[[int(full_input[m,3]) for m in full_medoids]]
+                    changed, overlap = compare_choices(medoid_out, full_choice)
+                    audits[0] += 1
+                    audits[1] += int(changed)
+                    audit_time = time() - start_audit
+            with timer.phase('logging'):
+                results.append('screening', ii, x_all.shape[0], true_sample_count, 
+                               screen_time, int(audit), int(changed), overlap)
                 
+        # the chosen points are not candidates again
+        if candidates is not None:
+            candidates.retire(x_test[medoid_out['x_star'].astype(int)])
+        
         model_iter_calls = [0,0,0,0]
         
         # When the number of iterations between RVE updates have been completed
         # update the RVE model with all of the medoid positions, 
         # for every other iteration, update the individual low order models
         
-        model_cost = time() - start_iteration
+        model_cost = time() - start_iteration - kg_wait - audit_time - calibration_time
         
-        rve_Budget_Left -= model_cost
-        total_Budget_Left -= model_cost
+        ledger.charge_compute(model_cost)
         
         if (ii % rve_iter == 0) and (ii != 0):
-            max_new = 0
+            # the truth model jobs are submitted as a batch, their results are
+            # folded into the fused model below when they are complete
             for iii in range(len(medoids)):
-                x_new = np.array(medoid_out[iii,[8,9]])
-                x_new = np.expand_dims(x_new, 0)
-                y_new = rve_gp.predict(x_new)
-                all_RVE_x.append(x_new)
-                all_RVE_y.append(y_new)
-                if y_new > max_new:
-                    max_new = y_new
-                model_control.update_truth(x_new, y_new)
+                x_new = np.array([[medoid_out[iii]['temperature'], medoid_out[iii]['carbon']]])
+                with timer.phase('truth_evaluation'):
+                    truth.submit(ii, x_new)
                 model_iter_calls[3] += 1
-                with open("results/{}/{}_iteration_data.csv".format(date, results_dir_name), 'a') as f:
-                    f.write("{},{},{},{},{},\n".format(ii,3,medoid_out[iii,8],medoid_out[iii,9],y_new))
-                
-                total_Budget_Left -= 7200
-                rve_Budget_Left = rve_budget
+                ledger.charge_rve()
             sample_count += 5
-            if max_new > max_RVE[ii]:
-                max_RVE.append(max_new)
-            else: 
-                max_RVE.append(max_RVE[ii])
+            max_RVE.append(max_RVE[ii])
         else:
             max_RVE.append(max_RVE[ii])
             # Obtain the results from the medoids for the lower order models
-            cost = [0.246179, 0.890249,  1.827838]
             for iii in range(len(medoids)):
-                x_new = np.array(medoid_out[iii,[8,9]])
-                x_new = np.expand_dims(x_new, 0)
-                y_new = predict_low_order_model(tc_gp, x_new, 
-                                                model_names[medoid_out[iii,5]])[0,0]
-                model_control.update_GP(x_new, y_new, medoid_out[iii,5])
-                model_iter_calls[medoid_out[iii,5]] += 1
-                with open("results/{}/{}_iteration_data.csv".format(date, results_dir_name), 'a') as f:
-                    f.write("{},{},{},{},{},\n".format(ii,medoid_out[iii,5],medoid_out[iii,8],medoid_out[iii,9],y_new))
-                total_Budget_Left -= cost[medoid_out[iii,5]]
-                rve_Budget_Left -= cost[medoid_out[iii,5]]
+                x_new = np.array([[medoid_out[iii]['temperature'], medoid_out[iii]['carbon']]])
+                model = int(medoid_out[iii]['model'])
+                with timer.phase('rom_evaluation'):
+                    y_new = predict_low_order_model(tc_gp, x_new, 
+                                                    model_names[model])[0,0]
+                with timer.phase('model_update'):
+                    model_control.update_GP(x_new, y_new, model)
+                model_iter_calls[model] += 1
+                with timer.phase('logging'):
+                    results.append('iteration_data', ii, model, medoid_out[iii]['temperature'], 
+                                   medoid_out[iii]['carbon'], y_new)
+                ledger.charge_rom(model)
+        
+        # the hyper-parameters of the low order GPs and their error models are
+        # fitted again every hp-refit iterations, the time is charged to the
+        # budget as acquisition compute
+        if (options['hp-refit'] > 0) and ((ii+1) % options['hp-refit'] == 0):
+            with timer.phase('hp_refit'):
+                start_refit = time()
+                model_control.optimize_hyper_params(options['hp-refit-starts'], 
+                                                    options['hp-refit-workers'], 
+                                                    streams.generator('hp_refit', ii))
+                ledger.charge_compute(time() - start_refit)
+        
+        # fold in the truth model results that are complete. The end of the
+        # campaign is decided here, after every charge of the iteration, and
+        # then all of the jobs are waited for
+        last_iteration = (ledger.total_left < 0) or (ii == iter_count-1)
+        truth_results = truth.collect(wait=last_iteration)
+        for job_iteration, x_new, y_new in truth_results:
+            all_RVE_x.append(x_new)
+            all_RVE_y.append(y_new)
+            if y_new > max_RVE[-1]:
+                max_RVE[-1] = y_new
+            with timer.phase('logging'):
+                results.append('iteration_data', job_iteration, 3, x_new[0,0], 
+                               x_new[0,1], y_new)
+        if len(truth_results) > 0:
+            # the error models are updated once for the whole batch
+            with timer.phase('model_update'):
+                model_control.update_truth(np.vstack([job[1] for job in truth_results]), 
+                                           np.concatenate([job[2] for job in truth_results]))
         
         for jjj in range(4):
             model_record[jjj] += model_iter_calls[jjj]
             
-        with open("results/{}/{}_model_record.csv".format(date, results_dir_name), 'a') as f:
-            f.write("{},{},{},{},\n".format(model_record[0],model_record[1],model_record[2],model_record[3]))
-            
-        with open("results/{}/{}_iteration_cost.csv".format(date, results_dir_name), 'a') as f:
-            f.write("{},{},{},\n".format(model_cost, total_Budget_Left, rve_Budget_Left))
+        with timer.phase('logging'):
+            results.append('model_record', *model_record)
+            results.append('iteration_cost', model_cost, ledger.total_left, ledger.rve_left)
+            costs = ledger.end_iteration()
+            results.append('cost_ledger', ii, costs['rom_evaluation'], 
+                           costs['rve_evaluation'], costs['acquisition_compute'], 
+                           costs['charged'], ledger.total_left, ledger.rve_left)
  
         iteration_time.append(time()-start)
+        timer.end_iteration(ii, model_cost=model_cost, 
+                            true_sample_count=true_sample_count, 
+                            kg=kg_trace(kg_report))
+        
+        if (options['checkpoint-every'] > 0) and ((ii+1) % options['checkpoint-every'] == 0):
+            with timer.carried_phase('checkpoint'):
+                # the buffered records are written first so the checkpoint holds
+                # the size of the complete tables
+                results.flush()
+                save_checkpoint({'param': param,
+                                 'date': date,
+                                 'results_dir_name': results_dir_name,
+                                 'init_index': init_index,
+                                 'streams': streams,
+                                 'iteration': ii+1,
+                                 'model_control': model_control,
+                                 'fused_model_HP': fused_model_HP,
+                                 'sample_count': sample_count,
+                                 'ledger': ledger,
+                                 'max_RVE': max_RVE,
+                                 'model_record': model_record,
+                                 'iteration_time': iteration_time,
+                                 'all_RVE_x': all_RVE_x,
+                                 'all_RVE_y': all_RVE_y,
+                                 'truth_pending': truth.pending(),
+                                 'candidates': candidates,
+                                 'scheduler_latency': scheduler.latency,
+                                 'governor': (governor.num_workers, 
+                                              governor.blas_threads, 
+                                              governor.calibration)})
         
-        if total_Budget_Left < 0:
+        if last_iteration:
             break
         
+    truth.close()
+    results.flush()
+    if audits[0] > 0:
+        print("Screening changed the medoid choice in {} of {} audited iterations".format(
+              audits[1], audits[0]))
     print("** Code Finished **")
     with open("results/{}/{}_code_finished.txt".format(date, results_dir_name), 'w') as f:
         f.write("** Code Finished **\n")
-                
-        
-        
-        
-        
-        
\ No newline at end of file
+
+
+if __name__ == "__main__":
+    param, options = parse_run_options(sys.argv)
+    # When testing, particularly in Spyder, the following ensures the correct
+    # operation of the code
+    if len(param) == 1:
+        param = ['', 'M52', '2', '10', '50', '1', '1', '2000000', '1000']
+    run_campaign(param, options)
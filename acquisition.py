@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""
+Continuous optimization of the acquisition function of the fused model.
+
+Rather than a fresh Latin hypercube of candidates, the candidates can be
+the local maxima of the expected improvement of the fused GP (built with the
+median of the hyper-parameter sets), found by multi-start L-BFGS-B:
+    1. the expected improvement is evaluated on a Sobol sample of the
+       feasible region (candidates.candidate_pool) and the best points are
+       the starting points,
+    2. from each of them L-BFGS-B climbs the expected improvement, with the
+       gradient calculated analytically from the GP (gp_gradient),
+    3. a local maximum outside the feasible region is moved back along the
+       line to its starting point until it is feasible,
+    4. the distinct local maxima, best first, are the batch; when there are
+       fewer of them than asked for the batch is topped up with the best of
+       the sampled points.
+The GP evaluations (points at which the posterior is calculated) are
+counted in the report, so the search can be compared with the discrete one.
+"""
+
+import numpy as np
+import scipy.optimize as op
+from copy import deepcopy
+from scipy.linalg import cho_factor, cho_solve
+from scipy.stats import norm
+from candidates import candidate_pool, unit_to_design
+from functions import kernel_profile
+
+
+class gp_gradient:
+    """
+    The posterior mean and variance of a gp_model, and their gradients with
+    respect to the input, calculated directly from the kernel (the same
+    kernels as george: r^2 is the squared distance scaled by the squared
+    length scales).
+    """
+    def __init__(self, gp):
+        self.x_train = np.array(gp.x_train, dtype=np.float64)
+        self.l2 = np.array(gp.l_param, dtype=np.float64)*np.ones(self.x_train.shape[1])
+        self.sf = gp.sigma_f
+        self.kern = gp.kern
+        self.mean = gp.mean
+        noise = np.ones(self.x_train.shape[0])*np.array(gp.sigma_n)**2
+        K = self.kernel(self.x_train, self.x_train)[0] + np.diag(noise)
+        self.factor = cho_factor(K, lower=True)
+        self.alpha = cho_solve(self.factor, np.array(gp.y_train) - self.mean)
+
+    def kernel(self, x, y):
+        # the kernel and its derivative with respect to r^2
+        diff = x[:,None,:] - y[None,:,:]
+        k, dk = kernel_profile(self.kern, np.sum(diff**2/self.l2, axis=2))
+        return self.sf*k, self.sf*dk, diff
+
+    def predict(self, x):
+        k, dk, diff = self.kernel(x, self.x_train)
+        mean = k @ self.alpha + self.mean
+        v = cho_solve(self.factor, k.T)
+        var = self.sf - np.sum(k*v.T, axis=1)
+        return mean, np.maximum(var, 1e-12)
+
+    def predict_grad(self, x):
+        """
+        The mean and variance at the points x and their gradients (one row
+        per point).
+        """
+        k, dk, diff = self.kernel(x, self.x_train)
+        # d k(x, x_i) / dx = dk/dr^2 * 2 (x - x_i) / l^2
+        dkdx = dk[:,:,None]*2*diff/self.l2
+        mean = k @ self.alpha + self.mean
+        dmean = np.einsum('ijd,j->id', dkdx, self.alpha)
+        v = cho_solve(self.factor, k.T)
+        var = self.sf - np.sum(k*v.T, axis=1)
+        dvar = -2*np.einsum('ijd,ji->id', dkdx, v)
+        return mean, np.maximum(var, 1e-12), dmean, dvar
+
+
+def expected_improvement(gp, x, best, xi=0.0, gradient=False):
+    """
+    The expected improvement over best at the points x, with its gradient
+    when gradient is True.
+    """
+    if gradient:
+        mean, var, dmean, dvar = gp.predict_grad(x)
+    else:
+        mean, var = gp.predict(x)
+    std = np.sqrt(var)
+    z = (mean - best - xi)/std
+    ei = (mean - best - xi)*norm.cdf(z) + std*norm.pdf(z)
+    if not gradient:
+        return ei
+    dstd = dvar/(2*std[:,None])
+    return ei, norm.cdf(z)[:,None]*dmean + norm.pdf(z)[:,None]*dstd
+
+
+def optimize_acquisition(model_control, x_fused, fused_model_HP, kernel, fmap,
+                         batch, rng, starts=10, samples=None, xi=0.0):
+    """
+    A batch of batch feasible points (in unit coordinates) with high
+    expected improvement of the fused model, from starts local searches
+    begun at the best of samples (by default 20 x starts, or batch if that
+    is more, so the batch can be topped up) Sobol points of the feasible
+    region. Returns the points and a report of the search.
+    """
+    if samples is None:
+        samples = max(20*starts, batch)
+    hp = np.median(fused_model_HP, axis=0)
+    model = deepcopy(model_control)
+    model.create_fused_GP(x_fused, hp[0:2], hp[2], 0.1, kernel)
+    gp = gp_gradient(model.fused_GP)
+    best = np.max(model.fused_GP.y_train)
+    evaluations = [0]
+
+    sample = candidate_pool(fmap, 'sobol', rng).draw(samples)
+    sample_ei = expected_improvement(gp, sample, best, xi)
+    evaluations[0] += samples
+    order = np.argsort(-sample_ei, kind='stable')
+
+    def negative_ei(x):
+        evaluations[0] += 1
+        ei, dei = expected_improvement(gp, x[None,:], best, xi, gradient=True)
+        return -ei[0], -dei[0]
+
+    found = []
+    for start in sample[order[:starts]]:
+        result = op.minimize(negative_ei, start, jac=True, method='L-BFGS-B',
+                             bounds=[(0, 1), (0, 1)], options={'maxiter': 50})
+        x = result.x
+        if fmap.predict(unit_to_design(x[None,:]))[0] != 0:
+            # back along the line to the (feasible) starting point
+            steps = np.linspace(1, 0, 11)[1:,None]
+            line = start + steps*(x - start)
+            feasible = np.nonzero(fmap.predict(unit_to_design(line))==0)[0]
+            x = line[feasible[0]] if len(feasible) > 0 else start
+        found.append(x)
+    found = np.array(found)
+    found_ei = expected_improvement(gp, found, best, xi)
+    evaluations[0] += found.shape[0]
+
+    # the distinct local maxima, then the best sampled points
+    points = []
+    for index in np.argsort(-found_ei, kind='stable'):
+        if all([np.max(np.abs(found[index]-p)) > 1e-3 for p in points]):
+            points.append(found[index])
+    local_maxima = len(points)
+    for index in order:
+        if len(points) >= batch:
+            break
+        if all([np.max(np.abs(sample[index]-p)) > 1e-3 for p in points]):
+            points.append(sample[index])
+    points = np.array(points[:batch])
+    report = {'evaluations': evaluations[0],
+              'local_maxima': local_maxima,
+              'best_ei': float(np.max(found_ei)),
+              'best_sample_ei': float(sample_ei[order[0]])}
+    return points, report
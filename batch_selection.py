@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+Greedy selection of the batch of points with fantasized updates, as an
+alternative to the medoid clustering of the knowledge gradient output.
+
+The medoids are found in (nu, candidate index, model) space, in which the
+distances have no meaning in the design space. The greedy batch is chosen
+one point at a time instead:
+    1. the first point is the (x_star, model) choice with the highest
+       knowledge gradient of the tasks that were run for all the candidates,
+    2. the chosen model is updated with the point at its predicted value (a
+       fantasy, the value is not known until the batch is evaluated),
+    3. the shortlist, the best tasks of the first step (one hyper-parameter
+       set for each candidate and model) with an equal share for each model,
+       is run again with the fantasized models and the best choice is the
+       next point, and so on until the batch is complete.
+The choices whose point is in the training data of their model already, and
+the choices already in the batch, are left out. Without the share for each
+model the shortlist is filled by the model with the lowest cost, whose
+knowledge gradient per unit cost is the highest, and so is the batch.
+The fantasy leaves the mean of the updated model unchanged and reduces its
+variance around the chosen point, so the knowledge gradient of the points
+near it falls and the batch spreads out. Each point after the first costs
+at most shortlist tasks, which are run in this process.
+"""
+
+import numpy as np
+from copy import copy, deepcopy
+from kg_tasks import KG_OUTPUT_DTYPE, updated_model, calculate_task
+
+
+def _trained(context, kg_output):
+    # the rows whose point is in the training data of their model already
+    # (the models are trained at (temperature, carbon))
+    trained = np.zeros(kg_output.shape[0], dtype=bool)
+    for jj in np.unique(kg_output['model']):
+        rows = np.nonzero(kg_output['model'] == jj)[0]
+        x = np.column_stack((kg_output['temperature'][rows], kg_output['carbon'][rows]))
+        x_train = np.array(context.model_control.x_train[jj], dtype=np.float64)
+        distance = np.max(np.abs(x[:,None,:] - x_train[None,:,:]), axis=2)
+        trained[rows] = np.any(distance < 1e-9, axis=1)
+    return trained
+
+
+def _shortlist(kg_output, count):
+    # the best task of each (candidate, model) pair, in decreasing order of
+    # the knowledge gradient (ties keep the task order), with an equal share
+    # of count for each model
+    keys = kg_output['sample']*3 + kg_output['model']
+    order = np.lexsort((-kg_output['nu'], keys))
+    unique_keys, first = np.unique(keys[order], return_index=True)
+    best = order[first]
+    best = best[np.argsort(-kg_output['nu'][best], kind='stable')]
+    models = np.unique(kg_output['model'])
+    share = int(np.ceil(count/len(models)))
+    best = np.concatenate([best[kg_output['model'][best] == jj][:share] for jj in models])
+    best = best[np.argsort(-kg_output['nu'][best], kind='stable')]
+    return kg_output[best]
+
+
+def _choice(row):
+    return (int(row['x_star']), int(row['model']))
+
+
+def greedy_batch(context, kg_output, num_points, shortlist=10):
+    """
+    A batch of up to num_points KG_OUTPUT_DTYPE rows with distinct
+    (x_star, model) choices, from the knowledge gradient output kg_output of
+    the tasks of context.
+    """
+    trained = _trained(context, kg_output)
+    if np.all(trained):
+        return np.zeros(0, dtype=KG_OUTPUT_DTYPE)
+    kg_output = kg_output[np.logical_not(trained)]
+    candidates = _shortlist(kg_output, shortlist)
+    first = kg_output[np.argmax(kg_output['nu'])]
+    batch = [first.copy()]
+    chosen = set([_choice(first)])
+    fantasy = copy(context)
+    fantasy.model_control = deepcopy(context.model_control)
+    while len(batch) < num_points:
+        last = batch[-1]
+        jj = int(last['model'])
+        x_star = int(last['x_star'])
+        fantasy.model_control.update_GP(np.expand_dims(context.x_test[x_star], axis=0),
+                                        np.expand_dims(np.array([context.new_mean[jj][x_star]]),
+                                                       axis=0), jj)
+        candidates = candidates[[_choice(row) not in chosen for row in candidates]]
+        outputs = np.zeros(candidates.shape[0], dtype=KG_OUTPUT_DTYPE)
+        for i, row in enumerate(candidates):
+            jj, kk, mm = int(row['model']), int(row['sample']), int(row['hp'])
+            calculate_task(fantasy, updated_model(fantasy, jj, kk), jj, kk, mm, outputs[i])
+        trained = _trained(context, outputs)
+        new = [i for i in np.argsort(-outputs['nu'], kind='stable')
+               if (_choice(outputs[i]) not in chosen) and (not trained[i])]
+        if len(new) == 0:
+            # every choice of the shortlist is in the batch already, the next
+            # best choices of the first step are used
+            rest = [i for i in np.argsort(-kg_output['nu'], kind='stable')
+                    if _choice(kg_output[i]) not in chosen]
+            if len(rest) == 0:
+                break
+            row = kg_output[rest[0]]
+        else:
+            row = outputs[new[0]]
+        batch.append(row.copy())
+        chosen.add(_choice(row))
+    return np.array(batch, dtype=KG_OUTPUT_DTYPE)
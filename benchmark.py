@@ -0,0 +1,432 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the batch optimization code.
+
+A full iteration of the optimization loop (sampling of the feasible
+candidates, low order prediction, knowledge gradient, clustering, evaluation
+of the selected points and the update of the low order GPs) is timed for every combination
+of the test sample counts, hyper-parameter set counts, medoid counts and
+worker counts given, followed by micro-benchmarks of reification,
+knowledge_gradient, gp_model.update, the GP backends (george against NumPy),
+the acquisition optimizer (against the best expected improvement of a large
+sample) and the three reduced order models, and the accuracy and speed of
+the inducing point approximations of the Thermo-Calc and RVE GPs.
+
+Every case starts from the same campaign state and random seed, so two runs
+do the same work and their results (written as JSON, by default to
+results/benchmarks/) can be compared between commits. Only the data in the
+data/ folder is needed, nothing is downloaded.
+
+    python benchmark.py --samples=10,25 --hps=10,25 --medoids=2 --workers=1,4
+    python benchmark.py --quick
+"""
+
+import os
+import sys
+import json
+import random
+import argparse
+import platform
+import subprocess
+import datetime as dt
+from copy import deepcopy
+from time import perf_counter
+import numpy as np
+import pandas as pd
+from pyDOE import lhs
+from functions import reification, knowledge_gradient, gp_model, GP, sparse_accuracy
+from reduced_order_models import isostrain_IS, isostress_IS, isowork_IS
+from CC_CC_optimization import (TC_GP, RVE_GP, model_reification, 
+                                predict_low_order_model, k_medoids)
+from feasibility import feasibility_lookup
+from candidates import candidate_pool, unit_to_design
+from acquisition import gp_gradient, expected_improvement, optimize_acquisition
+from kg_tasks import kg_context, chunk_scheduler, run_kg_tasks, best_kg_points
+from instrumentation import phase_timer, kg_trace
+from thread_governor import available_cores
+
+
+def _int_list(value):
+    return [int(v) for v in value.split(',') if v.strip() != '']
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))
+                                       ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _time_calls(function, repeats, setup=None):
+    """
+    Time repeats calls of function. If setup is given it is called (untimed)
+    before every call and its output is passed to function.
+    """
+    times = []
+    for i in range(repeats):
+        argument = setup() if setup is not None else None
+        start = perf_counter()
+        if setup is not None:
+            function(argument)
+        else:
+            function()
+        times.append(perf_counter()-start)
+    return {'repeats': repeats,
+            'min': float(np.min(times)),
+            'median': float(np.median(times)),
+            'mean': float(np.mean(times))}
+
+
+class benchmark_campaign:
+    """
+    The state of a campaign at the start of the optimization loop, set up in
+    the same way as in the drivers: the Thermo-Calc GP, the feasibility map, the
+    reification models with the first initial data points and the fused
+    model points and hyper-parameter sets.
+    """
+    def __init__(self, kernel='M52', hp_count=10, seed=0, classifier_grid=200,
+                 init_index=0):
+        np.random.seed(seed)
+        random.seed(seed)
+        self.kernel = kernel
+        self.tc_gp = TC_GP()
+        self.clf = feasibility_lookup(TC_GP, classifier_grid)
+
+        points1 = 27
+        temp = np.linspace(0,1,points1,endpoint=True)
+        x_fused = np.zeros((points1*points1,2))
+        for i in range(points1):
+            for j in range(points1):
+                x_fused[i*points1+j,0] = temp[i]
+                x_fused[i*points1+j,1] = temp[j]
+        temp = deepcopy(x_fused)
+        temp[:,0] = temp[:,0]*200 + 650
+        self.x_fused = x_fused[np.nonzero(self.clf.predict(temp)==0)[0],:]
+
+        random_init = np.array(pd.read_csv("data/init_data.csv",header=None))
+        initial_data = np.array([[random_init[init_index, 0],random_init[init_index, 1]],
+                                 [random_init[init_index, 2],random_init[init_index, 3]]])
+        rve_out = RVE_GP().predict(initial_data)
+        self.model_names = ['isostrain','isostress','isowork']
+        x_init = []
+        y_init = []
+        for name in self.model_names:
+            x_init.append(initial_data)
+            y_init.append(predict_low_order_model(self.tc_gp, initial_data, name).flatten())
+        self.model_control = model_reification(x_init, y_init,
+                                               [[1.01584704, 0.21626703],
+                                                [3.65895877e+00, 3.43182042e+00],
+                                                [1.13256232, 0.26973212]],
+                                               [2.11334467,1.76954682e+04,3.410617],
+                                               [0.05, 0.05, 0.05],
+                                               [9.95204, 30.13247, 10.71565],
+                                               [6.67520, 3.87400, 6.46956],
+                                               [[0.1, 0.1], [0.1, 0.1], [0.1, 0.1]],
+                                               [1,1,1], [0.05, 0.05, 0.05],
+                                               initial_data, rve_out, 3, 2, kernel)
+        self.max_hp_count = 0
+        self.fused_model_HP = None
+        self.set_hp_count(hp_count)
+
+    def set_hp_count(self, hp_count):
+        # the hyper-parameter sets are drawn once for the largest count, so a
+        # smaller count uses the first sets of the same draw
+        if hp_count > self.max_hp_count:
+            state = np.random.get_state()
+            np.random.seed(12345)
+            fused_model_HP = lhs(3,hp_count)
+            np.random.set_state(state)
+            fused_model_HP[:,0] = fused_model_HP[:,0]*20 + 0.01
+            fused_model_HP[:,1] = fused_model_HP[:,1]*20 + 0.01
+            fused_model_HP[:,2] = fused_model_HP[:,2]*99.9 + 0.1
+            self.fused_model_HP = fused_model_HP
+            self.max_hp_count = hp_count
+        return self.fused_model_HP[:hp_count]
+
+
+def benchmark_iteration(campaign, sample_count, hp_count, num_medoids, num_workers,
+                        backend='processes', seed=0, medoid_method='voronoi'):
+    """
+    Time one iteration of the optimization loop from the campaign state.
+    Returns the wall and CPU time of each stage, the knowledge gradient
+    report and the points that were selected.
+    """
+    np.random.seed(seed)
+    random.seed(seed)
+    model_control = deepcopy(campaign.model_control)
+    fused_model_HP = campaign.set_hp_count(hp_count)
+    timer = phase_timer(None)
+
+    with timer.phase('sampling'):
+        # the candidates are drawn inside the feasible region, as in the drivers
+        x_test = candidate_pool(campaign.clf, 'lhs',
+                                np.random.default_rng(seed)).draw(sample_count)
+        x_test1 = unit_to_design(x_test)
+    true_sample_count = x_test1.shape[0]
+    with timer.phase('low_order_prediction'):
+        new_mean = []
+        for jj in range(3):
+            new, var = model_control.predict_low_order(x_test, jj)
+            new_mean.append(new)
+    with timer.phase('knowledge_gradient'):
+        context = kg_context(model_control, campaign.x_fused, fused_model_HP,
+                             campaign.kernel, x_test, new_mean, true_sample_count)
+        kg_output, kg_report = run_kg_tasks(context, num_workers,
+                                            chunk_scheduler(num_workers), backend)
+    with timer.phase('clustering'):
+        med_input = best_kg_points(kg_output)
+        if med_input.shape[0] > num_medoids:
+            medoids, clusters = k_medoids(med_input[:,0:3], num_medoids, medoid_method)
+        else:
+            medoids, clusters = k_medoids(med_input[:,0:3], int(med_input.shape[0]/3),
+                                          medoid_method)
+        medoid_out = kg_output[[int(med_input[m,3]) for m in medoids]]
+    selected = []
+    for point in medoid_out:
+        x_new = np.array([[point['temperature'], point['carbon']]])
+        model = int(point['model'])
+        with timer.phase('rom_evaluation'):
+            y_new = predict_low_order_model(campaign.tc_gp, x_new,
+                                            campaign.model_names[model])[0,0]
+        with timer.phase('model_update'):
+            model_control.update_GP(x_new, y_new, model)
+        selected.append([model, float(point['temperature']), float(point['carbon'])])
+
+    record = timer.end_iteration(0)
+    return {'sample_count': sample_count,
+            'true_sample_count': true_sample_count,
+            'hp_count': hp_count,
+            'num_medoids': num_medoids,
+            'workers': num_workers,
+            'backend': backend,
+            'wall': record['wall'],
+            'cpu': record['cpu'],
+            'total_wall': record['total_wall'],
+            'total_cpu': record['total_cpu'],
+            'kg': kg_trace(kg_report),
+            'selected': selected}
+
+
+def micro_benchmarks(campaign, repeats=20, sample_count=50, seed=0, rom_points=10):
+    """
+    Time the building blocks of an iteration on the campaign state. The
+    reduced order models are also timed on rom_points points at once (they
+    take around a second per point, so these are only run once).
+    """
+    np.random.seed(seed)
+    model_control = campaign.model_control
+    x_test = lhs(2, sample_count)
+    x_test1 = deepcopy(x_test)
+    x_test1[:,0] = x_test1[:,0]*200 + 650
+    results = {}
+
+    # reification of the three low order models on the fused model points
+    model_mean = []
+    model_var = []
+    for i in range(3):
+        m_mean, m_var = model_control.gp_models[i].predict_var(campaign.x_fused)
+        model_mean.append(m_mean*model_control.model_std[i] + model_control.model_mean[i])
+        err_mean, err_var = model_control.gp_err_models[i].predict_var(campaign.x_fused)
+        err_mean = err_mean*model_control.err_std[i] + model_control.err_mean[i]
+        model_var.append(err_mean**2 + m_var*model_control.model_std[i]**2)
+    results['reification'] = _time_calls(lambda: reification(model_mean, model_var),
+                                         repeats)
+    results['reification']['points'] = int(campaign.x_fused.shape[0])
+
+    # knowledge gradient of a fused GP over the test samples
+    model_temp = deepcopy(model_control)
+    hp = campaign.set_hp_count(1)[0]
+    model_temp.create_fused_GP(campaign.x_fused, hp[0:2], hp[2], 0.1, campaign.kernel)
+    fused_mean, fused_var = model_temp.predict_fused_GP(x_test)
+    results['knowledge_gradient'] = _time_calls(
+        lambda: knowledge_gradient(sample_count, 0.1, fused_mean, fused_var), repeats)
+    results['knowledge_gradient']['samples'] = sample_count
+
+    # the acquisition optimizer against the best expected improvement of a
+    # sample of the feasible region 20 times as large as its sample
+    fused_gp = gp_gradient(model_temp.fused_GP)
+    best = np.max(model_temp.fused_GP.y_train)
+    discrete = candidate_pool(campaign.clf, 'lhs', np.random.default_rng(seed)).draw(2000)
+    start = perf_counter()
+    discrete_ei = np.max(expected_improvement(fused_gp, discrete, best))
+    discrete_time = perf_counter() - start
+    start = perf_counter()
+    points, report = optimize_acquisition(model_control, campaign.x_fused, hp[None,:], 
+                                          campaign.kernel, campaign.clf, sample_count, 
+                                          np.random.default_rng(seed))
+    results['acquisition'] = {'discrete_best_ei': float(discrete_ei),
+                              'discrete_evaluations': discrete.shape[0],
+                              'discrete_time': discrete_time,
+                              'optimizer_best_ei': report['best_ei'],
+                              'optimizer_evaluations': report['evaluations'],
+                              'optimizer_local_maxima': report['local_maxima'],
+                              'optimizer_time': perf_counter() - start}
+
+    # adding one point to a low order GP
+    gp = model_control.gp_models[0]
+    results['gp_model.update'] = _time_calls(
+        lambda g: g.update(x_test[0:1], np.array([0.5]), 0.05, False), repeats,
+        setup=lambda: deepcopy(gp))
+    results['gp_model.update']['training_points'] = int(gp.x_train.shape[0]) + 1
+
+    # building the fused GP and predicting at the test samples with each GP
+    # backend, and the largest difference of the predictions from george's
+    fused = model_temp.fused_GP
+    backends = ['george', 'numpy'] if GP is not None else ['numpy']
+    predictions = {}
+    for backend in backends:
+        build = lambda: gp_model(fused.x_train, fused.y_train, np.sqrt(fused.l_param), 
+                                 fused.sigma_f, fused.sigma_n, fused.n_dim, fused.kern, 
+                                 backend=backend)
+        name = 'gp_backend_{}'.format(backend)
+        results[name + '.build'] = _time_calls(build, repeats)
+        model = build()
+        results[name + '.predict_var'] = _time_calls(lambda: model.predict_var(x_test), repeats)
+        results[name + '.log_likelihood'] = _time_calls(model.log_likelihood, repeats)
+        predictions[backend] = model.predict_var(x_test)
+    if 'george' in predictions:
+        results['gp_backend_difference'] = {
+            'mean': float(np.max(np.abs(predictions['george'][0]-predictions['numpy'][0]))),
+            'var': float(np.max(np.abs(predictions['george'][1]-predictions['numpy'][1])))}
+
+    # the reduced order models for a single point (as called in the loop) and
+    # for a batch of points
+    tc_out = campaign.tc_gp.predict(x_test1)
+    for name, rom in [('isostrain_IS', isostrain_IS), ('isostress_IS', isostress_IS),
+                      ('isowork_IS', isowork_IS)]:
+        results[name] = _time_calls(lambda: rom(tc_out[0:1], 0.009), repeats)
+        results[name]['points'] = 1
+        if rom_points > 1:
+            results[name + '_batch'] = _time_calls(lambda: rom(tc_out[0:rom_points], 0.009), 1)
+            results[name + '_batch']['points'] = min(rom_points, sample_count)
+    return results
+
+
+def sparse_benchmarks(campaign, inducing, seed=0, test_points=2000):
+    """
+    The accuracy report of the inducing point approximations (FITC and VFE,
+    with each number of inducing points) of the first Thermo-Calc GP and
+    the RVE GP, at test_points random points of the design space.
+    """
+    rng = np.random.default_rng(seed)
+    x = np.ones((test_points, 4))
+    # the inputs of the GPs, as in TC_GP.predict and RVE_GP.predict
+    x[:,0] = rng.random(test_points)
+    x[:,1] = rng.random(test_points)
+    x[:,2] = 0.283/2
+    x[:,3] = 0.328/3
+    reports = []
+    for name, model in [('tc_gp', campaign.tc_gp.tc_gp[0]), ('rve_gp', RVE_GP().gp)]:
+        for count in inducing:
+            for method in ['fitc', 'vfe']:
+                report = sparse_accuracy(model, x, count, method)
+                report['model'] = name
+                reports.append(report)
+                print("{} {} inducing={}: relative mean RMSE {:.2e}, build {:.3f} s "
+                      "(exact {:.3f} s)".format(name, method, count, 
+                                                report['mean_relative_rmse'], 
+                                                report['sparse_build_time'], 
+                                                report['exact_build_time']))
+    return reports
+
+
+def run_benchmarks(samples, hps, medoids, workers, backend='processes', seed=0,
+                   repeats=20, kernel='M52', classifier_grid=200, micro=True,
+                   rom_points=10, sparse_inducing=(100, 300)):
+    start = perf_counter()
+    campaign = benchmark_campaign(kernel, max(hps), seed, classifier_grid)
+    setup_time = perf_counter()-start
+    iterations = []
+    for sample_count in samples:
+        for hp_count in hps:
+            for num_medoids in medoids:
+                for num_workers in workers:
+                    iterations.append(benchmark_iteration(campaign, sample_count,
+                                                          hp_count, num_medoids,
+                                                          num_workers, backend, seed))
+                    print("samples={} hps={} medoids={} workers={}: {:.3f} s".format(
+                        sample_count, hp_count, num_medoids, num_workers,
+                        iterations[-1]['total_wall']))
+    return {'commit': _git_commit(),
+            'date': dt.datetime.now().isoformat(),
+            'machine': {'platform': platform.platform(),
+                        'processor': platform.processor(),
+                        'python': platform.python_version(),
+                        'numpy': np.__version__,
+                        'cores': available_cores()},
+            'settings': {'samples': samples, 'hps': hps, 'medoids': medoids,
+                         'workers': workers, 'backend': backend, 'seed': seed,
+                         'repeats': repeats, 'kernel': kernel,
+                         'classifier_grid': classifier_grid,
+                         'rom_points': rom_points,
+                         'sparse_inducing': list(sparse_inducing)},
+            'setup_time': setup_time,
+            'iterations': iterations,
+            'micro': micro_benchmarks(campaign, repeats, seed=seed, 
+                                      rom_points=rom_points) if micro else {},
+            'sparse': sparse_benchmarks(campaign, sparse_inducing, seed)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the batch optimization code')
+    parser.add_argument('--samples', type=_int_list, default=[10, 25],
+                        help='test sample counts (comma separated)')
+    parser.add_argument('--hps', type=_int_list, default=[10, 25],
+                        help='hyper-parameter set counts (comma separated)')
+    parser.add_argument('--medoids', type=_int_list, default=[2, 5],
+                        help='medoid counts (comma separated)')
+    parser.add_argument('--workers', type=_int_list, default=None,
+                        help='knowledge gradient worker counts (comma separated), '
+                             'by default 1 and the number of cores')
+    parser.add_argument('--backend', default='processes',
+                        help="knowledge gradient backend: 'processes', 'threads' or 'serial'")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeats', type=int, default=20,
+                        help='number of calls in each micro-benchmark')
+    parser.add_argument('--rom-points', type=int, default=10,
+                        help='number of points in the batch reduced order model '
+                             'benchmarks (0 to skip them)')
+    parser.add_argument('--sparse-inducing', type=_int_list, default=[100, 300],
+                        help='numbers of inducing points of the sparse GP accuracy '
+                             'report (comma separated, 0 to skip it)')
+    parser.add_argument('--kernel', default='M52')
+    parser.add_argument('--classifier-grid', type=int, default=200,
+                        help='size of the grid of the feasibility map (200 in the '
+                             'drivers, other sizes are built and stored in data/)')
+    parser.add_argument('--no-micro', action='store_true',
+                        help='skip the micro-benchmarks')
+    parser.add_argument('--quick', action='store_true',
+                        help='a single small iteration and short micro-benchmarks, '
+                             'without the sparse GP report')
+    parser.add_argument('--output', default=None,
+                        help='JSON file for the results, by default '
+                             'results/benchmarks/benchmark_<commit>_<date>.json')
+    args = parser.parse_args(sys.argv[1:])
+
+    workers = args.workers
+    if workers is None:
+        workers = sorted(set([1, min(available_cores(), 20)]))
+    if args.quick:
+        args.samples, args.hps, args.medoids, workers = [10], [10], [2], [workers[-1]]
+        args.repeats = 5
+        args.rom_points = 0
+        args.sparse_inducing = []
+
+    results = run_benchmarks(args.samples, args.hps, args.medoids, workers,
+                             args.backend, args.seed, args.repeats, args.kernel,
+                             args.classifier_grid, not args.no_micro, args.rom_points,
+                             [count for count in args.sparse_inducing if count > 0])
+
+    output = args.output
+    if output is None:
+        os.makedirs('results/benchmarks', exist_ok=True)
+        today = dt.datetime.today()
+        output = "results/benchmarks/benchmark_{}_{}_{}_{}_{}_{}.json".format(
+            (results['commit'] or 'nocommit')[:8], today.year, today.month,
+            today.day, today.hour, today.minute)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=1)
+    print("Benchmark results written to {}".format(output))
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+Cost ledger for the budget of the optimization drivers.
+
+The costs of a campaign are kept as separate line items:
+    rom_evaluation:      the modelled cost of the reduced order model calls
+    rve_evaluation:      the modelled cost of the RVE (truth model) calls
+    acquisition_compute: the measured wall time of the acquisition step
+                         (sampling, knowledge gradient and clustering)
+The budget policy decides which kinds of cost ('evaluation' and/or
+'compute') are taken from the budgets, so time lost to slow infrastructure
+only reduces the number of evaluations when the compute is charged.
+"""
+
+# modelled cost of a call to each of the reduced order models and to the RVE
+ROM_COST = [0.246179, 0.890249,  1.827838]
+RVE_COST = 7200
+
+CHARGE_KINDS = {'rom_evaluation': 'evaluation',
+                'rve_evaluation': 'evaluation',
+                'acquisition_compute': 'compute'}
+
+
+def parse_charges(charges):
+    """
+    Convert the --budget-charges option (a comma separated list) into a set.
+    """
+    charges = set([c.strip() for c in charges.split(',') if c.strip() != ''])
+    unknown = charges - set(CHARGE_KINDS.values())
+    if len(unknown) > 0:
+        raise ValueError('Unknown budget charges: {}'.format(', '.join(sorted(unknown))))
+    return charges
+
+
+class cost_ledger:
+    """
+    Keeps the total and RVE budgets left and the cost of every line item,
+    both over the campaign and in the current iteration. Only the kinds of
+    cost in charges are taken from the budgets; all of them are recorded.
+    A call to the RVE resets the RVE budget.
+    """
+    def __init__(self, total_budget, rve_budget, charges=('evaluation', 'compute')):
+        self.total_budget = total_budget
+        self.rve_budget = rve_budget
+        self.charges = set(charges)
+        self.total_left = total_budget
+        self.rve_left = rve_budget
+        self.totals = dict([(item, 0.0) for item in CHARGE_KINDS])
+        self.iteration = dict([(item, 0.0) for item in CHARGE_KINDS])
+        self.iteration_charged = 0.0
+
+    def _record(self, item, cost):
+        self.totals[item] += cost
+        self.iteration[item] += cost
+        if CHARGE_KINDS[item] in self.charges:
+            self.total_left -= cost
+            self.iteration_charged += cost
+            return True
+        return False
+
+    def charge_compute(self, seconds):
+        if self._record('acquisition_compute', seconds):
+            self.rve_left -= seconds
+
+    def charge_rom(self, model):
+        if self._record('rom_evaluation', ROM_COST[model]):
+            self.rve_left -= ROM_COST[model]
+
+    def charge_rve(self):
+        self._record('rve_evaluation', RVE_COST)
+        self.rve_left = self.rve_budget
+
+    def end_iteration(self):
+        """
+        Return the cost of each line item in the iteration and the total cost
+        charged to the budget, and start the next iteration.
+        """
+        iteration = dict(self.iteration)
+        iteration['charged'] = self.iteration_charged
+        self.iteration = dict([(item, 0.0) for item in CHARGE_KINDS])
+        self.iteration_charged = 0.0
+        return iteration
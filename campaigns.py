@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+Run a batch of optimization campaigns, one for each row of
+data/init_data.csv, sharing the surrogate models and the cores.
+
+The Thermo-Calc GP, the RVE GP and the feasibility map are built once and given
+to every campaign, rather than rebuilt by each of them. Up to --parallel
+campaigns run at the same time in their own processes; their knowledge
+gradient stages take turns at the cores in the order they become ready
+(kg_tasks.kg_turns), so one campaign's knowledge gradient overlaps the model
+evaluations and updates of the others. The time a campaign waits for its
+turn is recorded in the kg_wait phase of its trace and is not charged to its
+budget.
+
+    python campaigns.py M52 3 8 3 2 2 2000000 1000 --campaigns=0-99 --parallel=2
+
+The inputs and run options are those of the driver (CC_CC_optimization.py,
+or CC_IC_optimization.py with --driver=CC_IC). The files of campaign i are
+written to results/<date>/campaign_<i>/ and the exit code and wall time of
+every campaign to results/<date>/campaigns.csv. With --seed each campaign
+gets its own seed derived from it, otherwise each takes fresh entropy. A
+campaign that stopped can be continued on its own with the driver and
+--resume=results/<date>/campaign_<i>.
+"""
+
+import os
+import sys
+import argparse
+import importlib
+import multiprocessing
+import multiprocessing.connection
+import datetime as dt
+from time import time
+from kg_tasks import kg_turns
+from run_options import parse_run_options
+from rng import rng_streams
+from feasibility import feasibility_lookup
+from functions import set_gp_backend
+
+DRIVERS = {'CC_CC': 'CC_CC_optimization',
+           'CC_IC': 'CC_IC_optimization'}
+
+
+def campaign_indices(spec, count):
+    """
+    Convert a list of campaigns such as '0-9,20,25' (ranges are inclusive)
+    into a sorted list of row numbers. An empty spec is every row.
+    """
+    if spec == '':
+        return list(range(count))
+    indices = set()
+    for part in spec.split(','):
+        first, sep, last = part.partition('-')
+        if sep:
+            indices.update(range(int(first), int(last)+1))
+        else:
+            indices.add(int(first))
+    indices = sorted(indices)
+    if indices[0] < 0 or indices[-1] >= count:
+        raise ValueError('Campaigns must be between 0 and {}'.format(count-1))
+    return indices
+
+
+def shared_models(driver, feasibility_refine=1, inducing=0, sparse_method='fitc'):
+    """
+    Build the models shared by all the campaigns of the batch.
+    """
+    return {'tc_gp': driver.TC_GP(inducing, sparse_method),
+            'rve_gp': driver.RVE_GP(inducing, sparse_method),
+            'clf': feasibility_lookup(driver.TC_GP, 200, feasibility_refine),
+            'kg_turns': kg_turns()}
+
+
+def _run(module_name, param, options, shared):
+    driver = importlib.import_module(module_name)
+    driver.run_campaign(param, options, shared)
+
+
+def run_campaigns(module_name, param, options, indices, parallel, date):
+    """
+    Run a campaign for each row in indices, at most parallel at a time.
+    Returns a list of (index, exit code, wall time) for the campaigns in the
+    order they finished.
+    """
+    driver = importlib.import_module(module_name)
+    seed = options['seed'] if options['seed'] >= 0 else None
+    set_gp_backend(options['gp-backend'])
+    shared = shared_models(driver, options['feasibility-refine'], 
+                           options['sparse-inducing'], options['sparse-method'])
+    batch_streams = rng_streams(seed)
+
+    pending = list(indices)
+    running = {}
+    finished = []
+    while pending or running:
+        while pending and len(running) < parallel:
+            index = pending.pop(0)
+            campaign_options = dict(options)
+            campaign_options['init-index'] = index
+            campaign_options['results-dir'] = '{}/campaign_{}'.format(date, index)
+            if seed is not None:
+                campaign_options['seed'] = batch_streams.integer_seed('campaign', index)
+            campaign = multiprocessing.Process(target=_run,
+                                               args=(module_name, param,
+                                                     campaign_options, shared))
+            campaign.start()
+            running[campaign.sentinel] = (index, campaign, time())
+        for sentinel in multiprocessing.connection.wait(list(running.keys())):
+            index, campaign, start = running.pop(sentinel)
+            campaign.join()
+            finished.append((index, campaign.exitcode, time()-start))
+            print("Campaign {} finished with exit code {} ({}/{})".format(
+                  index, campaign.exitcode, len(finished), len(indices)))
+    return finished
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run a batch of optimization campaigns',
+                                     allow_abbrev=False)
+    parser.add_argument('--driver', default='CC_CC', choices=sorted(DRIVERS.keys()))
+    parser.add_argument('--campaigns', default='',
+                        help="rows of data/init_data.csv to run, for example "
+                             "'0-9,20' (by default every row)")
+    parser.add_argument('--parallel', type=int, default=2,
+                        help='number of campaigns running at the same time')
+    args, driver_args = parser.parse_known_args()
+    param, options = parse_run_options([sys.argv[0]] + driver_args)
+    if options['resume']:
+        raise ValueError('Resume the campaigns of a batch one at a time with the driver')
+    if options['init-index'] >= 0 or options['results-dir']:
+        raise ValueError('--init-index and --results-dir are set for each campaign')
+
+    with open("data/init_data.csv", 'r') as f:
+        row_count = len([line for line in f if line.strip() != ''])
+    indices = campaign_indices(args.campaigns, row_count)
+
+    today = dt.datetime.today()
+    date = "{}_{}_{}_{}_{}".format(today.year,today.month,today.day,today.hour,today.minute)
+    finished = run_campaigns(DRIVERS[args.driver], param, options, indices,
+                             max(1, args.parallel), date)
+
+    os.makedirs('results/{}'.format(date), exist_ok=True)
+    with open("results/{}/campaigns.csv".format(date), 'w') as f:
+        f.write("Campaign,Exit Code,Wall Time,\n")
+        for index, exitcode, wall_time in sorted(finished):
+            f.write("{},{},{},\n".format(index, exitcode, wall_time))
+    print("** Campaigns Finished **")
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+Candidate points for the knowledge gradient, sampled inside the feasible
+region of the design space.
+
+The feasible region of a feasibility map is a set of rectangular cells (the
+points closest to each feasible grid node), in columns of equal temperature.
+A point of the unit square is mapped onto them by inverse distribution
+functions: its first coordinate gives the temperature, in proportion to the
+feasible area of the columns, and its second coordinate the carbon content
+within the feasible cells of that column. Each coordinate of the design
+only sets one coordinate of the point, so the stratification of the design
+is kept in both, and a uniform design of the unit square becomes a uniform
+design of the feasible region. Every point is feasible, so exactly the
+requested number of candidates is returned. The designs are:
+    'lhs':       Latin hypercube
+    'sobol':     scrambled Sobol sequence
+    'random':    independent uniform points
+    'rejection': the original scheme, a Latin hypercube of the whole design
+                 space without the infeasible points (fewer points than
+                 requested)
+All the points are in unit coordinates (temperature scaled from 650-850 C).
+
+A candidate_pool keeps its points between the iterations: the points that
+have been chosen for evaluation are retired, and the pool is topped up with
+new ones (a Sobol pool continues its sequence) when it holds fewer points
+than are asked for, so each draw has fresh points in place of the retired
+ones.
+"""
+
+import warnings
+import numpy as np
+from scipy.stats import qmc
+from rng import lhs
+
+
+def unit_to_design(x):
+    # unit coordinates to (temperature, carbon)
+    x = np.array(x)
+    x[:,0] = x[:,0]*200 + 650
+    return x
+
+
+class feasible_sampler:
+    """
+    Maps points of the unit square onto the feasible cells of a feasibility
+    map.
+    """
+    def __init__(self, fmap):
+        nodes = fmap.nodes
+        feasible = np.logical_not(fmap.mask)
+        if not np.any(feasible):
+            raise ValueError('The feasibility map has no feasible points')
+        half = 0.5/(nodes-1)
+        centre = np.arange(nodes)/(nodes-1)
+        lower = np.maximum(centre-half, 0)
+        width = np.minimum(centre+half, 1) - lower
+        rows, cols = np.nonzero(feasible)
+        # the temperature columns, in proportion to their feasible area
+        length = np.bincount(rows, weights=width[cols], minlength=nodes)
+        self.row_lower = lower
+        self.row_width = width
+        self.row_end = np.cumsum(width*length)/np.sum(width*length)
+        self.row_start = np.append(0, self.row_end[:-1])
+        # the cells of each column, in proportion to their carbon width; the
+        # ends of the cells of column i are offset by i so that one sorted
+        # array holds the cells of all the columns
+        fraction = width[cols]/length[rows]
+        total = np.cumsum(fraction)
+        first = np.searchsorted(rows, rows, side='left')
+        self.cell_end = rows + total - (total[first] - fraction[first])
+        self.cell_start = self.cell_end - fraction
+        self.cell_lower = lower[cols]
+        self.cell_width = width[cols]
+        self.last_cell = np.searchsorted(rows, np.arange(nodes), side='right') - 1
+        self.last_row = rows[-1]
+
+    def transform(self, u):
+        # the temperature column and the position across it
+        i = np.searchsorted(self.row_end, u[:,0], side='right')
+        i = np.minimum(i, self.last_row)
+        span = self.row_end[i] - self.row_start[i]
+        across = np.clip((u[:,0]-self.row_start[i])/np.where(span > 0, span, 1), 0, 1)
+        # the cell of the column and the position along it
+        k = np.searchsorted(self.cell_end, i + u[:,1], side='right')
+        k = np.minimum(k, self.last_cell[i])
+        along = (i + u[:,1] - self.cell_start[k])/(self.cell_end[k] - self.cell_start[k])
+        x = np.zeros_like(u)
+        x[:,0] = self.row_lower[i] + across*self.row_width[i]
+        x[:,1] = self.cell_lower[k] + np.clip(along, 0, 1)*self.cell_width[k]
+        return x
+
+
+class candidate_pool:
+    """
+    Feasible candidate points drawn with one of the designs from the numpy
+    Generator rng. The pool grows when more points are asked for than it
+    holds, and loses the points that are retired.
+    """
+    def __init__(self, fmap, method='lhs', rng=None):
+        if method not in ['lhs', 'sobol', 'random', 'rejection']:
+            raise ValueError('Unknown candidate sampler: {}'.format(method))
+        self.fmap = fmap
+        self.method = method
+        self.rng = np.random.default_rng() if rng is None else rng
+        self.sampler = feasible_sampler(fmap) if method != 'rejection' else None
+        self.engine = qmc.Sobol(2, scramble=True, seed=self.rng) if method == 'sobol' else None
+        self.points = np.zeros((0,2))
+
+    def _design(self, n):
+        if self.method == 'sobol':
+            with warnings.catch_warnings():
+                # the balance of the Sobol sequence is only lost for the
+                # points that do not complete a power of two
+                warnings.simplefilter('ignore', UserWarning)
+                return self.engine.random(n)
+        if self.method == 'random':
+            return self.rng.random((n,2))
+        return lhs(2, n, self.rng)
+
+    def augment(self, n):
+        """
+        Add n new points to the pool (fewer with the 'rejection' design).
+        """
+        if n <= 0:
+            return
+        u = self._design(n)
+        if self.method == 'rejection':
+            new = u[np.nonzero(self.fmap.predict(unit_to_design(u))==0)[0],:]
+        else:
+            new = self.sampler.transform(u)
+        self.points = np.vstack((self.points, new))
+
+    def draw(self, n):
+        """
+        The first n points of the pool, adding new points when there are not
+        enough.
+        """
+        if self.points.shape[0] < n:
+            self.augment(n - self.points.shape[0])
+        return self.points[:n].copy()
+
+    def retire(self, x):
+        """
+        Remove the points x (rows of a draw) from the pool, so they are not
+        drawn again.
+        """
+        x = np.atleast_2d(x)
+        if (x.shape[0] == 0) or (self.points.shape[0] == 0):
+            return
+        distance = np.max(np.abs(self.points[:,None,:] - x[None,:,:]), axis=2)
+        self.points = self.points[np.logical_not(np.any(distance < 1e-12, axis=1))]
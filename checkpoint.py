@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+Checkpoints of the optimization loop so that a long campaign can be resumed
+after a crash or preemption.
+
+A checkpoint is a pickle of a dictionary holding everything the loop needs to
+continue: the model_reification object (with its fitted GPs, so nothing has to
+be refitted), the budgets, max_RVE, the counters, the random number generator
+states and the iteration to start from. The size of every log file of the
+campaign is stored as well, so that lines written after the checkpoint by an
+iteration that did not complete can be removed when the campaign is resumed.
+
+The checkpoint is written to a temporary file which then replaces the old
+checkpoint, so a crash while writing never leaves a broken checkpoint.
+"""
+
+import os
+import glob
+import pickle
+import random
+import numpy as np
+
+
+def checkpoint_path(date, results_dir_name):
+    return "results/{}/{}_checkpoint.pkl".format(date, results_dir_name)
+
+
+def _log_files(date, results_dir_name):
+    return [f for f in glob.glob("results/{}/{}_*".format(date, results_dir_name))
+            if not f.endswith('.pkl') and not f.endswith('.tmp')]
+
+
+def save_checkpoint(state):
+    """
+    Atomically write the loop state. state must contain the 'date' and
+    'results_dir_name' of the campaign; the random number generator states
+    and the log file sizes are added here.
+    """
+    state = dict(state)
+    state['np_random_state'] = np.random.get_state()
+    state['random_state'] = random.getstate()
+    state['log_sizes'] = {}
+    for f in _log_files(state['date'], state['results_dir_name']):
+        state['log_sizes'][f] = os.path.getsize(f)
+    path = checkpoint_path(state['date'], state['results_dir_name'])
+    with open(path + '.tmp', 'wb') as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + '.tmp', path)
+
+
+def find_checkpoint(resume, prefix):
+    """
+    Find the checkpoint given with the --resume option. This can be the
+    checkpoint file, the results/<date> directory of the campaign or 'latest'
+    for the most recent checkpoint of a campaign whose results name starts
+    with prefix.
+    """
+    if resume == 'latest':
+        found = glob.glob("results/**/{}*_checkpoint.pkl".format(prefix), recursive=True)
+        if len(found) == 0:
+            raise FileNotFoundError('No checkpoint found to resume from')
+        return max(found, key=os.path.getmtime)
+    if os.path.isdir(resume):
+        found = glob.glob(os.path.join(resume, "{}*_checkpoint.pkl".format(prefix)))
+        if len(found) == 0:
+            raise FileNotFoundError('No checkpoint found in {}'.format(resume))
+        return max(found, key=os.path.getmtime)
+    return resume
+
+
+def load_checkpoint(path):
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+def restore_checkpoint(state):
+    """
+    Restore the random number generator states and cut the log files back to
+    their size when the checkpoint was written.
+    """
+    np.random.set_state(state['np_random_state'])
+    random.setstate(state['random_state'])
+    for f in state['log_sizes']:
+        if os.path.exists(f) and os.path.getsize(f) > state['log_sizes'][f]:
+            with open(f, 'r+b') as log:
+                log.truncate(state['log_sizes'][f])
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+Feasibility map of the design space, in place of the tc_vf_classifier.
+
+A point (temperature, carbon) is infeasible when the Thermo-Calc GP predicts
+a phase fraction above 0.9. The map holds this on a regular grid over
+650-850 C and 0-1 wt% C, and a point takes the value of the nearest grid
+node, so classifying a batch of points is a single array index. This is the
+same answer the decision tree trained on the grid gave (its splits fall half
+way between the grid nodes), without building the tree or predicting the
+grid at every start-up.
+
+With refine > 1 the grid is made refine times finer in the cells that the
+feasibility boundary passes through (where the corners of the cell
+disagree), the Thermo-Calc GP being evaluated at the new nodes; elsewhere
+the fine nodes take the value of the nearest coarse node.
+
+The map is stored in data/feasibility_<size>_<refine>.npz, together with a
+hash of data/tc_data.xlsx, and is built again when that file changes.
+"""
+
+import os
+import hashlib
+import numpy as np
+
+TEMPERATURE = (650, 850)
+CARBON = (0, 1)
+TC_DATA = 'data/tc_data.xlsx'
+
+
+def _tc_data_hash():
+    with open(TC_DATA, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def _grid_points(nodes):
+    # all the (temperature, carbon) nodes of a nodes x nodes grid, in the
+    # order of the rows of the map
+    temp = np.linspace(0, 1, nodes, endpoint=True)
+    x = np.zeros((nodes*nodes, 2))
+    x[:,0] = np.repeat(temp, nodes)*(TEMPERATURE[1]-TEMPERATURE[0]) + TEMPERATURE[0]
+    x[:,1] = np.tile(temp, nodes)*(CARBON[1]-CARBON[0]) + CARBON[0]
+    return x
+
+
+def _infeasible(tc_gp, x, block=2000):
+    # the Thermo-Calc GP is evaluated in blocks to bound the memory of the
+    # predictive covariance
+    out = np.zeros(x.shape[0], dtype=bool)
+    for start in range(0, x.shape[0], block):
+        tc_out = tc_gp.predict(x[start:start+block])
+        out[start:start+block] = tc_out[:,0] > 0.9
+    return out
+
+
+class feasibility_map:
+    """
+    Nearest-node lookup in a boolean map of the infeasible region. predict
+    returns 1 for an infeasible point and 0 for a feasible one, as the
+    classifier did.
+    """
+    def __init__(self, mask):
+        self.mask = mask
+        self.nodes = mask.shape[0]
+
+    def index(self, x_predict):
+        if len(x_predict.shape) == 1:
+            x_predict = np.expand_dims(x_predict, axis=0)
+        i = np.rint((x_predict[:,0]-TEMPERATURE[0])/(TEMPERATURE[1]-TEMPERATURE[0])*(self.nodes-1))
+        j = np.rint((x_predict[:,1]-CARBON[0])/(CARBON[1]-CARBON[0])*(self.nodes-1))
+        i = np.clip(i, 0, self.nodes-1).astype(np.int64)
+        j = np.clip(j, 0, self.nodes-1).astype(np.int64)
+        return i, j
+
+    def predict(self, x_predict):
+        i, j = self.index(x_predict)
+        return self.mask[i, j].astype(np.float64)
+
+
+def build_feasibility_map(tc_gp, size=200, refine=1):
+    """
+    Evaluate the Thermo-Calc GP on a size x size grid, and on the nodes of a
+    refine times finer grid in the cells the boundary passes through.
+    """
+    coarse = _infeasible(tc_gp, _grid_points(size)).reshape((size, size))
+    if refine <= 1:
+        return feasibility_map(coarse)
+
+    nodes = (size-1)*refine + 1
+    nearest = np.rint(np.arange(nodes)/refine).astype(np.int64)
+    mask = coarse[np.ix_(nearest, nearest)]
+    corners = (coarse[:-1,:-1].astype(np.int64) + coarse[1:,:-1] + coarse[:-1,1:] + 
+               coarse[1:,1:])
+    boundary = np.zeros((nodes, nodes), dtype=bool)
+    for i, j in zip(*np.nonzero((corners > 0) & (corners < 4))):
+        boundary[i*refine:(i+1)*refine+1, j*refine:(j+1)*refine+1] = True
+    fine = _grid_points(nodes)[boundary.flatten()]
+    mask[boundary] = _infeasible(tc_gp, fine)
+    return feasibility_map(mask)
+
+
+def feasibility_path(size=200, refine=1):
+    return 'data/feasibility_{}_{}.npz'.format(size, refine)
+
+
+def save_feasibility_map(fmap, path):
+    np.savez_compressed(path, mask=fmap.mask, tc_data=_tc_data_hash())
+
+
+def load_feasibility_map(path):
+    """
+    The map stored in path, or None when there is none or it was built from
+    a different data/tc_data.xlsx.
+    """
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as data:
+        if str(data['tc_data']) != _tc_data_hash():
+            return None
+        return feasibility_map(data['mask'])
+
+
+def feasibility_lookup(tc_gp_class, size=200, refine=1):
+    """
+    Load the feasibility map, building it (with a new tc_gp_class instance)
+    and storing it when it is missing or out of date.
+    """
+    path = feasibility_path(size, refine)
+    fmap = load_feasibility_map(path)
+    if fmap is None:
+        fmap = build_feasibility_map(tc_gp_class(), size, refine)
+        save_feasibility_map(fmap, path)
+    return fmap
@@ -10,18 +10,304 @@ This code is to achieve two objectives:
     2) Provide the code for using the Reification method in Python. Will use the
     george.py module for the GP fit.
 """
-from george import kernels, GP
+try:
+    from george import kernels, GP
+except ImportError:
+    kernels = None
+    GP = None
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 from copy import deepcopy
+from scipy.linalg import cho_factor, cho_solve, solve_triangular
+from scipy.spatial.distance import cdist
+
+# the GP backend of the gp_models created without one, 'george' or 'numpy'
+# (see set_gp_backend)
+GP_BACKEND = 'george' if GP is not None else 'numpy'
+
+
+def set_gp_backend(backend):
+    """
+    Set the backend of the gp_models created from now on. 'auto' is george
+    when it is installed and numpy otherwise.
+    """
+    global GP_BACKEND
+    if backend == 'auto':
+        backend = 'george' if GP is not None else 'numpy'
+    if backend not in ['george', 'numpy']:
+        raise ValueError('Unknown GP backend: {}'.format(backend))
+    if (backend == 'george') and (GP is None):
+        raise ValueError('The george GP backend needs the george package')
+    GP_BACKEND = backend
+
+
+def kernel_profile(kern, r2):
+    """
+    The SE, M32 or M52 kernel as a function of r2, the squared distance
+    scaled by the squared length scales (as in george), and its derivative
+    with respect to r2, without the constant.
+    """
+    if kern == 'SE':
+        k = np.exp(-0.5*r2)
+        return k, -0.5*k
+    if kern == 'M32':
+        u = np.sqrt(3*r2)
+        e = np.exp(-u)
+        return (1+u)*e, -1.5*e
+    u = np.sqrt(5*r2)
+    e = np.exp(-u)
+    return (1+u+u**2/3)*e, -(5/6)*(1+u)*e
+
+
+class numpy_gp:
+    """
+    The parts of the george GP used by gp_model, in NumPy and SciPy, for the
+    SE, M32 and M52 kernels scaled by a constant. The parameter vector is the
+    same as george's: the log of the constant divided by the number of
+    dimensions and the logs of the squared length scales (one for all the
+    dimensions or one for each). The Cholesky factor is kept until the
+    parameters or the training points change (when points are only added to
+    the end it is extended), and alpha until y changes.
+    """
+    def __init__(self, kern, l_param, sigma_f, n_dim, mean=0):
+        if kern not in ['SE', 'M32', 'M52']:
+            raise ValueError('Unknown kernel: {}'.format(kern))
+        self.kern = kern
+        self.n_dim = n_dim
+        self.mean = mean
+        self.parameters = np.append(np.log(sigma_f/n_dim), 
+                                    np.log(np.atleast_1d(l_param).astype(np.float64)))
+        self.x = None
+        self.yerr = None
+        self.factor = None
+        self.y = None
+        self.alpha = None
+    
+    def get_parameter_vector(self):
+        return self.parameters.copy()
+    
+    def set_parameter_vector(self, p):
+        self.parameters = np.array(p, dtype=np.float64)
+        self.factor = None
+        self.alpha = None
+    
+    def _scale(self, x):
+        return np.array(x, dtype=np.float64)/np.sqrt(np.exp(self.parameters[1:]))
+    
+    def get_value(self, x1, x2=None):
+        x2 = x1 if x2 is None else x2
+        r2 = cdist(self._scale(x1), self._scale(x2), 'sqeuclidean')
+        return np.exp(self.parameters[0])*self.n_dim*kernel_profile(self.kern, r2)[0]
+    
+    def compute(self, x, yerr=0.0):
+        x = np.array(x, dtype=np.float64)
+        noise = np.ones(x.shape[0])*np.array(yerr, dtype=np.float64)**2
+        n = 0 if (self.factor is None) or (self.x is None) else self.x.shape[0]
+        if (0 < n < x.shape[0]) and np.array_equal(x[:n], self.x) and \
+           np.array_equal(noise[:n], np.ones(n)*np.array(self.yerr, dtype=np.float64)**2):
+            # points added to the end of the training points: the Cholesky
+            # factor is extended by their rows, O(n^2 k) for k new points
+            # rather than a new O((n+k)^3) factorisation
+            L = self.factor[0]
+            K = self.get_value(x[n:])
+            K[np.diag_indices_from(K)] += noise[n:]
+            L21 = solve_triangular(L, self.get_value(self.x, x[n:]), lower=True).T
+            factor = np.zeros((x.shape[0], x.shape[0]))
+            factor[:n,:n] = L
+            factor[n:,:n] = L21
+            factor[n:,n:] = np.linalg.cholesky(K - L21 @ L21.T)
+            self.factor = (factor, True)
+        else:
+            K = self.get_value(x)
+            K[np.diag_indices_from(K)] += noise
+            self.factor = cho_factor(K, lower=True)
+        self.x = x
+        self.yerr = yerr
+        self.alpha = None
+    
+    def recompute(self, quiet=False):
+        if self.factor is None:
+            try:
+                self.compute(self.x, self.yerr)
+            except (np.linalg.LinAlgError, ValueError):
+                if quiet:
+                    return False
+                raise
+        return True
+    
+    def _alpha(self, y):
+        y = np.array(y, dtype=np.float64)
+        if (self.alpha is None) or (not np.array_equal(y, self.y)):
+            self.y = y
+            self.alpha = cho_solve(self.factor, y - self.mean)
+        return self.alpha
+    
+    def predict(self, y, t, return_cov=True, return_var=False, kernel=None):
+        self.recompute()
+        alpha = self._alpha(y)
+        Ks = self.get_value(t, self.x)
+        mean = Ks @ alpha + self.mean
+        if not (return_cov or return_var):
+            return mean
+        v = solve_triangular(self.factor[0], Ks.T, lower=True)
+        if return_var:
+            var = np.exp(self.parameters[0])*self.n_dim - np.sum(v**2, axis=0)
+            return mean, var
+        return mean, self.get_value(t) - v.T @ v
+    
+    def log_likelihood(self, y, quiet=False):
+        if not self.recompute(quiet=quiet):
+            return -np.inf
+        alpha = self._alpha(y)
+        ll = (-0.5*np.dot(self.y - self.mean, alpha) - 
+              np.sum(np.log(np.diag(self.factor[0]))) - 
+              0.5*self.x.shape[0]*np.log(2*np.pi))
+        return ll if np.isfinite(ll) else -np.inf
+    
+    def grad_log_likelihood(self, y, quiet=False):
+        if not self.recompute(quiet=quiet):
+            return np.zeros_like(self.parameters)
+        alpha = self._alpha(y)
+        n = self.x.shape[0]
+        l2 = np.exp(self.parameters[1:])
+        diff2 = (self.x[:,None,:] - self.x[None,:,:])**2
+        k, dk = kernel_profile(self.kern, np.sum(diff2/(l2*np.ones(self.x.shape[1])), axis=2))
+        sf = np.exp(self.parameters[0])*self.n_dim
+        # 0.5 trace((alpha alpha^T - K^-1) dK/dp) for each parameter
+        W = np.outer(alpha, alpha) - cho_solve(self.factor, np.eye(n))
+        grad = np.zeros_like(self.parameters)
+        grad[0] = 0.5*np.sum(W*sf*k)
+        if l2.shape[0] == 1:
+            grad[1] = 0.5*np.sum(W*sf*dk*(-np.sum(diff2, axis=2)/l2[0]))
+        else:
+            for d in range(l2.shape[0]):
+                grad[d+1] = 0.5*np.sum(W*sf*dk*(-diff2[:,:,d]/l2[d]))
+        return grad
+
+
+class sparse_gp(numpy_gp):
+    """
+    An inducing point approximation of numpy_gp, for GPs with many training
+    points. The inducing points are a subset of the training points (inducing
+    of them), chosen by farthest point selection in the coordinates scaled by
+    the length scales, and are kept until the training points change. The
+    approximation of the training covariance is
+        'fitc': Qff + diag(Kff - Qff) + noise (exact variances)
+        'vfe':  Qff + noise, with the trace penalty of Titsias in the
+                likelihood
+    where Qff = Kfu Kuu^-1 Kuf. Building the GP costs O(n m^2) and a
+    prediction O(m) (O(m^2) with the variance), for n training points and m
+    inducing points. The gradient of the log likelihood is found by central
+    differences.
+    """
+    def __init__(self, kern, l_param, sigma_f, n_dim, mean=0, inducing=200, method='fitc'):
+        numpy_gp.__init__(self, kern, l_param, sigma_f, n_dim, mean)
+        if method not in ['fitc', 'vfe']:
+            raise ValueError('Unknown sparse GP method: {}'.format(method))
+        self.inducing = inducing
+        self.method = method
+        self.z = None
+    
+    def select_inducing(self, x):
+        # farthest point selection, from the training point nearest the centre
+        a = self._scale(x)
+        chosen = [np.argmin(np.sum((a - np.mean(a, axis=0))**2, axis=1))]
+        distance = np.sum((a - a[chosen[0]])**2, axis=1)
+        for i in range(1, min(self.inducing, x.shape[0])):
+            chosen.append(np.argmax(distance))
+            distance = np.minimum(distance, np.sum((a - a[chosen[-1]])**2, axis=1))
+        return x[np.sort(chosen)]
+    
+    def compute(self, x, yerr=0.0):
+        x = np.array(x, dtype=np.float64)
+        if (self.z is None) or (self.x is None) or (x.shape != self.x.shape) or \
+           (not np.array_equal(x, self.x)):
+            self.z = self.select_inducing(x)
+        self.x = x
+        self.yerr = yerr
+        sf = np.exp(self.parameters[0])*self.n_dim
+        Kuu = self.get_value(self.z)
+        Kuu[np.diag_indices_from(Kuu)] += 1e-8*sf
+        L = np.linalg.cholesky(Kuu)
+        V = solve_triangular(L, self.get_value(self.z, x), lower=True)
+        noise = np.ones(x.shape[0])*np.array(yerr, dtype=np.float64)**2
+        # Kff - Qff on the diagonal
+        residual = np.maximum(sf - np.sum(V**2, axis=0), 0)
+        if self.method == 'fitc':
+            lam = noise + residual
+        else:
+            lam = noise
+        lam = np.maximum(lam, 1e-10*sf)
+        A = np.eye(self.z.shape[0]) + (V/lam) @ V.T
+        LA = np.linalg.cholesky(A)
+        self.factor = (L, V, lam, LA)
+        self.trace = 0.5*np.sum(residual/lam) if self.method == 'vfe' else 0.0
+        self.alpha = None
+    
+    def _alpha(self, y):
+        y = np.array(y, dtype=np.float64)
+        if (self.alpha is None) or (not np.array_equal(y, self.y)):
+            L, V, lam, LA = self.factor
+            self.y = y
+            c = solve_triangular(LA, V @ ((y - self.mean)/lam), lower=True)
+            w = solve_triangular(L.T, solve_triangular(LA.T, c, lower=False), lower=False)
+            self.alpha = (w, c)
+        return self.alpha
+    
+    def predict(self, y, t, return_cov=True, return_var=False, kernel=None):
+        self.recompute()
+        w, c = self._alpha(y)
+        L, V, lam, LA = self.factor
+        Kus = self.get_value(self.z, t)
+        mean = Kus.T @ w + self.mean
+        if not (return_cov or return_var):
+            return mean
+        a1 = solve_triangular(L, Kus, lower=True)
+        a2 = solve_triangular(LA, a1, lower=True)
+        if return_var:
+            var = (np.exp(self.parameters[0])*self.n_dim - np.sum(a1**2, axis=0) + 
+                   np.sum(a2**2, axis=0))
+            return mean, var
+        return mean, self.get_value(t) - a1.T @ a1 + a2.T @ a2
+    
+    def log_likelihood(self, y, quiet=False):
+        if not self.recompute(quiet=quiet):
+            return -np.inf
+        w, c = self._alpha(y)
+        L, V, lam, LA = self.factor
+        r = self.y - self.mean
+        ll = (-0.5*(np.dot(r, r/lam) - np.dot(c, c)) - 
+              0.5*np.sum(np.log(lam)) - np.sum(np.log(np.diag(LA))) - 
+              0.5*self.x.shape[0]*np.log(2*np.pi) - self.trace)
+        return ll if np.isfinite(ll) else -np.inf
+    
+    def grad_log_likelihood(self, y, quiet=False, step=1e-5):
+        p0 = self.get_parameter_vector()
+        grad = np.zeros_like(p0)
+        for i in range(p0.shape[0]):
+            p = p0.copy()
+            p[i] = p0[i] + step
+            self.set_parameter_vector(p)
+            upper = self.log_likelihood(y, quiet=quiet)
+            p[i] = p0[i] - step
+            self.set_parameter_vector(p)
+            lower = self.log_likelihood(y, quiet=quiet)
+            grad[i] = (upper - lower)/(2*step) if np.isfinite(upper - lower) else 0.0
+        self.set_parameter_vector(p0)
+        return grad
+    
   
 class gp_model:
     """
     A class that creates a GP from a given set of input data and hyper-parameters.
-    The Kernel can be selected from three separate Kernels.
+    The Kernel can be selected from three separate Kernels. The GP is built
+    with george or with numpy_gp, by default the backend set with
+    set_gp_backend. With more training points than inducing it is the
+    inducing point approximation sparse_gp (sparse_method 'fitc' or 'vfe').
     """
-    def __init__(self, x_train, y_train, l_param, sigma_f, sigma_n, n_dim, kern, mean=0):
+    def __init__(self, x_train, y_train, l_param, sigma_f, sigma_n, n_dim, kern, mean=0,
+                 backend=None, inducing=None, sparse_method='fitc'):
         self.x_train = np.array(x_train)
         self.y_train = np.array(y_train)
         self.l_param = np.array(l_param)**2
@@ -30,10 +316,19 @@ class gp_model:
         self.mean = mean
         self.n_dim = n_dim
         self.kern = kern
+        self.backend = GP_BACKEND if backend is None else backend
+        self.inducing = inducing
+        self.sparse_method = sparse_method
         self.kk = self.create_kernel()
         self.gp = self.create_gp()
+    
+    def is_sparse(self):
+        return (self.inducing is not None) and (0 < self.inducing < self.x_train.shape[0])
         
     def create_kernel(self):
+        if (self.backend == 'numpy') or self.is_sparse():
+            # the kernel is part of the numpy_gp
+            return None
         if self.kern == 'SE':
             return self.sigma_f * kernels.ExpSquaredKernel(self.l_param, ndim=self.n_dim)
         elif self.kern == 'M32':
@@ -42,7 +337,13 @@ class gp_model:
             return self.sigma_f * kernels.Matern52Kernel(self.l_param, ndim=self.n_dim)
     
     def create_gp(self):
-        gp = GP(kernel=self.kk, mean=self.mean)
+        if self.is_sparse():
+            gp = sparse_gp(self.kern, self.l_param, self.sigma_f, self.n_dim, self.mean, 
+                           self.inducing, self.sparse_method)
+        elif self.backend == 'numpy':
+            gp = numpy_gp(self.kern, self.l_param, self.sigma_f, self.n_dim, self.mean)
+        else:
+            gp = GP(kernel=self.kk, mean=self.mean)
         gp.compute(self.x_train, self.sigma_n)
         return gp
     
@@ -78,28 +379,121 @@ class gp_model:
                 params.append(np.sqrt(np.exp(curr_params[i])))
         return np.array(params)
         
-    def hp_optimize(self, meth="L-BFGS-B", update=False):
-        import scipy.optimize as op
-        gp = deepcopy(self)
-        p0 = gp.gp.get_parameter_vector()
-        def nll(p):
-            gp.gp.set_parameter_vector(p)
-            ll = gp.log_likelihood()
-            return -ll if np.isfinite(ll) else 1e25
+    def hp_optimize(self, meth="L-BFGS-B", update=False, starts=1, bounds=None,
+                    workers=1, random_state=None):
+        """
+        Maximise the log likelihood over the hyper-parameters, from the
+        current ones and starts-1 random starting points (see hp_optimize_models).
+        """
+        return hp_optimize_models([self], meth, update, starts, bounds, workers,
+                                  random_state)[0]
+    
+    def set_hyper_params(self, p):
+        # p is the george parameter vector: the log of sigma_f/n_dim and the
+        # logs of the squared length scales
+        self.sigma_f = np.exp(p[0])*self.n_dim
+        self.l_param = np.exp(p[1:])
+        self.kk = self.create_kernel()
+        self.gp = self.create_gp()
         
-        def grad_nll(p):
-            gp.gp.set_parameter_vector(p)
-            return -gp.gp.grad_log_likelihood(self.y_train, quiet=True)
-                
-        results = op.minimize(nll, p0, jac=grad_nll, method=meth)
+
+def _hp_start(gp, p0, bounds, meth):
+    """
+    A single start of the hyper-parameter optimization of gp. The
+    log likelihood and its gradient are calculated together, so the kernel
+    matrix is factorised once for each parameter vector.
+    """
+    import scipy.optimize as op
+    def nll(p):
+        gp.gp.set_parameter_vector(p)
+        ll = gp.log_likelihood()
+        if not np.isfinite(ll):
+            return 1e25, np.zeros_like(p)
+        return -ll, -gp.gp.grad_log_likelihood(gp.y_train, quiet=True)
+    
+    results = op.minimize(nll, p0, jac=True, method=meth, bounds=bounds)
+    return results.fun, results.x
+
+
+def hp_optimize_models(models, meth="L-BFGS-B", update=False, starts=1, bounds=None,
+                       workers=1, random_state=None):
+    """
+    Optimize the hyper-parameters of several gp_models at once. Each model
+    is started from its current hyper-parameters and from starts-1 points
+    drawn uniformly within the bounds, and the best of its starts is kept.
+    The bounds are on the george parameter vector (the logs); without them a
+    single start is unbounded, as before, and the random starts are drawn
+    within 5 of the current parameters. All the starts of all the models
+    are run by a pool of worker processes (in this process for 1 worker).
+    
+    Returns the exponential of the best parameter vector of each model, and
+    with update=True the models are given these hyper-parameters.
+    """
+    import concurrent.futures
+    rng = np.random.default_rng(random_state)
+    jobs = []
+    for index, model in enumerate(models):
+        p0 = model.gp.get_parameter_vector()
+        if (bounds is None) and (starts > 1):
+            model_bounds = [(p-5, p+5) for p in p0]
+        else:
+            model_bounds = bounds
+        jobs.append((index, p0, model_bounds))
+        for i in range(starts-1):
+            low = np.array([b[0] for b in model_bounds])
+            high = np.array([b[1] for b in model_bounds])
+            jobs.append((index, low + rng.random(p0.shape[0])*(high-low), model_bounds))
+    
+    if workers > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(_hp_start, models[index], p, b, meth) 
+                       for index, p, b in jobs]
+            results = [future.result() for future in futures]
+    else:
+        results = [_hp_start(deepcopy(models[index]), p, b, meth) for index, p, b in jobs]
+    
+    best = [None]*len(models)
+    for (index, p, b), (fun, x) in zip(jobs, results):
+        if (best[index] is None) or (fun < best[index][0]):
+            best[index] = (fun, x)
+    out = []
+    for model, (fun, x) in zip(models, best):
         if update:
-            # automatically update the hyper-parameters, the required input for
-            # the set_parameter_vector command is the log of the hyper-parameters
-            self.gp.set_parameter_vector(results.x)
-            self.gp.compute(self.x_train, self.sigma_n)
+            model.set_hyper_params(x)
         # The results are the log of the hyper-parameters, so return the
         # exponential of the results.
-        return np.exp(results.x)
+        out.append(np.exp(x))
+    return out
+
+
+def sparse_accuracy(model, x_test, inducing, sparse_method='fitc'):
+    """
+    Compare the inducing point approximation of the gp_model model (with the
+    same data and hyper-parameters and inducing points) against the exact GP
+    at the points x_test. Returns the build and prediction times of both and
+    the errors of the mean and standard deviation of the approximation.
+    """
+    from time import perf_counter
+    models = {}
+    report = {'training_points': int(model.x_train.shape[0]), 'inducing': inducing,
+              'method': sparse_method, 'test_points': int(x_test.shape[0])}
+    for name, count in [('exact', None), ('sparse', inducing)]:
+        start = perf_counter()
+        models[name] = gp_model(model.x_train, model.y_train, np.sqrt(model.l_param), 
+                                model.sigma_f, model.sigma_n, model.n_dim, model.kern, 
+                                model.mean, model.backend, count, sparse_method)
+        report[name + '_build_time'] = perf_counter() - start
+        start = perf_counter()
+        mean, var = models[name].predict_var(x_test)
+        report[name + '_predict_time'] = perf_counter() - start
+        models[name] = (mean, np.sqrt(np.maximum(var, 0)))
+    error = models['sparse'][0] - models['exact'][0]
+    report['mean_rmse'] = float(np.sqrt(np.mean(error**2)))
+    report['mean_max_error'] = float(np.max(np.abs(error)))
+    # the RMSE relative to the spread of the exact mean
+    report['mean_relative_rmse'] = report['mean_rmse']/max(float(np.std(models['exact'][0])), 1e-12)
+    report['std_rmse'] = float(np.sqrt(np.mean((models['sparse'][1] - models['exact'][1])**2)))
+    return report
         
         
 def reification(y, sig):
@@ -0,0 +1,457 @@
+# -*- coding: utf-8 -*-
+"""
+Golden-output regression harness for the numerical kernels.
+
+The outputs of the current implementations of the reduced order models,
+reification, knowledge_gradient, the k-medoids routines and the GP are
+recorded on seeded inputs into fixture files in golden/ (one .npz per function, holding
+the inputs, the outputs and the time the reference took). Any engine
+registered for a function (the reference implementation, or a faster
+version of it) can then be checked against the fixtures with the
+tolerances of that function, and the accuracy and speed of the engines are
+reported side by side:
+
+    python golden.py record              # write the fixtures (once)
+    python golden.py check               # check every engine
+    python golden.py check --functions=reification,knowledge_gradient
+
+A new engine is added with register_engine, for example
+
+    register_engine('kMedoids', 'fastPAM', _kmedoids_fastpam_engine,
+                    {'rtol': 0.0, 'atol': 1e-9, 'exact': [],
+                     'at_most': ['cost'], 'skip': ['medoids']})
+
+where the function takes the dictionary of inputs of a case and returns a
+dictionary with the same outputs as the reference engine, and the optional
+tolerances replace those of the function for this engine. The engines
+registered here are the optimized paths of the reference code: the
+precomputed and blocked distances of KMedoids, the NumPy and inducing point
+GP backends against george, and fastPAM and CLARA in place of kMedoids
+(which must find clusters with no larger total distance).
+"""
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+import datetime as dt
+from time import perf_counter
+import numpy as np
+from functions import reification, knowledge_gradient
+from reduced_order_models import isostrain_IS, isostress_IS, isowork_IS
+from scipy.spatial.distance import cdist
+from kmedoids import KMedoids, kMedoids, fastPAM, clara
+from functions import gp_model, sparse_gp, GP
+
+# the fixtures are recorded in this format version, fixtures of another
+# version are not used
+GOLDEN_VERSION = 1
+GOLDEN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'golden')
+
+# tolerances of each function: outputs listed in exact must match exactly,
+# those in skip are not compared, those in at_most must satisfy
+# new <= golden + atol + rtol*|golden| and the rest
+# |new - golden| <= atol + rtol*|golden|
+TOLERANCES = {
+    'isostrain_IS': {'rtol': 1e-9, 'atol': 1e-12, 'exact': []},
+    'isostress_IS': {'rtol': 1e-6, 'atol': 1e-9, 'exact': []},
+    'isowork_IS': {'rtol': 1e-6, 'atol': 1e-9, 'exact': []},
+    'reification': {'rtol': 1e-9, 'atol': 1e-12, 'exact': []},
+    'knowledge_gradient': {'rtol': 1e-7, 'atol': 1e-10, 'exact': ['x_star']},
+    'kMedoids': {'rtol': 1e-9, 'atol': 1e-12, 'exact': ['medoids']},
+    'fastPAM': {'rtol': 1e-9, 'atol': 1e-12, 'exact': ['medoids']},
+    'KMedoids': {'rtol': 1e-9, 'atol': 1e-12, 'exact': ['medoids']},
+    'gp_model': {'rtol': 1e-7, 'atol': 1e-10, 'exact': []},
+}
+
+ENGINES = dict([(function, {}) for function in TOLERANCES])
+ENGINE_TOLERANCES = dict([(function, {}) for function in TOLERANCES])
+
+
+def register_engine(function, name, engine, tolerances=None):
+    """
+    Add an implementation of function to be checked against the fixtures,
+    with tolerances in place of those of the function if they are given.
+    """
+    if function not in ENGINES:
+        raise ValueError('No golden outputs for {}'.format(function))
+    ENGINES[function][name] = engine
+    if tolerances is not None:
+        ENGINE_TOLERANCES[function][name] = tolerances
+
+
+def _rom_engine(rom):
+    return lambda inputs: {'cc': np.asarray(rom(inputs['x'], float(inputs['ep'])),
+                                            dtype=np.float64)}
+
+
+def _reification_engine(inputs):
+    mean, var = reification(list(inputs['y']), list(inputs['sig']))
+    return {'mean': mean, 'var': var}
+
+
+def _knowledge_gradient_engine(inputs):
+    nu_star, x_star, NU = knowledge_gradient(int(inputs['M']), float(inputs['sn']),
+                                             inputs['mu'], inputs['sigma'])
+    return {'nu_star': np.float64(nu_star), 'x_star': np.int64(x_star),
+            'NU': np.array(NU, dtype=np.float64)}
+
+
+def _medoid_outputs(D, M):
+    M = np.sort(np.array(M, dtype=np.int64))
+    return {'medoids': M, 'cost': np.float64(np.sum(np.min(D[:,M], axis=1)))}
+
+
+def _kmedoids_engine(inputs):
+    # kMedoids starts from random medoids, the seed is part of the inputs
+    D = cdist(inputs['X'], inputs['X'])
+    np.random.seed(int(inputs['seed']))
+    M, C = kMedoids(D, int(inputs['k']))
+    return _medoid_outputs(D, M)
+
+
+def _fastpam_engine(inputs):
+    D = cdist(inputs['X'], inputs['X'])
+    M, C = fastPAM(D, int(inputs['k']))
+    return _medoid_outputs(D, M)
+
+
+def _clara_engine(inputs):
+    D = cdist(inputs['X'], inputs['X'])
+    M, C = clara(inputs['X'], int(inputs['k']), random_state=int(inputs['seed']))
+    return _medoid_outputs(D, M)
+
+
+def _kmedoids_class_engine(distance):
+    # the lazy distances (the original code) only take a list of points
+    def engine(inputs):
+        X = inputs['X']
+        model = KMedoids(int(inputs['k']), distance=distance, random_state=int(inputs['seed']))
+        model.fit(X.tolist() if distance == 'lazy' else X)
+        return _medoid_outputs(cdist(X, X), list(model.medoids))
+    return engine
+
+
+def _gp_outputs(gp, inputs):
+    mean, var = gp.predict(inputs['y'], inputs['x_test'], return_cov=False, return_var=True)
+    return {'mean': np.asarray(mean, dtype=np.float64),
+            'var': np.asarray(var, dtype=np.float64),
+            'log_likelihood': np.float64(gp.log_likelihood(inputs['y']))}
+
+
+def _gp_engine(backend):
+    def engine(inputs):
+        model = gp_model(inputs['x'], inputs['y'], inputs['l_param'], float(inputs['sf']),
+                         float(inputs['sn']), inputs['x'].shape[1], str(inputs['kern']),
+                         backend=backend)
+        return _gp_outputs(model.gp, inputs)
+    return engine
+
+
+def _sparse_gp_engine(method):
+    # with every training point as an inducing point the approximation is
+    # the exact GP, apart from the jitter of the inducing covariance
+    def engine(inputs):
+        gp = sparse_gp(str(inputs['kern']), np.asarray(inputs['l_param'])**2,
+                       float(inputs['sf']), inputs['x'].shape[1],
+                       inducing=inputs['x'].shape[0], method=method)
+        gp.compute(inputs['x'], float(inputs['sn']))
+        return _gp_outputs(gp, inputs)
+    return engine
+
+
+# a different clustering of the same points, which must not be worse
+REPLACEMENT_TOLERANCES = {'rtol': 0.0, 'atol': 1e-9, 'exact': [],
+                          'at_most': ['cost'], 'skip': ['medoids']}
+# the jitter of the inducing covariance
+SPARSE_TOLERANCES = {'rtol': 1e-3, 'atol': 1e-6, 'exact': []}
+
+
+register_engine('isostrain_IS', 'reference', _rom_engine(isostrain_IS))
+register_engine('isostress_IS', 'reference', _rom_engine(isostress_IS))
+register_engine('isowork_IS', 'reference', _rom_engine(isowork_IS))
+register_engine('reification', 'reference', _reification_engine)
+register_engine('knowledge_gradient', 'reference', _knowledge_gradient_engine)
+register_engine('kMedoids', 'reference', _kmedoids_engine)
+register_engine('fastPAM', 'reference', _fastpam_engine)
+register_engine('kMedoids', 'fastPAM', _fastpam_engine, REPLACEMENT_TOLERANCES)
+register_engine('kMedoids', 'clara', _clara_engine, REPLACEMENT_TOLERANCES)
+register_engine('KMedoids', 'reference', _kmedoids_class_engine('lazy'))
+register_engine('KMedoids', 'precomputed', _kmedoids_class_engine('precomputed'))
+register_engine('KMedoids', 'blocked', _kmedoids_class_engine('blocked'))
+if GP is not None:
+    # the fixtures are recorded with george
+    register_engine('gp_model', 'reference', _gp_engine('george'))
+register_engine('gp_model', 'numpy', _gp_engine('numpy'))
+register_engine('gp_model', 'sparse_fitc', _sparse_gp_engine('fitc'), SPARSE_TOLERANCES)
+register_engine('gp_model', 'sparse_vfe', _sparse_gp_engine('vfe'), SPARSE_TOLERANCES)
+
+
+_tc_outputs = {}
+
+
+def _rom_cases(seed):
+    # Thermo-Calc outputs (phase fraction and compositions) at random
+    # temperatures and carbon contents, the batch of 5 avoids the (4, 4)
+    # input that the models read as transposed
+    if seed not in _tc_outputs:
+        from CC_CC_optimization import TC_GP
+        rng = np.random.RandomState(seed)
+        x = np.column_stack((rng.uniform(650, 850, 6), rng.uniform(0, 1, 6)))
+        _tc_outputs[seed] = TC_GP().predict(x)
+    tc_out = _tc_outputs[seed]
+    return [('single', {'x': tc_out[0:1], 'ep': np.float64(0.009)}),
+            ('batch', {'x': tc_out[1:6], 'ep': np.float64(0.009)})]
+
+
+def _reification_cases(seed):
+    rng = np.random.RandomState(seed)
+    cases = []
+    for name, points in [('small', 20), ('fused_points', 427)]:
+        y = rng.normal(10, 3, (3, points))
+        y[1] += rng.normal(0, 0.5, points)
+        sig = rng.uniform(0.05, 2.0, (3, points))
+        cases.append((name, {'y': y, 'sig': sig}))
+    return cases
+
+
+def _knowledge_gradient_cases(seed):
+    rng = np.random.RandomState(seed)
+    cases = []
+    for name, M in [('small', 10), ('samples', 60)]:
+        mu = rng.normal(0, 1, M)
+        # the drivers pass the diagonal covariance of the fused GP
+        sigma = np.diag(rng.uniform(0.01, 1.0, M))
+        cases.append((name + '_diagonal', {'M': np.int64(M), 'sn': np.float64(0.1),
+                                           'mu': mu, 'sigma': sigma}))
+        A = rng.normal(0, 1, (M, M))
+        sigma = A@A.T/M + 0.01*np.eye(M)
+        cases.append((name + '_full', {'M': np.int64(M), 'sn': np.float64(0.1),
+                                       'mu': mu, 'sigma': sigma}))
+    return cases
+
+
+def _medoid_cases(seed):
+    # the points are stored rather than the distance matrix to keep the
+    # fixtures small, the engines find the distances
+    rng = np.random.RandomState(seed)
+    cases = []
+    for name, points, k in [('small', 60, 3), ('medium', 400, 8)]:
+        centres = rng.uniform(0, 10, (k, 3))
+        X = centres[rng.randint(0, k, points)] + rng.normal(0, 0.7, (points, 3))
+        cases.append((name, {'X': X, 'k': np.int64(k),
+                             'seed': np.int64(seed)}))
+    return cases
+
+
+def _gp_cases(seed):
+    rng = np.random.RandomState(seed)
+    cases = []
+    for kern in ['SE', 'M32', 'M52']:
+        x = rng.uniform(0, 1, (30, 2))
+        y = np.sin(4*x[:,0]) + x[:,1]**2 + rng.normal(0, 0.05, 30)
+        cases.append((kern, {'x': x, 'y': y, 'x_test': rng.uniform(0, 1, (10, 2)),
+                             'l_param': np.array([0.3, 0.5]), 'sf': np.float64(1.3),
+                             'sn': np.float64(0.05), 'kern': np.array(kern)}))
+    return cases
+
+
+CASES = {
+    'isostrain_IS': _rom_cases,
+    'isostress_IS': _rom_cases,
+    'isowork_IS': _rom_cases,
+    'reification': _reification_cases,
+    'knowledge_gradient': _knowledge_gradient_cases,
+    'kMedoids': _medoid_cases,
+    'fastPAM': _medoid_cases,
+    'KMedoids': _medoid_cases,
+    'gp_model': _gp_cases,
+}
+
+
+def fixture_path(function):
+    return os.path.join(GOLDEN_DIR, '{}.v{}.npz'.format(function, GOLDEN_VERSION))
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))
+                                       ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _run(engine, inputs, repeats):
+    times = []
+    for i in range(repeats):
+        start = perf_counter()
+        outputs = engine(inputs)
+        times.append(perf_counter()-start)
+    return outputs, min(times)
+
+
+def record(function, seed=0, repeats=1):
+    """
+    Run the reference engine of function on its seeded cases and write the
+    inputs, outputs and times to the fixture file.
+    """
+    arrays = {}
+    cases = CASES[function](seed)
+    for case, inputs in cases:
+        outputs, elapsed = _run(ENGINES[function]['reference'], inputs, repeats)
+        for name in inputs:
+            arrays['{}/in/{}'.format(case, name)] = np.asarray(inputs[name])
+        for name in outputs:
+            arrays['{}/out/{}'.format(case, name)] = np.asarray(outputs[name])
+        arrays['{}/time'.format(case)] = np.float64(elapsed)
+    meta = {'function': function,
+            'version': GOLDEN_VERSION,
+            'seed': seed,
+            'cases': [case for case, inputs in cases],
+            'commit': _git_commit(),
+            'numpy': np.__version__,
+            'date': dt.datetime.now().isoformat()}
+    arrays['meta'] = np.array(json.dumps(meta))
+    os.makedirs(GOLDEN_DIR, exist_ok=True)
+    np.savez_compressed(fixture_path(function), **arrays)
+    return meta
+
+
+def load_fixture(function):
+    """
+    Returns the metadata and a list of (case, inputs, outputs, time) of the
+    fixture of function.
+    """
+    with np.load(fixture_path(function)) as data:
+        meta = json.loads(str(data['meta']))
+        if meta['version'] != GOLDEN_VERSION:
+            raise ValueError('{} has version {}, expected {}'.format(
+                fixture_path(function), meta['version'], GOLDEN_VERSION))
+        cases = []
+        for case in meta['cases']:
+            inputs = {}
+            outputs = {}
+            for key in data.files:
+                if key.startswith(case + '/in/'):
+                    inputs[key[len(case)+4:]] = data[key]
+                elif key.startswith(case + '/out/'):
+                    outputs[key[len(case)+5:]] = data[key]
+            cases.append((case, inputs, outputs, float(data[case + '/time'])))
+    return meta, cases
+
+
+def compare(function, golden, outputs, tol=None):
+    """
+    Compare the outputs of an engine with the golden outputs, with the
+    tolerances tol (by default those of function). Returns (passed, largest
+    absolute error, largest relative error).
+    """
+    tol = TOLERANCES[function] if tol is None else tol
+    passed = True
+    max_abs = 0.0
+    max_rel = 0.0
+    for name in golden:
+        if name in tol.get('skip', []):
+            continue
+        if name not in outputs:
+            return False, np.inf, np.inf
+        expected = np.asarray(golden[name], dtype=np.float64)
+        actual = np.asarray(outputs[name], dtype=np.float64)
+        if expected.shape != actual.shape:
+            return False, np.inf, np.inf
+        error = np.abs(actual - expected)
+        if error.size > 0:
+            max_abs = max(max_abs, float(np.max(error)))
+            max_rel = max(max_rel, float(np.max(error/np.maximum(np.abs(expected), 1e-300))))
+        if name in tol['exact']:
+            passed = passed and np.array_equal(actual, expected)
+        elif name in tol.get('at_most', []):
+            passed = passed and bool(np.all(actual <= expected + tol['atol'] + 
+                                                      tol['rtol']*np.abs(expected)))
+        else:
+            passed = passed and bool(np.all(error <= tol['atol'] + tol['rtol']*np.abs(expected)))
+    return passed, max_abs, max_rel
+
+
+def check(function, engines=None, repeats=3):
+    """
+    Check the engines of function (all of them by default) against the
+    fixture. Returns one result per engine and case with the errors, whether
+    it passed, its time and its speed-up over the reference engine.
+    """
+    meta, cases = load_fixture(function)
+    if engines is None:
+        engines = list(ENGINES[function])
+    results = []
+    for case, inputs, golden, recorded_time in cases:
+        reference_time = None
+        for name in engines:
+            outputs, elapsed = _run(ENGINES[function][name], inputs, repeats)
+            passed, max_abs, max_rel = compare(function, golden, outputs,
+                                               ENGINE_TOLERANCES[function].get(name))
+            if name == 'reference':
+                reference_time = elapsed
+            results.append({'function': function,
+                            'case': case,
+                            'engine': name,
+                            'passed': passed,
+                            'max_abs_error': max_abs,
+                            'max_rel_error': max_rel,
+                            'time': elapsed,
+                            'recorded_time': recorded_time})
+        for result in results:
+            if result['case'] == case and result['function'] == function:
+                base = reference_time if reference_time is not None else recorded_time
+                result['speedup'] = base/result['time'] if result['time'] > 0 else None
+    return results
+
+
+def _repeats(function, repeats):
+    # the reduced order models take about a second per point
+    return 1 if function.endswith('_IS') else repeats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Golden-output regression harness')
+    parser.add_argument('command', choices=['record', 'check'])
+    parser.add_argument('--functions', default=','.join(TOLERANCES),
+                        help='functions to record or check (comma separated)')
+    parser.add_argument('--engines', default=None,
+                        help='engines to check (comma separated), all by default')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeats', type=int, default=3,
+                        help='number of timed runs of each engine (the fastest is used)')
+    parser.add_argument('--output', default=None,
+                        help='JSON file for the results of check')
+    args = parser.parse_args(sys.argv[1:])
+    functions = [f for f in args.functions.split(',') if f != '']
+
+    if args.command == 'record':
+        for function in functions:
+            meta = record(function, args.seed, _repeats(function, args.repeats))
+            print("Recorded {} ({} cases) to {}".format(function, len(meta['cases']),
+                                                       fixture_path(function)))
+        sys.exit(0)
+
+    engines = args.engines.split(',') if args.engines is not None else None
+    results = []
+    print("{:<20}{:<18}{:<14}{:<8}{:>12}{:>12}{:>12}{:>10}".format(
+        'function', 'case', 'engine', 'passed', 'abs error', 'rel error',
+        'time (s)', 'speedup'))
+    for function in functions:
+        function_engines = None
+        if engines is not None:
+            function_engines = [e for e in engines if e in ENGINES[function]]
+        for result in check(function, function_engines, _repeats(function, args.repeats)):
+            results.append(result)
+            print("{:<20}{:<18}{:<14}{:<8}{:>12.3e}{:>12.3e}{:>12.4f}{:>10.2f}".format(
+                result['function'], result['case'], result['engine'],
+                str(result['passed']), result['max_abs_error'],
+                result['max_rel_error'], result['time'], result['speedup'] or 0.0))
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+    sys.exit(0 if all([r['passed'] for r in results]) else 1)
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""
+Pruning of the hyper-parameter sets of the fused GP by their likelihood.
+
+Every knowledge gradient task builds the fused GP with one of the hp_count
+hyper-parameter sets, so the work is proportional to hp_count, although
+some of the sets fit the reified data very badly. Once per iteration the
+log marginal likelihood of each set is calculated on the training points of
+the fused GP (the reified mean at every 12th of the first 400 fused model
+points, as in create_fused_GP). The reification is done once, and each set
+only costs the factorisation of a GP on these few points. The sets whose log
+likelihood is more than threshold below the best are not used by the tasks
+of the iteration, so the work follows the number of plausible sets. The
+sets themselves are kept, a set pruned in one iteration can be used again
+in a later one.
+"""
+
+import numpy as np
+from copy import deepcopy
+from functions import gp_model
+
+
+def hp_log_likelihoods(model_control, x_fused, fused_model_HP, kernel):
+    """
+    The log marginal likelihood of the fused GP training data with each of
+    the hyper-parameter sets, -inf for a set that fails to factorise.
+    """
+    model = deepcopy(model_control)
+    hp = fused_model_HP[0]
+    fused = model.create_fused_GP(x_fused, hp[0:2], hp[2], 0.1, kernel)
+    log_likelihood = np.zeros(fused_model_HP.shape[0])
+    for i, hp in enumerate(fused_model_HP):
+        try:
+            gp = gp_model(fused.x_train, fused.y_train, hp[0:2], hp[2], fused.sigma_n,
+                          fused.n_dim, kernel)
+            log_likelihood[i] = gp.log_likelihood()
+        except np.linalg.LinAlgError:
+            log_likelihood[i] = -np.inf
+    return log_likelihood
+
+
+def prune_hyper_parameters(model_control, x_fused, fused_model_HP, kernel, threshold):
+    """
+    The indices (in increasing order) of the hyper-parameter sets whose log
+    likelihood is within threshold of the best, and the log likelihoods.
+    """
+    log_likelihood = hp_log_likelihoods(model_control, x_fused, fused_model_HP, kernel)
+    log_likelihood[np.isnan(log_likelihood)] = -np.inf
+    keep = np.nonzero(log_likelihood >= np.max(log_likelihood) - threshold)[0]
+    return keep, log_likelihood
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+Timing of the phases of the optimization loop.
+
+The wall time and the CPU time of this process are recorded separately for
+each named phase of an iteration (a phase can be entered several times, the
+times are added up). At the end of every iteration one JSON object is
+appended to the trace file, for example
+
+    {"iteration": 3, "wall": {"sampling": 0.002, ...}, "cpu": {...},
+     "calls": {...}, "total_wall": 12.1, "total_cpu": 11.8, "kg": {...}}
+
+so the trace can be read with
+
+    [json.loads(line) for line in open('results/<date>/<name>_trace.jsonl')]
+"""
+
+import json
+from time import perf_counter, process_time
+from contextlib import contextmanager
+
+
+class phase_timer:
+    """
+    Collects the phase times of the current iteration and writes them to
+    path (a JSON lines file) when end_iteration is called. With path=None
+    the records are only returned, with enabled=False the phases are not
+    timed and nothing is written.
+    """
+    def __init__(self, path, enabled=True, append=False):
+        self.path = path
+        self.enabled = enabled
+        self.carried = {}
+        self._reset()
+        if self.enabled and (self.path is not None) and not append:
+            open(self.path, 'w').close()
+
+    def _reset(self):
+        self.wall = {}
+        self.cpu = {}
+        self.calls = {}
+        self.start_wall = perf_counter()
+        self.start_cpu = process_time()
+
+    def add(self, name, wall, cpu=0.0):
+        """
+        Add time measured elsewhere (for example by the workers) to a phase.
+        """
+        if not self.enabled:
+            return
+        self.wall[name] = self.wall.get(name, 0.0) + wall
+        self.cpu[name] = self.cpu.get(name, 0.0) + cpu
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+    @contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+        start_wall = perf_counter()
+        start_cpu = process_time()
+        try:
+            yield
+        finally:
+            self.add(name, perf_counter()-start_wall, process_time()-start_cpu)
+
+    @contextmanager
+    def carried_phase(self, name):
+        """
+        A phase that runs after the record of the iteration has been written
+        (the checkpoint, which has to hold the size of the trace file). Its
+        time is stored in the record of the next iteration as previous_<name>.
+        """
+        if not self.enabled:
+            yield
+            return
+        start_wall = perf_counter()
+        start_cpu = process_time()
+        try:
+            yield
+        finally:
+            self.carried[name] = (perf_counter()-start_wall, process_time()-start_cpu)
+
+    def end_iteration(self, iteration, **extra):
+        """
+        Append the record of the iteration to the trace file and start the
+        next one. Any extra keyword arguments are stored in the record, they
+        must be serializable to JSON. Returns the record.
+        """
+        if not self.enabled:
+            return None
+        record = {'iteration': iteration,
+                  'wall': self.wall,
+                  'cpu': self.cpu,
+                  'calls': self.calls,
+                  'total_wall': perf_counter()-self.start_wall,
+                  'total_cpu': process_time()-self.start_cpu}
+        for name in self.carried:
+            record['wall']['previous_' + name] = self.carried[name][0]
+            record['cpu']['previous_' + name] = self.carried[name][1]
+        record.update(extra)
+        if self.path is not None:
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(record) + "\n")
+        self.carried = {}
+        self._reset()
+        return record
+
+
+def kg_trace(kg_report):
+    """
+    The parts of a knowledge gradient throughput report that go in the
+    trace: the stage times (startup, enqueue, collect and shutdown), the time
+    spent by all the workers on the tasks and the task counts and latencies
+    of each worker.
+    """
+    workers = {}
+    for name, stats in kg_report['worker_stats'].items():
+        workers[name] = {'chunks': stats['chunks'],
+                         'tasks': stats['tasks'],
+                         'busy': stats['busy'],
+                         'cpu': stats['cpu'],
+                         'max_chunk_time': stats['max_chunk_time'],
+                         'task_latency': stats['busy']/stats['tasks'] if stats['tasks'] > 0 else None}
+    return {'backend': kg_report['backend'],
+            'workers': kg_report['workers'],
+            'blas_threads': kg_report['blas_threads'],
+            'tasks': kg_report['tasks'],
+            'wall_time': kg_report['wall_time'],
+            'stage_times': kg_report['stage_times'],
+            'worker_compute': {'wall': sum([w['busy'] for w in workers.values()]),
+                               'cpu': sum([w['cpu'] for w in workers.values()])},
+            'worker_stats': workers}
@@ -0,0 +1,474 @@
+# -*- coding: utf-8 -*-
+"""
+Chunked dispatch of the knowledge gradient tasks in the batch optimization
+drivers.
+
+A single task is one (jj, kk, mm) triple: the low order model jj is updated
+with candidate kk and the fused GP is built with hyper-parameter set mm. The
+tasks are numbered in the order jj -> kk -> mm, so a chunk of consecutive task
+numbers [start, stop) is a block of candidates x hyper-parameter sets. Each
+worker only updates the low order model once per candidate in the block, and
+only the two task numbers travel through the queue. The workers can be
+processes, threads or the calling process itself (see run_kg_tasks).
+"""
+
+import numpy as np
+import random
+import multiprocessing
+import threading
+import queue
+from copy import deepcopy
+from math import ceil
+from time import time, process_time, thread_time
+from functions import knowledge_gradient
+from thread_governor import limit_threads, available_cores
+
+# The knowledge gradient output for a single task. nu is the log knowledge
+# gradient divided by the model cost and x_star is the index of the test
+# sample with the highest knowledge gradient, at (temperature, carbon).
+KG_OUTPUT_DTYPE = np.dtype([('max_mean', np.float64),
+                            ('max_x0', np.float64),
+                            ('max_x1', np.float64),
+                            ('nu', np.float64),
+                            ('x_star', np.int64),
+                            ('model', np.int64),
+                            ('sample', np.int64),
+                            ('hp', np.int64),
+                            ('temperature', np.float64),
+                            ('carbon', np.float64)])
+
+
+class kg_context:
+    """
+    The data shared by all the tasks of one iteration. This is given to the
+    workers once when they are started, rather than with every task.
+    """
+    def __init__(self, model_control, x_fused, fused_model_HP, kernel, x_test,
+                 new_mean, true_sample_count, seed=None):
+        self.model_control = model_control
+        self.x_fused = x_fused
+        self.fused_model_HP = fused_model_HP
+        self.kernel = kernel
+        self.x_test = x_test
+        self.new_mean = new_mean
+        self.true_sample_count = true_sample_count
+        self.hp_count = fused_model_HP.shape[0]
+        self.num_tasks = 3*true_sample_count*self.hp_count
+        # SeedSequence of the iteration, each worker process seeds its random
+        # state from its own child of this sequence
+        self.seed = seed
+
+    def task_index(self, task):
+        """
+        Convert a task number into the (jj, kk, mm) triple.
+        """
+        jk, mm = divmod(task, self.hp_count)
+        jj, kk = divmod(jk, self.true_sample_count)
+        return jj, kk, mm
+
+
+# cost of a call to each of the low order models, the knowledge gradient is
+# divided by it
+KG_MODEL_COST = [0.246179, 0.890249,  1.827838]
+
+
+def updated_model(context, jj, kk):
+    """
+    A copy of the reification models with low order model jj updated with
+    candidate kk at its predicted value.
+    """
+    model_temp = deepcopy(context.model_control)
+    model_temp.update_GP(np.expand_dims(context.x_test[kk], axis=0),
+                         np.expand_dims(np.array([context.new_mean[jj][kk]]),
+                                        axis=0), jj)
+    return model_temp
+
+
+def calculate_task(context, model_temp, jj, kk, mm, output):
+    """
+    The knowledge gradient choice of the task (jj, kk, mm), model_temp being
+    the models given by updated_model(context, jj, kk). The result is written
+    to output, a KG_OUTPUT_DTYPE row.
+    """
+    x_test = context.x_test
+    fused_model_HP = context.fused_model_HP[mm,:]
+    output['model'] = jj
+    output['sample'] = kk
+    output['hp'] = mm
+    model_temp.create_fused_GP(context.x_fused, fused_model_HP[0:2],
+                               fused_model_HP[2], 0.1,
+                               context.kernel)
+    fused_mean, fused_var = model_temp.predict_fused_GP(x_test)
+
+    index_max = np.argmax(fused_mean)
+    output['max_mean'] = fused_mean[index_max]
+    output['max_x0'] = x_test[index_max,0]
+    output['max_x1'] = x_test[index_max,1]
+
+    nu_star, x_star, NU = knowledge_gradient(context.true_sample_count,
+                                              0.1,
+                                              fused_mean,
+                                              fused_var)
+    output['nu'] = nu_star/KG_MODEL_COST[jj]
+    output['x_star'] = x_star
+    output['temperature'] = x_test[x_star,0]*200 + 650
+    output['carbon'] = x_test[x_star,1]
+
+
+def calculate_chunk(context, start, stop):
+    """
+    Calculate the knowledge gradient choice for every task in the chunk
+    [start, stop). The low order model is only updated when the (jj, kk) pair
+    changes. The output is a KG_OUTPUT_DTYPE array with one row per task.
+    """
+    outputs = np.zeros(stop-start, dtype=KG_OUTPUT_DTYPE)
+    current = None
+    for task in range(start, stop):
+        jj, kk, mm = context.task_index(task)
+        if current != (jj, kk):
+            model_temp = updated_model(context, jj, kk)
+            current = (jj, kk)
+        calculate_task(context, model_temp, jj, kk, mm, outputs[task-start])
+    return outputs
+
+
+def worker_seed(seed, worker):
+    """
+    The SeedSequence of a worker, derived from the SeedSequence of the
+    iteration and the worker number.
+    """
+    return np.random.SeedSequence(seed.entropy, spawn_key=tuple(seed.spawn_key) + (worker,))
+
+
+def calculate(process_name, context, tasks, results, blas_threads=None, seed=None):
+    # this worker will calculate the knowledge gradient choice for each chunk
+    # of tasks taken from the queue until it receives None. The CPU time of a
+    # worker thread is its own thread time, a worker process uses the time of
+    # the whole process. A worker process with a seed does not keep the random
+    # state copied from the parent, so no two workers draw the same numbers
+    if seed is not None:
+        np.random.seed(seed.generate_state(4))
+        random.seed(int(seed.generate_state(1)[0]))
+    if threading.current_thread() is threading.main_thread():
+        cpu_time = process_time
+    else:
+        cpu_time = thread_time
+    with limit_threads(blas_threads):
+        while True:
+            chunk = tasks.get()
+            if chunk is None:
+                results.put((process_name, -1, -1, 0, 0, None))
+                break
+            start, stop = chunk
+            start_chunk = time()
+            start_cpu = cpu_time()
+            outputs = calculate_chunk(context, start, stop)
+            results.put((process_name, start, stop, time()-start_chunk, 
+                         cpu_time()-start_cpu, outputs))
+
+
+def _new_worker_stats():
+    return {'chunks': 0, 'tasks': 0, 'busy': 0.0, 'cpu': 0.0, 
+            'max_chunk_time': 0.0}
+
+
+def _record_chunk(stats, task_count, elapsed, cpu):
+    stats['chunks'] += 1
+    stats['tasks'] += task_count
+    stats['busy'] += elapsed
+    stats['cpu'] += cpu
+    stats['max_chunk_time'] = max(stats['max_chunk_time'], elapsed)
+
+
+class chunk_scheduler:
+    """
+    Decides how many tasks go into each chunk.
+
+    With chunk_size='auto' the size is chosen so that one chunk takes about
+    target_time seconds, using a running estimate of the time per task. The
+    size is also capped at a fraction of the remaining work divided between
+    the workers (guided scheduling), so the chunks shrink towards the end of
+    the iteration and the idle workers pick up the last small chunks from the
+    shared queue while the others finish, so that all the workers finish
+    together. The latency estimate is kept between iterations.
+    """
+    def __init__(self, num_workers, chunk_size='auto', target_time=0.5,
+                 initial_chunk=4, min_chunk=1, max_chunk=None, smoothing=0.3):
+        self.num_workers = num_workers
+        self.chunk_size = chunk_size
+        self.target_time = target_time
+        self.initial_chunk = initial_chunk
+        self.min_chunk = min_chunk
+        self.max_chunk = max_chunk
+        self.smoothing = smoothing
+        self.latency = None
+        self.num_tasks = 0
+        self.next_task = 0
+
+    def start(self, num_tasks):
+        self.num_tasks = num_tasks
+        self.next_task = 0
+
+    def remaining(self):
+        return self.num_tasks - self.next_task
+
+    def chunk_length(self):
+        remaining = self.remaining()
+        if self.chunk_size != 'auto':
+            return min(int(self.chunk_size), remaining)
+        if self.latency is None:
+            size = self.initial_chunk
+        else:
+            size = int(self.target_time/max(self.latency, 1e-9))
+        if self.max_chunk is not None:
+            size = min(size, self.max_chunk)
+        size = min(size, ceil(remaining/(2*self.num_workers)))
+        return min(max(size, self.min_chunk), remaining)
+
+    def next_chunk(self):
+        if self.remaining() <= 0:
+            return None
+        start = self.next_task
+        self.next_task += self.chunk_length()
+        return start, self.next_task
+
+    def record(self, task_count, elapsed):
+        """
+        Update the estimate of the time taken per task from a completed chunk.
+        """
+        if task_count <= 0:
+            return
+        latency = elapsed/task_count
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency = (1-self.smoothing)*self.latency + self.smoothing*latency
+
+
+def _run_serial(context, scheduler):
+    kg_output = np.zeros(context.num_tasks, dtype=KG_OUTPUT_DTYPE)
+    worker_stats = {'S0': _new_worker_stats()}
+    scheduler.start(context.num_tasks)
+    chunk = scheduler.next_chunk()
+    while chunk is not None:
+        start, stop = chunk
+        start_chunk = time()
+        start_cpu = process_time()
+        kg_output[start:stop] = calculate_chunk(context, start, stop)
+        elapsed = time()-start_chunk
+        scheduler.record(stop-start, elapsed)
+        _record_chunk(worker_stats['S0'], stop-start, elapsed, 
+                      process_time()-start_cpu)
+        chunk = scheduler.next_chunk()
+    return kg_output, worker_stats, {}
+
+
+def _run_queue(context, num_workers, scheduler, backend, blas_threads, prefetch):
+    if backend == 'processes':
+        # each process holds its own copy of the context and sets its own
+        # BLAS thread limit
+        tasks = multiprocessing.Queue()
+        results = multiprocessing.Queue()
+        worker_type = multiprocessing.Process
+        worker_blas_threads = blas_threads
+    else:
+        # the threads share the context, nothing is pickled, and the BLAS
+        # thread limit is set once for the whole process by the caller
+        tasks = queue.Queue()
+        results = queue.Queue()
+        worker_type = threading.Thread
+        worker_blas_threads = None
+
+    # time spent by this process starting the workers, putting chunks on the
+    # task queue, waiting for and storing the results, and stopping the workers
+    stage_times = {'startup': 0.0, 'enqueue': 0.0, 'collect': 0.0, 'shutdown': 0.0}
+    start_phase = time()
+    workers = []
+    worker_stats = {}
+    for i in range(num_workers):
+        worker_name = '%s%i' % (backend[0].upper(), i)
+        if backend == 'processes' and context.seed is not None:
+            seed = worker_seed(context.seed, i)
+        else:
+            seed = None
+        new_worker = worker_type(target=calculate,
+                                 args=(worker_name, context, tasks, results,
+                                       worker_blas_threads, seed))
+        new_worker.daemon = True
+        workers.append(new_worker)
+        worker_stats[worker_name] = _new_worker_stats()
+        new_worker.start()
+    stage_times['startup'] = time()-start_phase
+
+    start_phase = time()
+    scheduler.start(context.num_tasks)
+    outstanding = 0
+    for i in range(prefetch*num_workers):
+        chunk = scheduler.next_chunk()
+        if chunk is None:
+            break
+        tasks.put(chunk)
+        outstanding += 1
+    if outstanding == 0:
+        # nothing to do, so stop the workers straight away
+        for i in range(num_workers):
+            tasks.put(None)
+    stage_times['enqueue'] += time()-start_phase
+
+    kg_output = np.zeros(context.num_tasks, dtype=KG_OUTPUT_DTYPE)
+    num_finished_workers = 0
+    while num_finished_workers < num_workers:
+        start_phase = time()
+        try:
+            worker_name, start, stop, elapsed, cpu, outputs = results.get(timeout=5)
+        except queue.Empty:
+            stage_times['collect'] += time()-start_phase
+            if not all([w.is_alive() for w in workers]):
+                for w in workers:
+                    if backend == 'processes':
+                        w.terminate()
+                    else:
+                        tasks.put(None)
+                raise RuntimeError('A knowledge gradient worker stopped unexpectedly')
+            continue
+        if start < 0:
+            # Worker has finished
+            num_finished_workers += 1
+            stage_times['collect'] += time()-start_phase
+            continue
+        kg_output[start:stop] = outputs
+        scheduler.record(stop-start, elapsed)
+        _record_chunk(worker_stats[worker_name], stop-start, elapsed, cpu)
+        outstanding -= 1
+        stage_times['collect'] += time()-start_phase
+        start_phase = time()
+        chunk = scheduler.next_chunk()
+        if chunk is not None:
+            tasks.put(chunk)
+            outstanding += 1
+        elif outstanding == 0:
+            # Quit the workers by sending them None
+            for i in range(num_workers):
+                tasks.put(None)
+        stage_times['enqueue'] += time()-start_phase
+
+    start_phase = time()
+    for w in workers:
+        w.join()
+    stage_times['shutdown'] = time()-start_phase
+
+    return kg_output, worker_stats, stage_times
+
+
+class kg_turns:
+    """
+    First come, first served turns at the knowledge gradient workers, shared
+    by campaigns running in separate processes (see campaigns.py). A campaign
+    calls acquire before its knowledge gradient stage and release after it,
+    so the stages of the campaigns use all the cores one after another, in
+    the order they became ready, while the other campaigns get on with their
+    model evaluations and updates. It has to be created before the campaign
+    processes are started.
+    """
+    def __init__(self):
+        self.condition = multiprocessing.Condition()
+        self.next_ticket = multiprocessing.RawValue('l', 0)
+        self.now_serving = multiprocessing.RawValue('l', 0)
+
+    def acquire(self):
+        with self.condition:
+            ticket = self.next_ticket.value
+            self.next_ticket.value += 1
+            while self.now_serving.value != ticket:
+                self.condition.wait()
+
+    def release(self):
+        with self.condition:
+            self.now_serving.value += 1
+            self.condition.notify_all()
+
+
+def run_kg_tasks(context, num_workers, scheduler, backend='processes',
+                 blas_threads=None, prefetch=2):
+    """
+    Calculate all the knowledge gradient tasks of the iteration with one of
+    the execution backends:
+        'processes': worker processes, each given a copy of the context
+        'threads': worker threads sharing the context in this process, for
+                   when the NumPy/LAPACK and george routines release the GIL
+        'serial': all the chunks in this process, one after another
+    The workers are fed chunks of tasks from a shared queue. At most prefetch
+    chunks per worker are waiting at any time, so the size of the later
+    chunks can follow the measured latency. blas_threads is the number of
+    BLAS/OpenMP threads each worker may use (by default the available cores
+    divided between the workers) so the workers do not oversubscribe the
+    cores.
+
+    Returns the knowledge gradient output for every task as a KG_OUTPUT_DTYPE
+    array (in task order) and the throughput report of the backend, which
+    includes the time spent on each part of the stage and the task counts,
+    busy time, CPU time and longest chunk of every worker.
+    """
+    if backend == 'serial':
+        num_workers = 1
+    elif backend not in ['processes', 'threads']:
+        raise ValueError('Unknown knowledge gradient backend: {}'.format(backend))
+    if blas_threads is None and backend != 'serial':
+        blas_threads = max(1, available_cores()//num_workers)
+
+    start_stage = time()
+    if backend == 'serial':
+        kg_output, worker_stats, stage_times = _run_serial(context, scheduler)
+    elif backend == 'threads':
+        with limit_threads(blas_threads):
+            kg_output, worker_stats, stage_times = _run_queue(context, num_workers, 
+                                                              scheduler, backend, 
+                                                              blas_threads, prefetch)
+    else:
+        kg_output, worker_stats, stage_times = _run_queue(context, num_workers, 
+                                                          scheduler, backend, 
+                                                          blas_threads, prefetch)
+    return kg_output, throughput_report(backend, num_workers, blas_threads,
+                                        worker_stats, time()-start_stage,
+                                        stage_times)
+
+
+def throughput_report(backend, num_workers, blas_threads, worker_stats, wall_time,
+                      stage_times=None):
+    """
+    Summary of one knowledge gradient stage: the tasks completed per second
+    of wall time, and the fraction of the available worker time spent on the
+    tasks (the rest is start-up, communication and waiting).
+    """
+    num_tasks = sum([worker_stats[w]['tasks'] for w in worker_stats])
+    busy = sum([worker_stats[w]['busy'] for w in worker_stats])
+    return {'backend': backend,
+            'workers': num_workers,
+            'blas_threads': blas_threads,
+            'tasks': num_tasks,
+            'wall_time': wall_time,
+            'throughput': num_tasks/wall_time if wall_time > 0 else 0.0,
+            'utilisation': busy/(num_workers*wall_time) if wall_time > 0 else 0.0,
+            'stage_times': stage_times if stage_times is not None else {},
+            'worker_stats': worker_stats}
+
+
+def best_kg_points(kg_output):
+    """
+    Find the hyper-parameter set with the highest knowledge gradient for each
+    (x_star, model) pair. Where several sets give the same value the first
+    one is used.
+
+    Returns the input for the medoid clustering, with one row per pair and
+    the columns [nu, x_star, model, row of kg_output].
+    """
+    keys = kg_output['x_star']*3 + kg_output['model']
+    # sort by pair, then by decreasing nu; lexsort is stable so ties keep
+    # the task order
+    order = np.lexsort((-kg_output['nu'], keys))
+    unique_keys, first = np.unique(keys[order], return_index=True)
+    best = order[first]
+    return np.column_stack((kg_output['nu'][best],
+                            kg_output['x_star'][best],
+                            kg_output['model'][best],
+                            best)).astype(np.float64)
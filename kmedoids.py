@@ -1,17 +1,33 @@
 from scipy.sparse import csr_matrix
+from scipy.spatial.distance import cdist
 import numpy as np
 import random
 
 class KMedoids:
-    def __init__(self, n_cluster=2, max_iter=10, tol=0.1, start_prob=0.8, end_prob=0.99):
-        '''Kmedoids constructor called'''
+    def __init__(self, n_cluster=2, max_iter=10, tol=0.1, start_prob=0.8, end_prob=0.99,
+                 distance='lazy', block_size=1024, random_state=None):
+        '''Kmedoids constructor called
+        
+        distance selects how the distances between the data points are found:
+            'lazy': one pair of rows at a time, when it is needed
+            'precomputed': the full distance matrix is calculated once in fit
+            'blocked': the distances are calculated as arrays, block_size rows
+                       at a time, without storing the full distance matrix
+        random_state is an integer seed for the random initialisation, with
+        None the global state of the random module is used
+        '''
         if start_prob < 0 or start_prob >= 1 or end_prob < 0 or end_prob >= 1 or start_prob > end_prob:
             raise ValueError('Invalid input')
+        if distance not in ['lazy', 'precomputed', 'blocked']:
+            raise ValueError('Invalid distance mode')
         self.n_cluster = n_cluster
         self.max_iter = max_iter
         self.tol = tol
         self.start_prob = start_prob
         self.end_prob = end_prob
+        self.distance = distance
+        self.block_size = block_size
+        self.__random = random if random_state is None else random.Random(random_state)
         
         self.medoids = []
         self.clusters = {}
@@ -22,12 +38,15 @@ class KMedoids:
         self.__is_csr = None
         self.__rows = 0
         self.__columns = 0
+        self.__sq_norms = None
+        self.__distance_matrix = None
         self.cluster_distances = {}
         
         
     def fit(self, data):
         self.__data = data
         self.__set_data_type()     
+        self.__setup_distances()
         self.__start_algo()
         return self
     
@@ -63,6 +82,8 @@ class KMedoids:
         
     def __swap_and_recalculate_clusters(self):
         # http://www.math.le.ac.uk/people/ag153/homepage/KmeansKmedoids/Kmeans_Kmedoids.html
+        if self.distance != 'lazy':
+            return self.__swap_and_recalculate_clusters_array()
         cluster_dist = {}
         for medoid in self.medoids:
             is_shortest_medoid_found = False
@@ -79,6 +100,31 @@ class KMedoids:
                 cluster_dist[medoid] = self.cluster_distances[medoid]
         return cluster_dist
     
+    def __swap_and_recalculate_clusters_array(self):
+        # same as the swap above, with the distances from each member of the
+        # cluster to the other members found one block of members at a time,
+        # the first member that improves on the medoid is used
+        cluster_dist = {}
+        for medoid in self.medoids:
+            members = np.array(self.clusters[medoid])
+            medoid_column = self.clusters[medoid].index(medoid)
+            new_medoid = medoid
+            for start in range(0, len(members), self.block_size):
+                block = members[start:start+self.block_size]
+                dist = self.__distances(block, members)
+                # in the swapped cluster list the member is replaced by the
+                # medoid, so the distance to the medoid is counted twice
+                new_distance = (np.sum(dist, axis=1) + dist[:,medoid_column])/len(members)
+                improved = np.nonzero((block != medoid) & 
+                                      (new_distance < self.cluster_distances[medoid]))[0]
+                if len(improved) > 0:
+                    new_medoid = int(block[improved[0]])
+                    cluster_dist[new_medoid] = new_distance[improved[0]]
+                    break
+            if new_medoid == medoid:
+                cluster_dist[medoid] = self.cluster_distances[medoid]
+        return cluster_dist
+    
     def calculate_inter_cluster_distance(self, medoid, cluster_list):
         distance = 0
         for data_index in cluster_list:
@@ -91,6 +137,15 @@ class KMedoids:
         for medoid in medoids:
             clusters[medoid] = []
             cluster_distances[medoid] = 0
+        
+        if self.distance != 'lazy':
+            medoids = list(medoids)
+            nearest, nearest_distance = self.__nearest_medoids(medoids)
+            for i in range(len(medoids)):
+                members = np.nonzero(nearest == i)[0]
+                clusters[medoids[i]] = members.tolist()
+                cluster_distances[medoids[i]] = np.sum(nearest_distance[members])/len(members)
+            return clusters, cluster_distances
             
         for row in range(self.__rows):
             nearest_medoid, nearest_distance = self.__get_shortest_distance_to_mediod(row, medoids)
@@ -115,11 +170,29 @@ class KMedoids:
 
     def __initialize_medoids(self):
         '''Kmeans++ initialisation'''
-        self.medoids.append(random.randint(0,self.__rows-1))
+        self.medoids.append(self.__random.randint(0,self.__rows-1))
         while len(self.medoids) != self.n_cluster:
             self.medoids.append(self.__find_distant_medoid())
     
+    def __nearest_medoids(self, medoids):
+        '''index (in medoids) of and distance to the nearest medoid of every row'''
+        medoids = list(medoids)
+        nearest = np.zeros(self.__rows, dtype=int)
+        nearest_distance = np.zeros(self.__rows)
+        for start in range(0, self.__rows, self.block_size):
+            rows = np.arange(start, min(start+self.block_size, self.__rows))
+            dist = self.__distances(rows, medoids)
+            nearest[rows] = np.argmin(dist, axis=1)
+            nearest_distance[rows] = dist[np.arange(len(rows)), nearest[rows]]
+        return nearest, nearest_distance
+    
     def __find_distant_medoid(self):
+        if self.distance != 'lazy':
+            indices = list(range(self.__rows))
+            distances = self.__nearest_medoids(self.medoids)[1]
+            distances_index = np.argsort(distances)
+            choosen_dist = self.__select_distant_medoid(distances_index)
+            return indices[choosen_dist]
         distances = []
         indices = []
         for row in range(self.__rows):
@@ -132,7 +205,7 @@ class KMedoids:
     def __select_distant_medoid(self, distances_index):
         start_index = round(self.start_prob*len(distances_index))
         end_index = round(self.end_prob*(len(distances_index)-1)) 
-        return distances_index[random.randint(start_index, end_index)]
+        return distances_index[self.__random.randint(start_index, end_index)]
 
                            
     def __get_distance(self, x1, x2):
@@ -140,8 +213,38 @@ class KMedoids:
         b = self.__data[x2].toarray() if self.__is_csr == True else np.array(self.__data[x2])
         return np.linalg.norm(a-b)
     
+    def __setup_distances(self):
+        '''prepare the data for the array distance calculations'''
+        if self.distance == 'lazy':
+            return
+        if self.__is_csr:
+            # squared norms of the rows, taken directly from the CSR data
+            self.__sq_norms = np.asarray(self.__data.multiply(self.__data).sum(axis=1)).ravel()
+        else:
+            self.__data = np.asarray(self.__data, dtype=float)
+        if self.distance == 'precomputed':
+            all_rows = np.arange(self.__rows)
+            self.__distance_matrix = np.zeros((self.__rows, self.__rows))
+            for start in range(0, self.__rows, self.block_size):
+                rows = all_rows[start:start+self.block_size]
+                self.__distance_matrix[rows,:] = self.__calculate_distances(rows, all_rows)
+    
+    def __distances(self, rows, cols):
+        '''distances between the rows and cols data points as an array'''
+        if self.__distance_matrix is not None:
+            return self.__distance_matrix[np.ix_(rows, cols)]
+        return self.__calculate_distances(rows, cols)
+    
+    def __calculate_distances(self, rows, cols):
+        if self.__is_csr:
+            # |a-b|^2 = |a|^2 + |b|^2 - 2a.b with the products of the sparse rows
+            cross = (self.__data[rows] @ self.__data[cols].T).toarray()
+            sq_dist = self.__sq_norms[rows][:,None] + self.__sq_norms[cols][None,:] - 2*cross
+            return np.sqrt(np.maximum(sq_dist, 0))
+        return cdist(self.__data[rows], self.__data[cols])
+    
     def __set_data_type(self):
-        '''to check whether the given input is of type "list" or "csr" '''
+        '''to check whether the given input is of type "list", "array" or "csr" '''
         if isinstance(self.__data,csr_matrix):
             self.__is_csr = True
             self.__rows = self.__data.shape[0]
@@ -150,12 +253,22 @@ class KMedoids:
             self.__is_csr = False
             self.__rows = len(self.__data)
             self.__columns = len(self.__data[0])
+        elif isinstance(self.__data,np.ndarray) and self.distance != 'lazy':
+            self.__is_csr = False
+            self.__rows = self.__data.shape[0]
+            self.__columns = self.__data.shape[1]
         else:
             raise ValueError('Invalid input')
             
             
 
-def kMedoids(D, k, tmax=100):
+def kMedoids(D, k, tmax=100, random_state=None):
+    # random_state is passed to numpy.random.default_rng for the random
+    # initialisation, with None the global numpy random state is used
+    shuffle = np.random.shuffle
+    if random_state is not None:
+        shuffle = np.random.default_rng(random_state).shuffle
+
     # determine dimensions of distance matrix D
     m, n = D.shape
 
@@ -169,7 +282,7 @@ def kMedoids(D, k, tmax=100):
     rs,cs = np.where(D==0)
     # the rows, cols must be shuffled because we will keep the first duplicate below
     index_shuf = list(range(len(rs)))
-    np.random.shuffle(index_shuf)
+    shuffle(index_shuf)
     rs = rs[index_shuf]
     cs = cs[index_shuf]
     for r,c in zip(rs,cs):
@@ -185,7 +298,7 @@ def kMedoids(D, k, tmax=100):
 
     # randomly initialize an array of k medoid indices
     M = np.array(valid_medoid_inds)
-    np.random.shuffle(M)
+    shuffle(M)
     M = np.sort(M[:k])
 
     # create a copy of the array of medoid indices
@@ -215,4 +328,177 @@ def kMedoids(D, k, tmax=100):
             C[kappa] = np.where(J==kappa)[0]
 
     # return results
-    return M, C
\ No newline at end of file
+    return M, C
+
+def _nearest_two(D, M):
+    # index (in M) of the nearest medoid, the distance to it and the distance
+    # to the second nearest medoid for every point
+    DM = D[:,M]
+    if len(M) == 1:
+        return np.zeros(D.shape[0], dtype=int), DM[:,0], np.full(D.shape[0], np.inf)
+    order = np.argsort(DM, axis=1)[:,0:2]
+    rows = np.arange(D.shape[0])
+    return order[:,0], DM[rows,order[:,0]], DM[rows,order[:,1]]
+
+
+def _clusters(D, M):
+    J = np.argmin(D[:,M], axis=1)
+    C = {}
+    for kappa in range(len(M)):
+        C[kappa] = np.where(J==kappa)[0]
+    return C
+
+
+def fastPAM(D, k, tmax=100, block_size=512):
+    """
+    k-medoids clustering of the points with the distance matrix D using the
+    PAM BUILD initialisation and the FastPAM1 swap of
+    
+    [1] E. Schubert and P. J. Rousseeuw, "Faster k-Medoids Clustering: Improving
+    the PAM, CLARA, and CLARANS Algorithms," SISAP 2019, pp. 171-187.
+    
+    For every candidate point the change in the total distance is found for
+    the swap with all k medoids at once from the distances to the nearest and
+    second nearest medoids: the part that is the same for every medoid is a
+    sum over the points, and the part of each medoid a sum over the points
+    nearest to it (np.bincount over their labels), so each pass over the
+    candidates is O(n^2) rather than the O(k n^2) of PAM. BUILD is O(k n^2).
+    As in FasterPAM the best swap in each block of candidates is made straight
+    away, and the passes are repeated until no swap reduces the total
+    distance. The result does not depend on any random state. The total
+    distance is usually lower than with kMedoids, but as BUILD and the passes
+    cost more than the Voronoi iteration it is also slower.
+    
+    Returns the sorted medoid indices and a dictionary of the points in each
+    cluster, in the same form as kMedoids.
+    """
+    m, n = D.shape
+    if k > n:
+        raise Exception('too many medoids')
+    
+    # BUILD: start from the point with the smallest total distance and add the
+    # point that most reduces the total distance until there are k medoids
+    M = [int(np.argmin(np.sum(D, axis=0)))]
+    nearest_distance = D[:,M[0]].copy()
+    while len(M) < k:
+        gain = np.zeros(n)
+        for start in range(0, n, block_size):
+            cols = slice(start, min(start+block_size, n))
+            gain[cols] = np.sum(np.maximum(nearest_distance[:,None] - D[:,cols], 0), axis=0)
+        gain[M] = -1
+        new_medoid = int(np.argmax(gain))
+        M.append(new_medoid)
+        nearest_distance = np.minimum(nearest_distance, D[:,new_medoid])
+    M = np.array(M)
+    
+    # SWAP: the best swap within each block of candidates is made as soon as
+    # it is found, until a full pass over the candidates finds no improvement
+    for t in range(tmax):
+        swapped = False
+        for start in range(0, n, block_size):
+            nearest, dn, ds = _nearest_two(D, M)
+            cols = np.arange(start, min(start+block_size, n))
+            d = D[:,cols].T
+            # change for the points that do not belong to the removed medoid
+            base = np.minimum(d - dn, 0)
+            # extra change for the points that belong to the removed medoid,
+            # summed into the medoid of each point
+            extra = np.minimum(ds, d) - dn - base
+            labels = nearest[None,:] + k*np.arange(cols.shape[0])[:,None]
+            change = np.sum(base, axis=1)[:,None] + \
+                     np.bincount(labels.ravel(), weights=extra.ravel(), 
+                                 minlength=cols.shape[0]*k).reshape(-1, k)
+            change[np.isin(cols, M),:] = 0
+            index = np.unravel_index(np.argmin(change), change.shape)
+            if change[index] < -1e-12:
+                M[index[1]] = cols[index[0]]
+                swapped = True
+        if not swapped:
+            break
+    
+    M = np.sort(M)
+    return M, _clusters(D, M)
+
+
+def clara(X, k, sample_size=None, num_samples=5, tmax=100, refine_iter=5, 
+          refine_candidates=300, block_size=4096, random_state=None):
+    """
+    CLARA style k-medoids for large inputs. FastPAM is run on num_samples
+    random subsets of sample_size points (by default 250+4k) and the medoids
+    giving the smallest total distance over all the points are used. The best
+    medoids found so far are included in each following subset. The medoids
+    are then refined for up to refine_iter iterations by testing up to
+    refine_candidates random members of each cluster as its new medoid against
+    all the members of the cluster. Only the distances between the points of a
+    subset and from all points to a few candidate medoids are calculated.
+    
+    random_state is passed to numpy.random.default_rng so a fixed seed gives
+    the same clusters every time.
+    
+    Returns the sorted medoid indices and a dictionary of the points in each
+    cluster, in the same form as kMedoids.
+    """
+    rng = np.random.default_rng(random_state)
+    X = np.asarray(X, dtype=float)
+    n = X.shape[0]
+    if k > n:
+        raise Exception('too many medoids')
+    if sample_size is None:
+        sample_size = 250 + 4*k
+    sample_size = max(min(sample_size, n), k)
+    
+    def assign(M):
+        nearest = np.zeros(n, dtype=int)
+        cost = 0
+        for start in range(0, n, block_size):
+            d = cdist(X[start:start+block_size], X[M])
+            nearest[start:start+block_size] = np.argmin(d, axis=1)
+            cost += np.sum(np.min(d, axis=1))
+        return nearest, cost
+    
+    best_M = None
+    best_cost = np.inf
+    for s in range(num_samples):
+        if best_M is None:
+            sample = rng.choice(n, sample_size, replace=False)
+        else:
+            others = np.setdiff1d(np.arange(n), best_M)
+            sample = np.concatenate((best_M, rng.choice(others, sample_size-k, replace=False)))
+        M, C = fastPAM(cdist(X[sample], X[sample]), k, tmax)
+        M = np.sort(sample[M])
+        nearest, cost = assign(M)
+        if cost < best_cost:
+            best_M, best_cost, best_nearest = M, cost, nearest
+        if sample_size == n:
+            break
+    
+    # refine the medoids with the members of their clusters
+    M = best_M.copy()
+    for t in range(refine_iter):
+        changed = False
+        for kappa in range(k):
+            members = np.where(best_nearest==kappa)[0]
+            if len(members) > refine_candidates:
+                candidates = np.append(rng.choice(members, refine_candidates, replace=False), M[kappa])
+            else:
+                candidates = members
+            cost = np.zeros(len(candidates))
+            for start in range(0, len(members), block_size):
+                cost += np.sum(cdist(X[candidates], X[members[start:start+block_size]]), axis=1)
+            new_medoid = candidates[np.argmin(cost)]
+            if new_medoid != M[kappa]:
+                M[kappa] = new_medoid
+                changed = True
+        if not changed:
+            break
+        M = np.sort(M)
+        nearest, cost = assign(M)
+        if cost < best_cost:
+            best_M, best_cost, best_nearest = M.copy(), cost, nearest
+        else:
+            break
+    
+    C = {}
+    for kappa in range(k):
+        C[kappa] = np.where(best_nearest==kappa)[0]
+    return best_M, C
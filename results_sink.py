@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""
+Buffered writer for the results tables of the optimization drivers.
+
+Records are kept in memory and written to disk in batches, so the loop does
+not open and close a file for every medoid. Each table is stored as a typed
+structured array in a .npy file that new records are appended to; the shape
+in the header is rewritten after every flush, so the file can always be read
+with np.load (or load_table) and the columns accessed by name, for example
+
+    data = load_table('results/<date>/<name>_iteration_data.npy')
+    data['Model Out'][data['Model'] == 3]
+
+The tables can also be exported to the original CSV files with trailing
+commas, either instead of or as well as the .npy files.
+"""
+
+import os
+import ast
+import numpy as np
+
+# .npy format 1.0: magic string, version, header length (uint16) and a header
+# padded with spaces so the shape can grow without moving the data
+_MAGIC = b'\x93NUMPY\x01\x00'
+_HEADER_LENGTH = 1024
+
+
+def _header(dtype, length):
+    header = "{{'descr': {!r}, 'fortran_order': False, 'shape': ({},), }}".format(
+        np.lib.format.dtype_to_descr(dtype), length)
+    padding = _HEADER_LENGTH - len(_MAGIC) - 2 - len(header) - 1
+    if padding < 0:
+        raise ValueError('Table dtype is too long for the .npy header')
+    return (_MAGIC + np.uint16(_HEADER_LENGTH - len(_MAGIC) - 2).tobytes() +
+            header.encode('latin1') + b' '*padding + b'\n')
+
+
+def _value(value):
+    # single element arrays (for example the [[y]] returned by a GP
+    # prediction) are stored as the element
+    value = np.asarray(value)
+    if value.size == 1:
+        return value.item()
+    raise ValueError('Table values must be scalars, got shape {}'.format(value.shape))
+
+
+def load_table(path):
+    """
+    Load a table written by results_sink as a structured array.
+    """
+    return np.load(path)
+
+
+class results_table:
+    """
+    A single table of the results sink: a structured dtype, the CSV header
+    and the records waiting to be written.
+    """
+    def __init__(self, path, dtype, csv_header, write_npy=True, write_csv=False,
+                 append=False):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.csv_header = csv_header
+        self.write_npy = write_npy
+        self.write_csv = write_csv
+        self.rows = []
+        self.length = 0
+        if self.write_npy:
+            if append and os.path.exists(self.path + '.npy'):
+                self._repair()
+            else:
+                with open(self.path + '.npy', 'wb') as f:
+                    f.write(_header(self.dtype, 0))
+        if self.write_csv and not (append and os.path.exists(self.path + '.csv')):
+            with open(self.path + '.csv', 'w') as f:
+                f.write(self.csv_header + "\n")
+
+    def _repair(self):
+        # the file may have been cut back to the size it had at a checkpoint,
+        # so the number of records is taken from the size of the file
+        with open(self.path + '.npy', 'rb') as f:
+            f.seek(len(_MAGIC))
+            header_length = int(np.frombuffer(f.read(2), dtype=np.uint16)[0])
+            header = ast.literal_eval(f.read(header_length).decode('latin1'))
+        if np.dtype(np.lib.format.descr_to_dtype(header['descr'])) != self.dtype:
+            raise ValueError('{}.npy has a different dtype'.format(self.path))
+        data_size = os.path.getsize(self.path + '.npy') - _HEADER_LENGTH
+        self.length = data_size//self.dtype.itemsize
+        with open(self.path + '.npy', 'r+b') as f:
+            f.truncate(_HEADER_LENGTH + self.length*self.dtype.itemsize)
+            f.write(_header(self.dtype, self.length))
+
+    def append(self, *values):
+        if len(values) != len(self.dtype.names):
+            raise ValueError('{} expects {} values, got {}'.format(
+                self.path, len(self.dtype.names), len(values)))
+        self.rows.append(tuple(_value(v) for v in values))
+
+    def flush(self):
+        if len(self.rows) == 0:
+            return
+        records = np.array(self.rows, dtype=self.dtype)
+        if self.write_npy:
+            with open(self.path + '.npy', 'r+b') as f:
+                f.seek(0, os.SEEK_END)
+                f.write(records.tobytes())
+                self.length += records.shape[0]
+                f.seek(0)
+                f.write(_header(self.dtype, self.length))
+        if self.write_csv:
+            with open(self.path + '.csv', 'a') as f:
+                for row in self.rows:
+                    f.write("".join("{},".format(v) for v in row) + "\n")
+        self.rows = []
+
+
+class results_sink:
+    """
+    Collection of the results tables of a campaign. Tables are written to
+    results/<date>/<results_dir_name>_<table>.npy (and/or .csv, depending on
+    results_format: 'npy', 'csv' or 'both'). Buffered records are written
+    when more than flush_rows of them are waiting or when flush is called,
+    which the drivers do before every checkpoint and at the end of the run.
+    """
+    def __init__(self, date, results_dir_name, results_format='npy',
+                 flush_rows=10000, append=False):
+        if results_format not in ('npy', 'csv', 'both'):
+            raise ValueError('Unknown results format: {}'.format(results_format))
+        self.prefix = "results/{}/{}_".format(date, results_dir_name)
+        self.write_npy = results_format in ('npy', 'both')
+        self.write_csv = results_format in ('csv', 'both')
+        self.flush_rows = flush_rows
+        self.append_mode = append
+        self.tables = {}
+
+    def add_table(self, name, dtype, csv_header):
+        self.tables[name] = results_table(self.prefix + name, dtype, csv_header,
+                                          self.write_npy, self.write_csv,
+                                          self.append_mode)
+
+    def append(self, name, *values):
+        self.tables[name].append(*values)
+        if sum(len(t.rows) for t in self.tables.values()) > self.flush_rows:
+            self.flush()
+
+    def flush(self):
+        for table in self.tables.values():
+            table.flush()
+
+
+# tables written by the optimization drivers: dtype and CSV header
+RESULTS_TABLES = {
+    'model_record': ([('Isostrain', 'i8'), ('Isostress', 'i8'), 
+                      ('Isowork', 'i8'), ('RVE', 'i8')],
+                     "Isostrain,Isostress,Isowork,RVE,"),
+    'iteration_data': ([('Iteration', 'i8'), ('Model', 'i8'), 
+                        ('Temperature', 'f8'), ('Carbon', 'f8'), 
+                        ('Model Out', 'f8')],
+                       "Iteration,Model,Temperature,Carbon,Model Out,"),
+    'iteration_cost': ([('Model Cost', 'f8'), ('Total Budget Left', 'f8'), 
+                        ('RVE Budget Left', 'f8')],
+                       "Model Cost, Total Budget Left, RVE Budget Left,"),
+    'cost_ledger': ([('Iteration', 'i8'), ('ROM Evaluation', 'f8'), 
+                     ('RVE Evaluation', 'f8'), ('Acquisition Compute', 'f8'), 
+                     ('Charged', 'f8'), ('Total Budget Left', 'f8'), 
+                     ('RVE Budget Left', 'f8')],
+                    "Iteration,ROM Evaluation,RVE Evaluation,Acquisition Compute,Charged,Total Budget Left,RVE Budget Left,"),
+    'kg_throughput': ([('Iteration', 'i8'), ('Backend', 'U10'), 
+                       ('Workers', 'i8'), ('BLAS Threads', 'i8'), 
+                       ('Tasks', 'i8'), ('Wall Time', 'f8'), 
+                       ('Tasks per Second', 'f8'), ('Utilisation', 'f8')],
+                      "Iteration,Backend,Workers,BLAS Threads,Tasks,Wall Time,Tasks per Second,Utilisation,"),
+    'thread_calibration': ([('Workers', 'i8'), ('BLAS Threads', 'i8'), 
+                            ('Tasks per Second', 'f8')],
+                           "Workers,BLAS Threads,Tasks per Second,"),
+    'screening': ([('Iteration', 'i8'), ('Candidates', 'i8'), ('Kept', 'i8'), 
+                   ('Screening Time', 'f8'), ('Audited', 'i8'), 
+                   ('Choice Changed', 'i8'), ('Overlap', 'f8')],
+                  "Iteration,Candidates,Kept,Screening Time,Audited,Choice Changed,Overlap,"),
+    'acquisition': ([('Iteration', 'i8'), ('Candidates', 'i8'), ('Local Maxima', 'i8'), 
+                     ('GP Evaluations', 'i8'), ('Best EI', 'f8'), 
+                     ('Best Sample EI', 'f8'), ('Search Time', 'f8')],
+                    "Iteration,Candidates,Local Maxima,GP Evaluations,Best EI,Best Sample EI,Search Time,"),
+    'hp_pruning': ([('Iteration', 'i8'), ('HP Sets', 'i8'), ('Kept', 'i8'), 
+                    ('Best Log Likelihood', 'f8'), ('Pruning Time', 'f8')],
+                   "Iteration,HP Sets,Kept,Best Log Likelihood,Pruning Time,"),
+}
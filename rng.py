@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""
+Random number streams of the optimization drivers.
+
+All of the random numbers of a campaign are derived from a single seed with
+numpy's SeedSequence. Every stage that draws random numbers has its own
+stream, and the streams are keyed by the iteration (and the worker), so the
+numbers drawn by one stage do not depend on how many were drawn by another,
+or on the order in which the workers run:
+
+    streams = rng_streams(42)
+    x_test = lhs(2, 50, streams.generator('candidates', ii))
+
+Without a seed, fresh entropy is taken from the operating system; it is kept
+in rng_streams.entropy so the campaign can still be repeated.
+"""
+
+import numpy as np
+
+# the stages that draw random numbers, the number is the first part of the
+# spawn key of the stream so it must not change (3, 5 and 6 were streams of
+# code the drivers no longer run and are not used again)
+STREAMS = {'fused_hp': 0,
+           'candidates': 1,
+           'medoids': 2,
+           'kg_worker': 4,
+           'campaign': 7,
+           'hp_refit': 8}
+
+
+class rng_streams:
+    """
+    Independent random number streams derived from a single seed.
+    """
+    def __init__(self, seed=None):
+        self.entropy = np.random.SeedSequence(seed).entropy
+
+    def sequence(self, stream, *keys):
+        """
+        The SeedSequence of a stream, keys are non-negative integers such as
+        the iteration and the worker number.
+        """
+        return np.random.SeedSequence(self.entropy,
+                                      spawn_key=(STREAMS[stream],) + tuple(keys))
+
+    def generator(self, stream, *keys):
+        return np.random.Generator(np.random.PCG64(self.sequence(stream, *keys)))
+
+    def integer_seed(self, stream, *keys):
+        """
+        A 32 bit seed for the libraries that take an integer seed (the random
+        module, scikit-learn and np.random.seed).
+        """
+        return int(self.sequence(stream, *keys).generate_state(1)[0])
+
+
+def lhs(n, samples, rng):
+    """
+    Latin hypercube sample of samples points in n dimensions on [0, 1), drawn
+    from the numpy Generator rng. This is the same design as the 'classic'
+    (criterion=None) pyDOE lhs: one random point in each of the samples
+    intervals of every dimension, with the intervals of each dimension in a
+    random order.
+    """
+    cut = np.linspace(0, 1, samples + 1)
+    u = rng.random((samples, n))
+    a = cut[:samples]
+    b = cut[1:samples + 1]
+    points = u*(b - a)[:,None] + a[:,None]
+    H = np.zeros_like(points)
+    for j in range(n):
+        H[:,j] = points[rng.permutation(samples), j]
+    return H
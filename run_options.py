@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+Optional run options for the batch optimization drivers.
+
+The drivers take an ordered list of inputs (see the README). Any additional
+behaviour is controlled with named options given on the command line in the
+form --name=value (or --name for switches), for example
+
+    python CC_CC_optimization.py M52 2 10 50 2 1 14000 1000 --chunk-size=16
+
+The value of an option is converted to the type of its default value.
+"""
+
+DEFAULT_OPTIONS = {
+    # number of (model, candidate, hyper-parameter set) tasks sent to a worker
+    # in a single message, or 'auto' to size the chunks from measured latency
+    'chunk-size': 'auto',
+    # target duration (seconds) of a single chunk when chunk-size is 'auto'
+    'chunk-time': 0.5,
+    # how the knowledge gradient tasks are run: 'processes', 'threads' or
+    # 'serial'
+    'kg-backend': 'processes',
+    # number of knowledge gradient workers (0 for one per core, at most 20)
+    'kg-workers': 0,
+    # BLAS/OpenMP threads for each worker (0 to divide the cores evenly)
+    'blas-threads': 0,
+    # choose the workers x threads split with a short benchmark on the first
+    # iteration's tasks
+    'calibrate-threads': False,
+    # k-medoids method used to select the batch: the original 'voronoi'
+    # iteration, 'fastpam' or 'clara'
+    'medoid-method': 'voronoi',
+    # number of points above which 'fastpam' switches to CLARA sub-sampling
+    'clara-threshold': 2000,
+    # write a checkpoint of the loop state every this many iterations (0 to
+    # switch off checkpoints)
+    'checkpoint-every': 1,
+    # checkpoint file, results/<date> directory or 'latest' to resume from
+    'resume': '',
+    # results tables written by the drivers: 'npy' (typed tables that load
+    # with np.load), 'csv' or 'both'
+    'results-format': 'npy',
+    # write the wall and CPU time of each phase of every iteration to
+    # *_trace.jsonl
+    'trace': True,
+    # costs taken from the budgets: 'evaluation' (modelled cost of the model
+    # calls), 'compute' (measured time of the acquisition step) or both
+    'budget-charges': 'evaluation,compute',
+    # seed of all the random number streams of the campaign, -1 takes fresh
+    # entropy from the operating system (stored in the _seed.txt file)
+    'seed': -1,
+    # row of data/init_data.csv for the initial data, -1 reads it from
+    # current_index.txt
+    'init-index': -1,
+    # directory under results/ for the files of the campaign, by default the
+    # date and time it was started
+    'results-dir': '',
+    # how the truth model is evaluated: 'inline' (one point after another in
+    # the loop) or 'pool' (worker processes, while the loop goes on)
+    'truth-evaluator': 'inline',
+    # number of worker processes of the 'pool' truth evaluator
+    'truth-workers': 1,
+    # refinement of the feasibility map in the cells on the boundary of the
+    # feasible region, 1 is the 200 x 200 grid the classifier was trained on
+    'feasibility-refine': 1,
+    # design of the candidates inside the feasible region: 'lhs', 'sobol',
+    # 'random' or 'rejection' (the infeasible points of a Latin hypercube of
+    # the whole design space are dropped, the original scheme)
+    'candidate-sampler': 'lhs',
+    # keep the candidates between the iterations, adding new ones when more
+    # are needed, instead of drawing new ones every iteration
+    'candidate-pool': False,
+    # fraction of the candidates, by the upper confidence bound of the fused
+    # model, that go on to the knowledge gradient (1 is no screening)
+    'screen-keep': 1.0,
+    # weight of the standard deviation in the upper confidence bound
+    'screen-beta': 2.0,
+    # every this many iterations the knowledge gradient is also found for all
+    # the candidates, to check the screening (0 never)
+    'screen-audit': 0,
+    # the candidates are the local maxima of the expected improvement of the
+    # fused model, found by gradient search, instead of a sample
+    'acquisition-optimizer': False,
+    # number of local searches of the acquisition optimizer
+    'acquisition-starts': 10,
+    # how the batch of points is chosen from the knowledge gradient output:
+    # 'medoids' (clustering) or 'greedy' (one point at a time, with
+    # fantasized updates of the models)
+    'batch-selection': 'medoids',
+    # number of tasks run again for each point of a greedy batch after the
+    # first
+    'batch-shortlist': 10,
+    # the hyper-parameter sets of the fused GP whose log likelihood is more
+    # than this below the best are not used in the iteration (0 keeps all)
+    'hp-prune': 0.0,
+    # every this many iterations the hyper-parameters of the low order GPs
+    # and their error models are fitted again (0 never)
+    'hp-refit': 0,
+    # number of starts of the optimization of each GP in a refit
+    'hp-refit-starts': 5,
+    # number of worker processes that run the starts of a refit
+    'hp-refit-workers': 1,
+    # the GP backend: 'george', 'numpy' or 'auto' (george when it is
+    # installed)
+    'gp-backend': 'auto',
+    # number of inducing points of the Thermo-Calc and RVE GPs, which are
+    # then inducing point approximations (0 is the exact GPs)
+    'sparse-inducing': 0,
+    # the inducing point approximation: 'fitc' or 'vfe'
+    'sparse-method': 'fitc',
+}
+
+# value of an option given without a value, for options that are not switches
+SWITCH_VALUES = {
+    'resume': 'latest',
+}
+
+
+def _convert(name, value):
+    default = DEFAULT_OPTIONS[name]
+    if isinstance(default, bool):
+        if value is True:
+            return True
+        return str(value).lower() in ('1', 'true', 'yes', 'on')
+    if value is True:
+        if name in SWITCH_VALUES:
+            return SWITCH_VALUES[name]
+        raise ValueError('Run option --{} requires a value'.format(name))
+    if isinstance(default, int):
+        return int(value)
+    if isinstance(default, float):
+        return float(value)
+    return value
+
+
+def parse_run_options(argv):
+    """
+    Split the command line into the ordered list of inputs described in the
+    README and a dictionary with the value of every run option.
+    """
+    param = []
+    options = dict(DEFAULT_OPTIONS)
+    for arg in argv:
+        if arg.startswith('--'):
+            name, sep, value = arg[2:].partition('=')
+            if name not in DEFAULT_OPTIONS:
+                raise ValueError('Unknown run option: --{}'.format(name))
+            options[name] = _convert(name, value if sep else True)
+        else:
+            param.append(arg)
+    return param, options
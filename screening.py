@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""
+Screening of the candidates before the knowledge gradient.
+
+The knowledge gradient work grows as 3 models x candidates x hyper-parameter
+sets. The screening scores every candidate with the upper confidence bound
+(mean + beta x standard deviation) of a single fused GP, built with the
+median of the hyper-parameter sets, and only the best keep_ratio of the
+candidates go on to the knowledge gradient. This costs one fused GP and one
+prediction, so many more candidates can be drawn for the same cost.
+
+The screening is checked by an audit: on the audited iterations the
+knowledge gradient and the medoids are also found for all the candidates,
+and the two choices of points are compared (see compare_choices). The
+results are kept in the screening table.
+"""
+
+import numpy as np
+from math import ceil
+from copy import deepcopy
+
+
+def screen_candidates(model_control, x_fused, fused_model_HP, kernel, x_test,
+                      keep_ratio, beta=2.0, minimum=1):
+    """
+    The indices (in increasing order) of the candidates x_test with the
+    highest upper confidence bound, at least minimum of them, and the upper
+    confidence bound of every candidate.
+    """
+    hp = np.median(fused_model_HP, axis=0)
+    model = deepcopy(model_control)
+    model.create_fused_GP(x_fused, hp[0:2], hp[2], 0.1, kernel)
+    mean, var = model.fused_GP.predict_var(x_test)
+    mean = mean*model.fused_y_std + model.fused_y_mean
+    std = np.sqrt(np.maximum(var, 0))*model.fused_y_std
+    ucb = mean + beta*std
+    keep = min(x_test.shape[0], max(minimum, int(ceil(keep_ratio*x_test.shape[0]))))
+    # a stable sort, so candidates with the same bound keep their order
+    best = np.argsort(-ucb, kind='stable')[:keep]
+    return np.sort(best), ucb
+
+
+def medoid_choice(medoid_out):
+    """
+    The points chosen by the medoids: (temperature, carbon, model) for each
+    row of the knowledge gradient output.
+    """
+    return set([(round(float(row['temperature']), 6), round(float(row['carbon']), 6),
+                 int(row['model'])) for row in medoid_out])
+
+
+def compare_choices(screened_out, full_out):
+    """
+    Whether the points chosen with the screening differ from those chosen
+    without it, and the fraction of the latter that were chosen anyway.
+    """
+    screened = medoid_choice(screened_out)
+    full = medoid_choice(full_out)
+    overlap = len(screened & full)/len(full) if len(full) > 0 else 1.0
+    return screened != full, overlap
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+Control of the number of BLAS/OpenMP threads used by the knowledge gradient
+workers.
+
+NumPy (through BLAS/LAPACK) and george both start their own threads. When the
+drivers run one worker per core and every worker also uses one thread per core
+the workers fight over the cores, so the governor splits the available cores
+between the workers and the threads inside each worker. The split can be
+chosen by hand or by a short calibration run on the real tasks.
+"""
+
+import os
+import multiprocessing
+from contextlib import nullcontext
+from copy import copy
+
+# environment variables read by the BLAS/OpenMP libraries when they are loaded
+THREAD_ENV_VARS = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS',
+                   'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS']
+
+
+def available_cores():
+    """
+    The number of cores this process is allowed to run on.
+    """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return multiprocessing.cpu_count()
+
+
+def limit_threads(num_threads):
+    """
+    Context manager that limits the BLAS/OpenMP threads of the libraries that
+    are already loaded in this process. This needs the optional threadpoolctl
+    package; without it the limits are left unchanged.
+    """
+    if num_threads is None:
+        return nullcontext()
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        return nullcontext()
+    return threadpool_limits(limits=num_threads)
+
+
+def set_thread_environment(num_threads):
+    """
+    Set the thread environment variables, these only affect libraries loaded
+    after this call, for example in processes started with the 'spawn' method.
+    """
+    for name in THREAD_ENV_VARS:
+        os.environ[name] = str(num_threads)
+
+
+class thread_governor:
+    """
+    Holds the number of knowledge gradient workers and the number of
+    BLAS/OpenMP threads for each worker. A value of 0 selects the default:
+    one worker per core (20 workers on machines with more than 25 cores) and
+    the cores divided evenly between the workers.
+    """
+    def __init__(self, num_workers=0, blas_threads=0, max_workers=20):
+        self.cores = available_cores()
+        self.max_workers = max_workers
+        if num_workers > 0:
+            self.num_workers = num_workers
+        elif self.cores > 25:
+            self.num_workers = max_workers
+        else:
+            self.num_workers = self.cores
+        if blas_threads > 0:
+            self.blas_threads = blas_threads
+        else:
+            self.blas_threads = max(1, self.cores//self.num_workers)
+        self.calibration = []
+
+    def apply_environment(self):
+        set_thread_environment(self.blas_threads)
+
+    def candidate_splits(self):
+        """
+        (workers, threads per worker) pairs that use all of the cores: powers
+        of two up to the number of cores plus the default number of workers.
+        """
+        workers = set([min(self.cores, self.max_workers)])
+        w = 1
+        while w <= min(self.cores, self.max_workers):
+            workers.add(w)
+            w *= 2
+        return [(w, max(1, self.cores//w)) for w in sorted(workers)]
+
+    def calibrate(self, context, backend='processes', num_tasks=None,
+                  splits=None):
+        """
+        Run the first num_tasks knowledge gradient tasks of the context with
+        each (workers, threads) split and keep the split with the highest
+        throughput. By default eight tasks per core are used, which is enough
+        for the start-up costs to show without spending much of the budget.
+
+        Returns a list of (workers, threads, throughput) for the splits tried.
+        """
+        from kg_tasks import chunk_scheduler, run_kg_tasks
+        if splits is None:
+            splits = self.candidate_splits()
+        if num_tasks is None:
+            num_tasks = 8*self.cores
+        calibration_context = copy(context)
+        calibration_context.num_tasks = min(num_tasks, context.num_tasks)
+        results = []
+        for num_workers, blas_threads in splits:
+            kg_output, report = run_kg_tasks(calibration_context, num_workers,
+                                             chunk_scheduler(num_workers),
+                                             backend, blas_threads)
+            results.append((num_workers, blas_threads, report['throughput']))
+        best = max(results, key=lambda r: r[2])
+        self.num_workers, self.blas_threads = best[0], best[1]
+        self.calibration = results
+        return results
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+Evaluation of the truth model (the RVE) for the optimization drivers.
+
+The drivers submit the medoid points selected for the truth model as jobs
+and fold the results into the fused model when they are collected. An
+evaluator has three methods:
+    submit(iteration, x):  start the evaluation of the point x (a 1 x 2 array
+                           of temperature and carbon) chosen in iteration
+    collect(wait=False):   the (iteration, x, y) of the jobs that have
+                           finished since the last call, in the order they
+                           were submitted; with wait=True all of the jobs
+                           are waited for
+    pending():             the (iteration, x) of the jobs not collected yet,
+                           so they can be stored in the checkpoint and
+                           submitted again when the campaign is resumed
+and close(), which waits for any jobs still running and stops the workers
+(the jobs are not cancelled, collect(wait=True) beforehand returns their
+results).
+
+'inline' evaluates each point when it is submitted, which is the original
+behaviour of the drivers. 'pool' is a local stand-in for an external
+simulation queue: the points are evaluated by worker processes while the
+next iterations go on, and the results are folded in at the end of the
+first iteration in which they are found to be complete. The choices of the
+iterations between submission and collection are made without them, and
+which iteration that is depends on the timing, so the runs are not
+repeatable with the pool evaluator.
+"""
+
+import concurrent.futures
+
+
+class truth_evaluator:
+    def submit(self, iteration, x):
+        raise NotImplementedError
+
+    def collect(self, wait=False):
+        raise NotImplementedError
+
+    def pending(self):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class inline_evaluator(truth_evaluator):
+    """
+    Evaluate the truth model in this process when a job is submitted.
+    """
+    def __init__(self, truth_model):
+        self.truth_model = truth_model
+        self.done = []
+
+    def submit(self, iteration, x):
+        self.done.append((iteration, x, self.truth_model.predict(x)))
+
+    def collect(self, wait=False):
+        done = self.done
+        self.done = []
+        return done
+
+    def pending(self):
+        return []
+
+
+# the truth model of a worker process of the pool evaluator
+_truth_model = None
+
+
+def _start_worker(truth_model):
+    global _truth_model
+    _truth_model = truth_model
+
+
+def _evaluate(x):
+    return _truth_model.predict(x)
+
+
+class pool_evaluator(truth_evaluator):
+    """
+    Evaluate the truth model in a pool of worker processes, each of which is
+    given a copy of the truth model when it starts.
+    """
+    def __init__(self, truth_model, workers=1):
+        self.pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+                                                           initializer=_start_worker,
+                                                           initargs=(truth_model,))
+        self.jobs = []
+
+    def submit(self, iteration, x):
+        self.jobs.append((iteration, x, self.pool.submit(_evaluate, x)))
+
+    def collect(self, wait=False):
+        if wait:
+            concurrent.futures.wait([job[2] for job in self.jobs])
+        done = []
+        running = []
+        for job in self.jobs:
+            if job[2].done():
+                done.append(job)
+            else:
+                running.append(job)
+        self.jobs = running
+        return [(iteration, x, future.result()) for iteration, x, future in done]
+
+    def pending(self):
+        return [(iteration, x) for iteration, x, future in self.jobs]
+
+    def close(self):
+        self.pool.shutdown(wait=True)
+
+
+def create_truth_evaluator(kind, truth_model, workers=1):
+    """
+    The evaluator for the --truth-evaluator run option.
+    """
+    if kind == 'inline':
+        return inline_evaluator(truth_model)
+    if kind == 'pool':
+        return pool_evaluator(truth_model, workers)
+    raise ValueError('Unknown truth evaluator: {}'.format(kind))